@@ -0,0 +1,44 @@
+import numpy as np
+
+# The 8 symmetries of a square tile (the dihedral group D4): code k in
+# [0, 8) is a rotation by (k % 4) * 90 degrees, followed by a transpose
+# if k >= 4. Flips are in there too: lr is code 5, ud is code 7 and
+# lr_ud is code 2.
+N_TRANSFORMS = 8
+
+
+def d4_view(tile, code):
+    ''' Strided view of tile (H, W, ...) under transform code; no copy. '''
+    view = np.rot90(tile, code % 4, axes=(0, 1))
+    if code >= 4:
+        view = np.swapaxes(view, 0, 1)
+    return view
+
+
+def augment_batch(arrays, random_state=None, codes=None):
+    '''
+    Applies one random D4 transform per sample to a batch, the same
+    transform for every array in arrays (features, labels, cdl masks...).
+    Every array is (B, H, W, ...) with the same B, H and W, and H == W.
+    Each output sample is written once from a strided view of its input,
+    so the whole batch costs a single copy per array.
+    codes: (B,) transform codes; drawn from random_state if not given.
+    Returns (augmented arrays, codes).
+    '''
+    n_samples, height, width = arrays[0].shape[:3]
+    if height != width:
+        raise ValueError("D4 augmentation needs square tiles, got {}x{}".format(height, width))
+    if codes is None:
+        if random_state is None:
+            random_state = np.random
+        codes = random_state.randint(0, N_TRANSFORMS, size=n_samples)
+    out = []
+    for arr in arrays:
+        if arr.shape[:3] != (n_samples, height, width):
+            raise ValueError("arrays must share (B, H, W), got {} and {}".format(
+                arr.shape[:3], (n_samples, height, width)))
+        augmented = np.empty_like(arr)
+        for i, code in enumerate(codes):
+            augmented[i] = d4_view(arr[i], code)
+        out.append(augmented)
+    return out, codes
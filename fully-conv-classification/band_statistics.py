@@ -0,0 +1,315 @@
+import os
+import json
+import pickle
+import hashlib
+import argparse
+import numpy as np
+
+from glob import glob
+from collections import defaultdict
+
+STATS_FILE = 'band_stats.json'
+SCENE_STATS_TEMPLATE = 'band_stats_{}.json'
+# value of every band where a pixel is off the scene (Landsat fill, and
+# what aligned stacks are padded with).
+NODATA = 0
+
+
+def valid_pixels(data, nodata=NODATA):
+    ''' (n_pixels, n_bands) of the pixels of a (..., n_bands) array that
+    aren't nodata in every band. '''
+    flat = data.reshape(-1, data.shape[-1])
+    return flat[~np.all(flat == nodata, axis=1)]
+
+
+def band_moments(data):
+    '''
+    (mean, M2) per band of a (..., n_bands) array, where M2 is the sum of
+    squared deviations from the mean. One band at a time in float64, so a
+    uint16 tile is never copied whole.
+    '''
+    data = data.reshape(-1, data.shape[-1])
+    mean = np.empty(data.shape[1])
+    m2 = np.empty(data.shape[1])
+    for b in range(data.shape[1]):
+        band = data[:, b].astype(np.float64)
+        mean[b] = band.mean()
+        m2[b] = np.square(band - mean[b]).sum()
+    return mean, m2
+
+
+class BandStatistics(object):
+    '''
+    Streaming per band mean and variance (Welford, with Chan et al.'s
+    parallel update), so tiles, scenes and workers can each be summarized
+    on their own and merged exactly afterwards.
+
+    histogram_bins: also keep a histogram per band with this many equal
+    bins over histogram_range; histograms merge by addition.
+
+    update() leaves out nodata pixels (see valid_pixels), so fill around
+    the scene doesn't drag the means toward zero; callers add each scene
+    pixel once (see ScenePixels).
+
+    standardize() applies (x - mean) / std in float32 to any (..., n_bands)
+    array, the same for training batches and for inference.
+    '''
+
+    def __init__(self, n_bands, histogram_bins=None, histogram_range=(0, 65536)):
+        self.count = 0
+        self.mean = np.zeros(n_bands)
+        self.m2 = np.zeros(n_bands)
+        self.histogram_range = tuple(histogram_range)
+        self.histograms = None
+        if histogram_bins is not None:
+            self.histograms = np.zeros((n_bands, histogram_bins), dtype=np.int64)
+        self._scale = None
+
+
+    @property
+    def n_bands(self):
+        return self.mean.shape[0]
+
+
+    @property
+    def variance(self):
+        return self.m2 / max(self.count, 1)
+
+
+    @property
+    def std(self):
+        return np.sqrt(self.variance)
+
+
+    def update(self, data, nodata=NODATA):
+        ''' Adds every pixel of a (..., n_bands) array that isn't nodata. '''
+        flat = valid_pixels(data, nodata)
+        if not flat.shape[0]:
+            return
+        mean, m2 = band_moments(flat)
+        self.merge_moments(flat.shape[0], mean, m2)
+        if self.histograms is not None:
+            for b in range(self.n_bands):
+                self.histograms[b] += np.histogram(flat[:, b], bins=self.histograms.shape[1],
+                        range=self.histogram_range)[0]
+
+
+    def merge_moments(self, counts, means, m2s):
+        '''
+        Merges summaries (counts, means, M2s) of disjoint sets of pixels:
+        scalars for one set, or (n_sets,) counts with (n_sets, n_bands)
+        means and M2s for many at once.
+        '''
+        counts = np.append(np.atleast_1d(counts).astype(np.float64), self.count)
+        means = np.vstack([np.atleast_2d(means), self.mean])
+        m2s = np.vstack([np.atleast_2d(m2s), self.m2])
+        total = counts.sum()
+        if not total:
+            return
+        mean = (counts[:, None] * means).sum(axis=0) / total
+        self.m2 = m2s.sum(axis=0) + (counts[:, None] * np.square(means - mean)).sum(axis=0)
+        self.mean = mean
+        self.count = int(total)
+        self._scale = None
+
+
+    def merge(self, other):
+        self.merge_moments(other.count, other.mean, other.m2)
+        if self.histograms is not None and other.histograms is not None:
+            self.histograms += other.histograms
+
+
+    def scale(self):
+        ''' float32 (mean, 1 / std) per band, with constant bands left unscaled. '''
+        if self._scale is None:
+            std = self.std
+            std[std == 0] = 1
+            self._scale = (self.mean.astype(np.float32), (1 / std).astype(np.float32))
+        return self._scale
+
+
+    def standardize(self, x, out=None):
+        mean, inv_std = self.scale()
+        if out is None:
+            out = np.empty(x.shape, dtype=np.float32)
+        np.subtract(x, mean, out=out, casting='unsafe')
+        out *= inv_std
+        return out
+
+
+    def to_dict(self):
+        d = {'count': self.count, 'mean': self.mean.tolist(), 'm2': self.m2.tolist(),
+                'std': self.std.tolist()}
+        if self.histograms is not None:
+            d['histogram_range'] = list(self.histogram_range)
+            d['histograms'] = self.histograms.tolist()
+        return d
+
+
+    @classmethod
+    def from_dict(cls, d):
+        histograms = d.get('histograms')
+        stats = cls(len(d['mean']), histogram_bins=None if histograms is None else
+                len(histograms[0]), histogram_range=d.get('histogram_range', (0, 65536)))
+        stats.count = d['count']
+        stats.mean = np.asarray(d['mean'], dtype=np.float64)
+        stats.m2 = np.asarray(d['m2'], dtype=np.float64)
+        if histograms is not None:
+            stats.histograms = np.asarray(histograms, dtype=np.int64)
+        return stats
+
+
+    def save(self, path):
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.to_dict(), f)
+        os.replace(tmp, path)
+
+
+def load_band_statistics(band_statistics):
+    ''' Accepts None, a BandStatistics, a stats file or a directory holding one. '''
+    if band_statistics is None or isinstance(band_statistics, BandStatistics):
+        return band_statistics
+    if os.path.isdir(band_statistics):
+        band_statistics = os.path.join(band_statistics, STATS_FILE)
+    with open(band_statistics, 'r') as f:
+        return BandStatistics.from_dict(json.load(f))
+
+
+class ScenePixels(object):
+    '''
+    Which pixels of a scene have been counted, so that overlapping tiles
+    (strides smaller than the tile) add each scene pixel to the
+    statistics once. Windows are (x, y, tile_size) offsets, as in the
+    manifest; the mask grows to whatever windows it's given.
+    '''
+
+    def __init__(self, shape=(0, 0)):
+        self.counted = np.zeros(shape, dtype=bool)
+
+
+    def new_pixels(self, window, data):
+        ''' The pixels of the tile data at window not counted before, as
+        (n_pixels, n_bands); they're counted from now on. '''
+        x, y = int(window[0]), int(window[1])
+        end = (x + data.shape[0], y + data.shape[1])
+        if end[0] > self.counted.shape[0] or end[1] > self.counted.shape[1]:
+            counted = np.zeros((max(end[0], self.counted.shape[0]),
+                max(end[1], self.counted.shape[1])), dtype=bool)
+            counted[:self.counted.shape[0], :self.counted.shape[1]] = self.counted
+            self.counted = counted
+        seen = self.counted[x:end[0], y:end[1]]
+        new = data[~seen]
+        seen[...] = True
+        return new
+
+
+def save_scene_statistics(directory, scene, stats, tile_ids):
+    ''' The statistics of a scene's tiles, keyed by their ids, so that a
+    re-extraction that keeps every tile can keep them too. '''
+    path = os.path.join(directory, SCENE_STATS_TEMPLATE.format(scene))
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump({'tiles': _tile_ids_key(tile_ids), 'statistics': stats.to_dict()}, f)
+    os.replace(tmp, path)
+
+
+def load_scene_statistics(directory, scene, tile_ids=None):
+    ''' The saved statistics of scene, or None if there are none or they
+    were computed for other tiles than tile_ids. '''
+    path = os.path.join(directory, SCENE_STATS_TEMPLATE.format(scene))
+    if not os.path.isfile(path):
+        return None
+    with open(path, 'r') as f:
+        saved = json.load(f)
+    if tile_ids is not None and saved['tiles'] != _tile_ids_key(tile_ids):
+        return None
+    return BandStatistics.from_dict(saved['statistics'])
+
+
+def has_scene_statistics(directory):
+    return len(_scene_statistics_files(directory)) > 0
+
+
+def band_statistics_from_scenes(directory):
+    '''
+    Merges the per scene statistics extraction saves in directory (see
+    save_scene_statistics); no tile is opened. Each scene pixel under a
+    tile counts once, and nodata pixels not at all.
+    '''
+    stats = None
+    for path in _scene_statistics_files(directory):
+        with open(path, 'r') as f:
+            scene_stats = BandStatistics.from_dict(json.load(f)['statistics'])
+        if stats is None:
+            stats = BandStatistics(scene_stats.n_bands)
+        stats.merge(scene_stats)
+    if stats is None or not stats.count:
+        raise ValueError("no scene band statistics in {}; extract it again, or use "
+                "band_statistics_from_tiles".format(directory))
+    return stats
+
+
+def band_statistics_from_tiles(directory, histogram_bins=None):
+    '''
+    One pass over the tiles of the manifest of directory, for histograms or
+    for tiles extracted before scene statistics were saved. Overlapping
+    tiles add each scene pixel once, using the windows in the manifest;
+    tiles without one are counted whole.
+    '''
+    from tile_manifest import TileManifest, has_manifest
+    from tile_store import TileStore, is_tile_store
+    if not has_manifest(directory):
+        raise ValueError("no tile manifest in {}".format(directory))
+    store = TileStore(directory) if is_tile_store(directory) else None
+    scenes = defaultdict(ScenePixels)
+    stats = None
+    n_whole = 0
+    for record in TileManifest(directory).records:
+        if store is not None:
+            data = store[record['tile']]['data']
+        else:
+            data = _load_pickle(os.path.join(directory, record['tile']))['data']
+        if stats is None:
+            stats = BandStatistics(data.shape[-1], histogram_bins=histogram_bins)
+        if record.get('window') is None or record.get('path') is None:
+            n_whole += 1
+        else:
+            scene = (record['path'], record['row'], record['year'])
+            data = scenes[scene].new_pixels(record['window'], data)
+        stats.update(data)
+    if stats is None or not stats.count:
+        raise ValueError("no tiles with data in {}".format(directory))
+    if n_whole:
+        print("{} tiles have no window in the manifest and were counted whole".format(n_whole))
+    return stats
+
+
+def _scene_statistics_files(directory):
+    return sorted(glob(os.path.join(directory, SCENE_STATS_TEMPLATE.format('*'))))
+
+
+def _tile_ids_key(tile_ids):
+    return hashlib.sha1('\n'.join(sorted(tile_ids)).encode()).hexdigest()
+
+
+def _load_pickle(filename):
+    with open(filename, 'rb') as f:
+        return pickle.load(f)
+
+
+if __name__ == '__main__':
+
+    ap = argparse.ArgumentParser(description='write band_stats.json for a training directory')
+    ap.add_argument('directory', type=str)
+    ap.add_argument('--histogram-bins', type=int,
+            help='also histogram every band; reads every tile')
+    ap.add_argument('--from-tiles', action='store_true',
+            help='read every tile instead of merging the scene statistics of extraction')
+    args = ap.parse_args()
+    if args.histogram_bins is None and not args.from_tiles:
+        stats = band_statistics_from_scenes(args.directory)
+    else:
+        stats = band_statistics_from_tiles(args.directory, args.histogram_bins)
+    stats.save(os.path.join(args.directory, STATS_FILE))
+    print('{} pixels, mean {}, std {}'.format(stats.count, stats.mean, stats.std))
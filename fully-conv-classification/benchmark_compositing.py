@@ -0,0 +1,97 @@
+import argparse
+import numpy as np
+
+from time import time
+
+from runspec import landsat_rasters, static_rasters, climate_rasters
+from data_utils import (mean_of_three, median_of_three, paths_map_multiple_scenes,
+        stack_rasters_multiprocess)
+from compositing import composite_window, composite_scene, COMPOSITE_METHODS
+from fmask_cache import fmask_paths
+from rasterio import open as rasopen
+
+
+class _ArrayStack(object):
+    # the parts of an opened SceneStack that composite_window uses, over an
+    # in memory (n_rasters, height, width) stack, so both sides are timed
+    # without disk reads.
+
+    def __init__(self, paths_map, image_stack):
+        self.band_names = [name for name in sorted(paths_map) for _ in paths_map[name]]
+        self.image_stack = image_stack
+        self.n_bands = image_stack.shape[0]
+
+
+    def band_indices(self, band_name):
+        return [k for k, name in enumerate(self.band_names) if name == band_name]
+
+
+    def read(self, bands=None, window=None):
+        if isinstance(bands, str):
+            bands = self.band_indices(bands)
+        if bands is None:
+            bands = slice(None)
+        return self.image_stack[bands]
+
+
+def _synthetic_scene(n_scenes, size, cloud_fraction, satellite=8):
+    paths_map = {}
+    for band in landsat_rasters()[satellite]:
+        paths_map[band] = ['{}_{}'.format(k, band) for k in range(n_scenes)]
+    for band in static_rasters() + climate_rasters():
+        paths_map[band] = [band]
+    n_rasters = sum(len(p) for p in paths_map.values())
+    image_stack = np.random.randint(0, 20000, size=(n_rasters, size, size)).astype(np.uint16)
+    fmasks = (np.random.rand(n_scenes, size, size) < cloud_fraction).astype(np.uint8)
+    return paths_map, image_stack, fmasks
+
+
+def _timed(f, *args, **kwargs):
+    start = time()
+    out = f(*args, **kwargs)
+    return out, time() - start
+
+
+if __name__ == '__main__':
+
+    ap = argparse.ArgumentParser(description='mean_of_three/median_of_three vs. compositing.py')
+    ap.add_argument('--size', type=int, default=2048, help='side of the synthetic scene')
+    ap.add_argument('--cloud-fraction', type=float, default=0.2)
+    ap.add_argument('--image-directory', type=str,
+            help='also time a whole scene from disk, on a process pool')
+    args = ap.parse_args()
+
+    # the current functions only handle three scenes.
+    paths_map, image_stack, fmasks = _synthetic_scene(3, args.size, args.cloud_fraction)
+    stack = _ArrayStack(paths_map, image_stack)
+    mask_stack = _ArrayStack({'fmask': ['0', '1', '2']}, fmasks)
+    target_shape = (image_stack.shape[0], args.size, args.size)
+    # only the Landsat bands are compared: the current functions don't step past
+    # single rasters, so every later band repeats the first of them.
+    n_landsat = len(landsat_rasters()[8])
+    print('synthetic {0}x{0} scene, 3 dates, {1} rasters'.format(args.size, image_stack.shape[0]))
+    for name, old in (('mean', mean_of_three), ('median', median_of_three)):
+        expected, old_seconds = _timed(old, paths_map, image_stack, target_shape)
+        (out, _), seconds = _timed(composite_window, stack, method=name)
+        _, masked_seconds = _timed(composite_window, stack, method=name, fmasks=mask_stack)
+        print('{:>10}: {} {:.2f}s, composite_window {:.2f}s ({:.1f}x), with fmasks {:.2f}s, '
+                'max abs difference {:.3f}'.format(name, old.__name__, old_seconds, seconds,
+                    old_seconds / seconds, masked_seconds, np.abs(out - expected)[:n_landsat].max()))
+    for name in ('percentile', 'max_ndvi', 'medoid'):
+        _, seconds = _timed(composite_window, stack, method=name, fmasks=mask_stack)
+        print('{:>10}: composite_window with fmasks {:.2f}s'.format(name, seconds))
+
+    if args.image_directory is not None:
+        paths_map = paths_map_multiple_scenes(args.image_directory)
+        with rasopen(paths_map['B1.TIF'][0], 'r') as src:
+            meta = src.meta.copy()
+        shape = (meta['count'], meta['height'], meta['width'])
+        print(args.image_directory)
+        for name, old in (('mean', mean_of_three), ('median', median_of_three)):
+            start = time()
+            old(paths_map, stack_rasters_multiprocess(paths_map, meta, shape), shape)
+            old_seconds = time() - start
+            _, seconds = _timed(composite_scene, paths_map, meta, method=name,
+                    fmask_paths=fmask_paths(args.image_directory))
+            print('{:>10}: stack + {} {:.2f}s, composite_scene {:.2f}s ({:.1f}x)'.format(name,
+                old.__name__, old_seconds, seconds, old_seconds / seconds))
@@ -0,0 +1,75 @@
+import argparse
+import tensorflow as tf
+
+from time import time
+
+from data_generators import DataGenerator
+from tfrecord_pipeline import make_dataset, convert_pickle_directory, count_tiles
+
+# batches read before timing starts, the same for both pipelines, so neither
+# is charged for its first file opens, page cache misses or graph construction.
+WARMUP_STEPS = 5
+
+
+def _time_sequence(generator, n_steps, warmup_steps=WARMUP_STEPS):
+    warmup_steps = min(warmup_steps, len(generator))
+    n_steps = min(n_steps, len(generator) - warmup_steps)
+    for i in range(warmup_steps):
+        generator[i]
+    start = time()
+    for i in range(warmup_steps, warmup_steps + n_steps):
+        generator[i]
+    return n_steps / (time() - start)
+
+
+def _time_dataset(dataset, n_steps, warmup_steps=WARMUP_STEPS):
+    if tf.executing_eagerly():
+        batches = iter(dataset)
+        for _ in range(warmup_steps):
+            next(batches)
+        start = time()
+        for _ in range(n_steps):
+            next(batches)
+        return n_steps / (time() - start)
+    next_batch = tf.compat.v1.data.make_one_shot_iterator(dataset).get_next()
+    with tf.compat.v1.Session() as sess:
+        for _ in range(warmup_steps):
+            sess.run(next_batch)
+        start = time()
+        for _ in range(n_steps):
+            sess.run(next_batch)
+    return n_steps / (time() - start)
+
+
+if __name__ == '__main__':
+
+    ap = argparse.ArgumentParser(description='steps/sec of the pickle Sequence vs. tf.data')
+    ap.add_argument('--pickle-directory', type=str, required=True,
+            help='directory with class_N_data/*.pkl tiles')
+    ap.add_argument('--tfrecord-directory', type=str, required=True,
+            help='TFRecord shards of the same tiles; converted if empty')
+    ap.add_argument('--batch-size', type=int, default=4)
+    ap.add_argument('--n-classes', type=int, default=4)
+    ap.add_argument('--steps', type=int, default=100)
+    ap.add_argument('--warmup-steps', type=int, default=WARMUP_STEPS,
+            help='batches read by each pipeline before timing')
+    ap.add_argument('--augment', action='store_true')
+    ap.add_argument('--irrigated-weights', action='store_true',
+            help='scale the irrigated labels by 50 in both pipelines')
+    args = ap.parse_args()
+
+    if not count_tiles(args.tfrecord_directory):
+        print('converting', args.pickle_directory)
+        convert_pickle_directory(args.pickle_directory, args.tfrecord_directory)
+
+    generator = DataGenerator(args.pickle_directory, args.batch_size, n_classes=args.n_classes,
+            training=True, augment_data=args.augment, use_cdl=True,
+            apply_irrigated_weights=args.irrigated_weights)
+    dataset = make_dataset(args.tfrecord_directory, args.batch_size, args.n_classes,
+            training=True, augment_data=args.augment, use_cdl=True,
+            apply_irrigated_weights=args.irrigated_weights)
+    sequence_rate = _time_sequence(generator, args.steps, args.warmup_steps)
+    dataset_rate = _time_dataset(dataset, args.steps, args.warmup_steps)
+    print('pickle Sequence: {:.2f} steps/sec'.format(sequence_rate))
+    print('tf.data:         {:.2f} steps/sec'.format(dataset_rate))
+    print('speedup:         {:.2f}x'.format(dataset_rate / sequence_rate))
@@ -0,0 +1,244 @@
+import os
+import tempfile
+import numpy as np
+
+from multiprocessing import Pool
+
+from runspec import landsat_rasters
+from data_utils import SceneStack
+
+COMPOSITE_METHODS = ('mean', 'median', 'percentile', 'max_ndvi', 'medoid')
+# composites that pick one scene per pixel rather than reducing every band on its own.
+SELECTION_METHODS = ('max_ndvi', 'medoid')
+# (red, nir) by satellite.
+NDVI_BANDS = {4: ('B3.TIF', 'B4.TIF'), 5: ('B3.TIF', 'B4.TIF'), 7: ('B3.TIF', 'B4.TIF'),
+        8: ('B4.TIF', 'B5.TIF')}
+ROWS_PER_CHUNK = 512
+# beyond this many scenes, np.sort is faster than a sorting network.
+MAX_NETWORK_SCENES = 16
+
+
+def composite(scenes, method='median', obscured=None, percentile=50, ndvi_bands=None):
+    '''
+    Composite of a (n_scenes, n_bands, height, width) array of the same
+    bands over several dates: a float32 (n_bands, height, width) array,
+    nan where no scene is clear.
+
+    method: 'mean', 'median' or 'percentile' reduce each band over the
+    clear scenes of each pixel; 'max_ndvi' takes every band from the
+    clear scene with the greenest pixel, and 'medoid' from the clear scene
+    closest (summed euclidean distance over the bands) to the others.
+    obscured: (n_scenes, height, width) bool, True where a scene is cloudy.
+    ndvi_bands: (red, nir) indices into the band axis, for 'max_ndvi'.
+    '''
+    scenes = _masked(scenes, obscured)
+    if method in SELECTION_METHODS:
+        return take_scenes(scenes, choose_scenes(scenes, method, ndvi_bands))
+    return _reduce(scenes, method, percentile)
+
+
+def choose_scenes(scenes, method, ndvi_bands=None):
+    '''
+    Per pixel index of the scene a selection composite takes, -1 where
+    no scene is clear. scenes: (n_scenes, n_bands, height, width) float
+    with nan where obscured.
+    '''
+    clear = ~np.isnan(scenes).any(axis=1)
+    if method == 'max_ndvi':
+        if ndvi_bands is None:
+            raise ValueError("max_ndvi needs the (red, nir) band indices")
+        red = scenes[:, ndvi_bands[0]]
+        nir = scenes[:, ndvi_bands[1]]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            score = (nir - red) / (nir + red)
+        score[~clear | np.isnan(score)] = -np.inf
+        choice = np.argmax(score, axis=0)
+    elif method == 'medoid':
+        # pairs of scenes rather than an (n, n, ...) distance array, so a
+        # chunk needs only n_scenes planes of cost.
+        cost = np.zeros(clear.shape, dtype=np.float32)
+        for i in range(scenes.shape[0]):
+            for j in range(i + 1, scenes.shape[0]):
+                d = np.sqrt(np.square(scenes[i] - scenes[j]).sum(axis=0))
+                d[~(clear[i] & clear[j])] = 0
+                cost[i] += d
+                cost[j] += d
+        cost[~clear] = np.inf
+        choice = np.argmin(cost, axis=0)
+    else:
+        raise ValueError("method must be one of {}, got {}".format(SELECTION_METHODS, method))
+    choice[~clear.any(axis=0)] = -1
+    return choice
+
+
+def take_scenes(scenes, choice):
+    ''' (n_bands, height, width) of scenes at the per pixel scene index choice. '''
+    out = np.take_along_axis(scenes, np.maximum(choice, 0)[None, None], axis=0)[0]
+    out = out.astype(np.float32, copy=False)
+    out[:, choice < 0] = np.nan
+    return out
+
+
+def composite_window(stack, window=None, method='median', fmasks=None, satellite=8,
+        percentile=50):
+    '''
+    Composite of a window of an opened SceneStack (see
+    data_utils.SceneStack), one band per band name in sorted order, as
+    float32 (n_band_names, height, width); returns it and the band names.
+
+    Landsat bands, which must have a raster per scene, are masked with
+    fmasks: an opened SceneStack of the scenes' fmasks in the same (date)
+    order, where fmask == 1 is obscured. Bands with a single raster (the
+    static ones) are passed through. Other bands are reduced over their
+    rasters unmasked, or, for selection composites, taken from the chosen
+    scene if they have one raster per scene.
+    '''
+    names = sorted(set(stack.band_names))
+    landsat = [name for name in names if name in landsat_rasters()[satellite]]
+    if not len(landsat):
+        raise ValueError("no Landsat {} bands in the stack".format(satellite))
+    n_scenes = len(stack.band_indices(landsat[0]))
+    if any(len(stack.band_indices(name)) != n_scenes for name in landsat):
+        raise ValueError("every Landsat band needs one raster per scene")
+    scenes = np.stack([stack.read(name, window) for name in landsat], axis=1)
+    obscured = None
+    if fmasks is not None:
+        if fmasks.n_bands != n_scenes:
+            raise ValueError("{} fmasks for {} scenes".format(fmasks.n_bands, n_scenes))
+        obscured = fmasks.read(window=window) == 1
+    scenes = _masked(scenes, obscured)
+    choice = None
+    if method in SELECTION_METHODS:
+        ndvi_bands = None
+        if method == 'max_ndvi':
+            ndvi_bands = [landsat.index(name) for name in NDVI_BANDS[satellite]]
+        choice = choose_scenes(scenes, method, ndvi_bands)
+        landsat_composite = take_scenes(scenes, choice)
+    else:
+        landsat_composite = _reduce(scenes, method, percentile)
+
+    out = np.empty((len(names),) + landsat_composite.shape[1:], dtype=np.float32)
+    for k, name in enumerate(names):
+        if name in landsat:
+            out[k] = landsat_composite[landsat.index(name)]
+            continue
+        rasters = stack.read(name, window)[:, None]
+        if rasters.shape[0] == 1:
+            out[k] = rasters[0, 0]
+        elif choice is not None and rasters.shape[0] == n_scenes:
+            out[k] = take_scenes(rasters, choice)[0]
+        else:
+            out[k] = _reduce(_masked(rasters, None), 'mean' if choice is not None else method,
+                    percentile)[0]
+    return out, names
+
+
+def _masked(scenes, obscured):
+    if obscured is None:
+        return np.asarray(scenes, dtype=np.float32)
+    return np.where(obscured[:, None], np.float32(np.nan), scenes).astype(np.float32, copy=False)
+
+
+def _reduce(scenes, method, percentile=50):
+    if method == 'mean':
+        clear = ~np.isnan(scenes)
+        # a float32 count keeps the quotient float32.
+        count = clear.sum(axis=0, dtype=np.float32)
+        total = np.where(clear, scenes, 0).sum(axis=0, dtype=np.float32)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # nan where no scene is clear.
+            return total / count
+    if method == 'median':
+        return _nan_percentile(scenes, 50)
+    if method == 'percentile':
+        return _nan_percentile(scenes, percentile)
+    raise ValueError("method must be one of {}, got {}".format(COMPOSITE_METHODS, method))
+
+
+def _nan_percentile(scenes, q):
+    # np.nanpercentile goes pixel by pixel along the scene axis; it's far
+    # faster to sort that axis (nan sorts last) and interpolate between the
+    # ranks that each pixel's clear count gives.
+    ordered = _sort_scenes(scenes)
+    count = ordered.shape[0] - np.isnan(ordered).sum(axis=0, dtype=np.float32)
+    rank = (count - 1) * np.float32(q / 100.0)
+    lower = np.floor(rank)
+    upper = np.ceil(rank)
+    # plane by plane rather than fancy indexing; pixels without a clear
+    # scene stay nan.
+    below = np.full(rank.shape, np.nan, dtype=np.float32)
+    above = np.full(rank.shape, np.nan, dtype=np.float32)
+    for k in range(ordered.shape[0]):
+        np.copyto(below, ordered[k], where=lower == k)
+        np.copyto(above, ordered[k], where=upper == k)
+    return below + (above - below) * (rank - lower)
+
+
+def _sort_scenes(scenes):
+    if scenes.shape[0] > MAX_NETWORK_SCENES:
+        return np.sort(scenes, axis=0)
+    # odd-even transposition sort: whole planes are compare-swapped, which
+    # for a few scenes beats np.sort's strided sort along axis 0 several
+    # times over. fmin/maximum move nan to the end.
+    ordered = np.array(scenes, dtype=np.float32)
+    n = ordered.shape[0]
+    for p in range(n):
+        for i in range(p % 2, n - 1, 2):
+            lower = np.fmin(ordered[i], ordered[i + 1])
+            np.maximum(ordered[i], ordered[i + 1], out=ordered[i + 1])
+            ordered[i] = lower
+    return ordered
+
+
+_worker_stacks = {}
+
+
+def _open_worker_stacks(paths_map, target_geo, fmask_paths):
+    # once per worker process; the handles stay open for all its chunks.
+    # uint16 like the stack models are trained on.
+    _worker_stacks['scene'] = SceneStack(paths_map, target_geo, dtype=np.uint16).open()
+    _worker_stacks['fmask'] = None
+    if fmask_paths is not None:
+        _worker_stacks['fmask'] = SceneStack({'fmask': fmask_paths}, target_geo).open()
+
+
+def _composite_chunk(row_off, n_rows, out_file, out_shape, method, satellite, percentile):
+    stack = _worker_stacks['scene']
+    window = stack.window(row_off, 0, n_rows, stack.width)
+    chunk, _ = composite_window(stack, window, method, _worker_stacks['fmask'], satellite,
+            percentile)
+    out = np.memmap(out_file, dtype=np.float32, mode='r+', shape=out_shape)
+    out[:, window.row_off:window.row_off + window.height] = chunk
+    out.flush()
+    del out
+    return row_off
+
+
+def composite_scene(paths_map, target_geo, method='median', fmask_paths=None, satellite=8,
+        percentile=50, rows_per_chunk=ROWS_PER_CHUNK, n_processes=None,
+        temporary_directory=None):
+    '''
+    composite_window over a whole scene, in chunks of rows_per_chunk rows
+    on a process pool. Each worker opens the band files (and the fmasks in
+    fmask_paths, one per scene in date order) once and writes its chunks
+    into a memory mapped float32 (n_band_names, height, width) result,
+    whose backing file is unlinked once mapped (see
+    data_utils.stack_rasters_multiprocess). Returns it and the band names.
+    '''
+    if method not in COMPOSITE_METHODS:
+        raise ValueError("method must be one of {}, got {}".format(COMPOSITE_METHODS, method))
+    with SceneStack(paths_map, target_geo) as stack:
+        names = sorted(set(stack.band_names))
+        height, width = stack.height, stack.width
+    out_shape = (len(names), height, width)
+    fd, out_file = tempfile.mkstemp(suffix='.composite', dir=temporary_directory)
+    os.close(fd)
+    try:
+        out = np.memmap(out_file, dtype=np.float32, mode='w+', shape=out_shape)
+        with Pool(n_processes, initializer=_open_worker_stacks,
+                initargs=(paths_map, target_geo, fmask_paths)) as pool:
+            pool.starmap(_composite_chunk, [(y, rows_per_chunk, out_file, out_shape, method,
+                satellite, percentile) for y in range(0, height, rows_per_chunk)])
+    finally:
+        os.remove(out_file)
+    return out, names
@@ -8,7 +8,7 @@ import pdb
 import matplotlib.pyplot as plt
 
 from glob import glob
-from random import sample, shuffle, choice
+from random import sample, shuffle, choice, Random
 from scipy.ndimage.morphology import distance_transform_edt
 from rasterio import open as rasopen
 from rasterio.errors import RasterioIOError
@@ -17,18 +17,29 @@ from skimage.morphology import erosion
 from sat_image.warped_vrt import warp_single_image
 from tensorflow.keras.utils import Sequence
 from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from collections import defaultdict
 from sys import getsizeof, exit
 
 from data_utils import load_raster, paths_map_multiple_scenes, stack_rasters, stack_rasters_multiprocess, download_from_pr
 from shapefile_utils import get_shapefile_path_row, mask_raster_to_shapefile, filter_shapefile_overlapping, mask_raster_to_features
 from runspec import cdl_crop_values, cdl_non_crop_values
+from tile_store import TileStore, is_tile_store
+from tile_cache import TileCache
+from tile_manifest import TileManifest, has_manifest
+from label_encoding import LABEL_NODATA, one_hot_from_class_map, tile_class_map
+from augmentation import augment_batch
+from band_statistics import load_band_statistics
+from training_cubes import find_training_cubes, load_training_cube
 
 
 class SatDataGenerator(Sequence):
 
     def __init__(self, batch_size, n_classes, balance_pixels_per_batch=False, training=True,
-            apply_irrigated_weights=False, augment_data=False, use_cdl=False):
+            apply_irrigated_weights=False, augment_data=False, use_cdl=False,
+            prefetch_batches=0, prefetch_workers=1, prefetch_backend='thread',
+            prefetch_memory_bytes=None, seed=None, sparse_labels=False, cache_bytes=None,
+            cache_spill_directory=None, cache_spill_bytes=None, band_statistics=None):
 
         self.batch_size = batch_size
         self.n_classes = n_classes
@@ -37,8 +48,43 @@ class SatDataGenerator(Sequence):
         self.balance_pixels_per_batch = balance_pixels_per_batch
         self.apply_irrigated_weights = apply_irrigated_weights
         self.augment_data = augment_data
+        self.store = None
+        # cache_bytes: keep up to this many bytes of decoded tiles in memory
+        # (useful for a fixed validation set), spilling evicted tiles to
+        # cache_spill_directory if given.
+        self.cache = None
+        if cache_bytes is not None:
+            self.cache = TileCache(cache_bytes, cache_spill_directory, cache_spill_bytes)
+        # random_state draws what's chosen once per epoch in the main
+        # process (e.g. RandomWindowGenerator's windows); augmentation and
+        # pixel balancing draw from a RandomState per batch instead (see
+        # _batch_random_state), so they don't depend on which prefetch
+        # worker decodes the batch, or when.
+        self.seed = seed
+        self.epoch = 0
+        self.random_state = np.random.RandomState(seed)
+        # band_statistics: a BandStatistics or its json file (see
+        # band_statistics.py); features are standardized with it.
+        self.band_statistics = load_band_statistics(band_statistics)
+        # sparse_labels: yield (B, H, W, 1) uint8 class maps for
+        # masked_sparse_categorical_xent instead of one hot targets.
+        self.sparse_labels = sparse_labels
+        if self.sparse_labels and self.apply_irrigated_weights:
+            raise ValueError("apply_irrigated_weights requires one hot labels")
         if not self.training:
             self.augment_data = False
+        # prefetch_batches: how many batches past the requested one to
+        # decode in the background. Batches are keyed by index, so the
+        # file order from _build_file_list is never changed by the pool.
+        if prefetch_backend not in ('thread', 'process'):
+            raise ValueError("prefetch_backend must be one of thread, process")
+        self.prefetch_batches = prefetch_batches
+        self.prefetch_workers = prefetch_workers
+        self.prefetch_backend = prefetch_backend
+        self.prefetch_memory_bytes = prefetch_memory_bytes
+        self._executor = None
+        self._futures = {}
+        self._batch_nbytes = None
 
     def _get_files(self):
         # Required override.
@@ -57,114 +103,179 @@ class SatDataGenerator(Sequence):
         raise NotImplementedError
 
 
+    def _batch_files(self, idx):
+        return self.files[idx * self.batch_size:(idx + 1)*self.batch_size]
+
+
+    def _batch_random_state(self, idx):
+        # seeded from (seed, epoch, idx): the same batch of an epoch is
+        # augmented and balanced the same way whichever thread or process
+        # builds it.
+        if self.seed is None:
+            return np.random.RandomState()
+        return np.random.RandomState([self.seed % 2**32, self.epoch, idx])
+
+
+    def _batch_from_files(self, batch, random_state):
+        data_tiles = [self._load_tile(x) for x in batch]
+        if self.n_classes == 2:
+            return self._binary_labels_and_features(data_tiles, random_state)
+        return self._labels_and_features(data_tiles, random_state)
+
+
+    def _get_batch(self, idx):
+        if not self.prefetch_batches:
+            return self._batch_from_files(self._batch_files(idx), self._batch_random_state(idx))
+        if self._executor is None:
+            self._start_prefetch()
+        future = self._futures.pop(idx, None)
+        if future is None:
+            future = self._submit(idx)
+        for stale in [i for i in self._futures if i < idx]:
+            # the consumer moved past these (e.g. a shuffled enqueuer).
+            self._futures.pop(stale).cancel()
+        batch = future.result()
+        if self._batch_nbytes is None:
+            self._batch_nbytes = _nbytes(batch)
+        n_batches = int(np.ceil(len(self.files) / self.batch_size))
+        last = min(idx + 1 + self._prefetch_depth(), len(self), n_batches)
+        for i in range(idx + 1, last):
+            if i not in self._futures:
+                self._futures[i] = self._submit(i)
+        return batch
+
+
+    def _prefetch_depth(self):
+        # Bound the number of decoded batches held in memory.
+        if self._batch_nbytes is None:
+            return 1
+        depth = self.prefetch_batches
+        if self.prefetch_memory_bytes is not None:
+            depth = min(depth, self.prefetch_memory_bytes // max(self._batch_nbytes, 1))
+        return max(int(depth), 1)
+
+
+    def _start_prefetch(self):
+        if self.prefetch_backend == 'thread':
+            self._executor = ThreadPoolExecutor(max_workers=self.prefetch_workers)
+        else:
+            self._executor = ProcessPoolExecutor(max_workers=self.prefetch_workers,
+                    initializer=_init_prefetch_worker, initargs=(self,))
+
+
+    def _submit(self, idx):
+        batch = self._batch_files(idx)
+        random_state = self._batch_random_state(idx)
+        if self.prefetch_backend == 'thread':
+            return self._executor.submit(self._batch_from_files, batch, random_state)
+        return self._executor.submit(_prefetch_worker_batch, batch, random_state)
+
+
+    def _reset_prefetch(self):
+        # The file list is rebuilt every epoch, so anything queued is stale.
+        for future in self._futures.values():
+            future.cancel()
+        self._futures = {}
+
+
+    def close(self):
+        self._reset_prefetch()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+
+    def __getstate__(self):
+        # Sent to prefetch worker processes; they only need the
+        # decoding configuration, not the pool itself.
+        state = self.__dict__.copy()
+        state['_executor'] = None
+        state['_futures'] = {}
+        return state
+
+
     def _from_pickle(self, filename):
         with open(filename, 'rb') as f:
             data = pickle.load(f)
         return data
 
 
-    def _labels_and_features(self, data_tiles):
-        features = []
+    def _load_tile(self, x):
+        # x is an index into the tile store if there is one,
+        # otherwise a path to a pickled DataTile.
+        if self.cache is not None:
+            tile = self.cache.get(x)
+            if tile is not None:
+                return tile
+        if self.store is not None:
+            tile = self.store[x]
+        else:
+            tile = self._from_pickle(x)
+        if self.cache is not None:
+            self.cache.put(x, tile)
+        return tile
+
+
+    def _features(self, data_tiles):
+        if self.band_statistics is None:
+            return np.asarray([tile['data'] for tile in data_tiles])
+        # standardized straight into the float32 batch, one tile at a time.
+        features = np.empty((len(data_tiles),) + data_tiles[0]['data'].shape, dtype=np.float32)
+        for i, tile in enumerate(data_tiles):
+            self.band_statistics.standardize(tile['data'], out=features[i])
+        return features
+
+
+    def _labels_and_features(self, data_tiles, random_state):
         crop = list(cdl_crop_values().keys())
+        features = self._features(data_tiles)
+        class_maps = np.asarray([tile_class_map(tile) for tile in data_tiles])
         if self.use_cdl:
-            cdls = []
-        one_hots = []
+            cdls = np.isin(np.asarray([tile['cdl'] for tile in data_tiles]), crop)
         if self.balance_pixels_per_batch:
-            min_count = self._count_pixels(data_tiles)
-        for tile in data_tiles:
-            data = tile['data']
-            one_hot = tile['one_hot'].astype(np.int)
+            class_maps = self._balance_pixels(class_maps, self.n_classes, random_state)
+        if self.augment_data:
+            # augment the uint8 class maps, before they're expanded to one hot.
             if self.use_cdl:
-                cdl = tile['cdl'].astype(np.int)
-                cdl = np.isin(cdl, crop)
-                cdls.append(cdl)
+                (features, class_maps, cdls), _ = augment_batch([features, class_maps, cdls],
+                        random_state)
+            else:
+                (features, class_maps), _ = augment_batch([features, class_maps],
+                        random_state)
+        if self.sparse_labels:
+            labels = np.expand_dims(class_maps, -1)
+        else:
+            labels = one_hot_from_class_map(class_maps, self.n_classes)
             if self.apply_irrigated_weights:
-                one_hot[:, :, 0] *= 50
-            class_code = tile['class_code']
-            if self.balance_pixels_per_batch:
-                one_hot = self._balance_pixels(one_hot, min_count)
-            if self.augment_data:
-                data, one_hot = _augment_data(data, one_hot)
-            features.append(data)
-            one_hots.append(one_hot)
+                labels[:, :, :, 0] *= 50
 
         if self.use_cdl:
-            return [np.asarray(features)], [np.asarray(one_hots), np.asarray(cdls)]
+            return [features], [labels, cdls]
 
-        return [np.asarray(features)], [np.asarray(one_hots)]
+        return [features], [labels]
 
 
-    def _balance_pixels(self, one_hot, min_count, binary=False):
-
-        if binary:
-            ys, xs = np.where(one_hot[:, :] == 1)
-            if len(ys):
-                ys = np.random.choice(ys, size=int(len(ys)-min_count), replace=False)
-                xs = np.random.choice(xs, size=int(len(xs)-min_count), replace=False)
-                one_hot[ys, xs, i] = -1
-            ys, xs = np.where(one_hot[:, :] == 0)
-            if len(ys):
-                ys = np.random.choice(ys, size=int(len(ys)-min_count), replace=False)
-                xs = np.random.choice(xs, size=int(len(xs)-min_count), replace=False)
-                one_hot[ys, xs, i] = -1
-
-        else:
-            for i in range(one_hot.shape[2]):
-                ys, xs = np.where(one_hot[:, :, i] == 1)
-                if len(ys) == min_count:
-                    continue
-                if len(ys):
-                    n_to_choose = int(len(ys) - min_count) # 0 out all but min_count pixels
-                    ys = np.random.choice(ys, size=n_to_choose, replace=False)
-                    xs = np.random.choice(xs, size=n_to_choose, replace=False)
-                    one_hot[ys, xs, i] = 0
-            
-        return one_hot
-
-
-    def _count_pixels(self, data_tiles):
-        pixel_counts = np.ones((self.n_classes))*np.inf
-        for tile in data_tiles:
-            data = tile['data']
-            one_hot = tile['one_hot'].astype(np.int)
-            nodata_mask = np.sum(one_hot, axis=2) 
-            argmaxed = np.argmax(one_hot, axis=2) 
-            argmaxed[nodata_mask == 0] = -1
-            unique, counts = np.unique(argmaxed, return_counts=True) 
-            unique = unique[1:]
-            counts = counts[1:] 
-            for val, count in zip(unique, counts):
-                if count < pixel_counts[val]:
-                    pixel_counts[val] = count
-        return np.min(pixel_counts)
-    
+    def _balance_pixels(self, class_maps, n_classes, random_state):
+        ''' Sets all but min_count pixels of each class in each tile
+        of the (B, H, W) batch to LABEL_NODATA. '''
+        keep = balanced_pixel_mask(class_maps, n_classes, random_state)
+        class_maps[~keep] = LABEL_NODATA
+        return class_maps
 
-    def _binary_labels_and_features(self, data_tiles):
-        features = []
-        one_hots = []
 
+    def _binary_labels_and_features(self, data_tiles, random_state):
+        features = self._features(data_tiles)
+        class_maps = np.asarray([tile_class_map(tile) for tile in data_tiles])
+        binary_maps = (class_maps == 1).astype(np.uint8)
+        binary_maps[class_maps == LABEL_NODATA] = LABEL_NODATA
         if self.balance_pixels_per_batch:
-            min_count = self._count_pixels(data_tiles)
-        
-        for cnt, tile in enumerate(data_tiles):
-            data = tile['data']
-            one_hot = tile['one_hot'].astype(np.int)
-            binary_one_hot = np.ones((one_hot.shape[0], one_hot.shape[1])).astype(np.int)*-1 
-            for i in range(one_hot.shape[2]):
-                if i == 1:
-                    binary_one_hot[:, :][one_hot[:, :, i] == 1] = 1
-                else:
-                    binary_one_hot[:, :][one_hot[:, :, i] == 1] = 0
-            
-            if self.balance_pixels_per_batch:
-                one_hot = self._balance_pixels(one_hot, min_count, binary=True)
-
-            if self.augment_data:
-                data, binary_one_hot = _augment_data(data, binary_one_hot, binary=True)
-            binary_one_hot = np.expand_dims(binary_one_hot, 2)
-            features.append(data)
-            one_hots.append(binary_one_hot)
-        return [np.asarray(features)], [np.asarray(one_hots)]
+            binary_maps = self._balance_pixels(binary_maps, 2, random_state)
+        if self.augment_data:
+            (features, binary_maps), _ = augment_batch([features, binary_maps], random_state)
+        binary_one_hots = binary_maps.astype(np.int64)
+        binary_one_hots[binary_maps == LABEL_NODATA] = -1
+        binary_one_hots = np.expand_dims(binary_one_hots, -1)
+        return [features], [binary_one_hots]
 
 
 class DataGenerator(SatDataGenerator):
@@ -184,19 +295,47 @@ class DataGenerator(SatDataGenerator):
        Able to feed in examples that are balanced and in a definite order (queue of files)
        Able to feed in batches that are balanced on a pixel count level.
 
+    If data_directory has a manifest.jsonl (written during extraction),
+    the file lists come from it instead of listing the class directories,
+    and sample_by_pixels=True draws tiles weighted by their pixel counts.
     '''
     def __init__(self, data_directory, batch_size, n_classes=None, training=True,
             target_classes=None, balance=False, balance_examples_per_batch=False,
             balance_pixels_per_batch=False, apply_irrigated_weights=False,
-            steps_per_epoch=None, augment_data=False, use_cdl=False):
+            steps_per_epoch=None, augment_data=False, use_cdl=False, prefetch_batches=0,
+            prefetch_workers=1, prefetch_backend='thread', prefetch_memory_bytes=None, seed=None,
+            sparse_labels=False, cache_bytes=None, cache_spill_directory=None,
+            cache_spill_bytes=None, sample_by_pixels=False, rank=0, world_size=1,
+            shard_by_class=False, band_statistics=None):
         # Assert that all three can't be true
-        super().__init__(batch_size, n_classes, balance_pixels_per_batch, training, augment_data)
+        super().__init__(batch_size, n_classes, balance_pixels_per_batch=balance_pixels_per_batch,
+                training=training, apply_irrigated_weights=apply_irrigated_weights,
+                augment_data=augment_data, use_cdl=use_cdl, prefetch_batches=prefetch_batches,
+                prefetch_workers=prefetch_workers, prefetch_backend=prefetch_backend,
+                prefetch_memory_bytes=prefetch_memory_bytes, seed=seed,
+                sparse_labels=sparse_labels, cache_bytes=cache_bytes,
+                cache_spill_directory=cache_spill_directory, cache_spill_bytes=cache_spill_bytes,
+                band_statistics=band_statistics)
         self.data_directory = data_directory
         self.balance = balance
         self.balance_examples_per_batch = balance_examples_per_batch
         self.target_classes = target_classes
         self.steps_per_epoch = steps_per_epoch
         self.use_cdl = use_cdl
+        self.sample_by_pixels = sample_by_pixels
+        self.manifest = None
+        # rank/world_size: this node's disjoint slice of every epoch's file
+        # order. shard_by_class slices each class separately, so every rank
+        # keeps the class balance.
+        if world_size > 1 and seed is None:
+            raise ValueError("sharding across {} ranks requires a seed".format(world_size))
+        if not 0 <= rank < world_size:
+            raise ValueError("rank must be in [0, world_size)")
+        self.rank = rank
+        self.world_size = world_size
+        # pixel weighted draws are already class balanced; they shard the
+        # tiles themselves (see _pixel_weighted_file_list).
+        self.shard_by_class = shard_by_class and not sample_by_pixels
         self._get_files()
 
 
@@ -216,33 +355,73 @@ class DataGenerator(SatDataGenerator):
         return False
 
 
+    def _files_in(self, directory):
+        # Each class directory is listed once; every epoch after
+        # that gets a fresh copy of the same list.
+        if directory not in self._class_files:
+            class_code = int(os.path.basename(directory).split('_')[1])
+            if self.manifest is not None:
+                files = self.manifest.tiles_for_class(class_code)
+                if self.store is None:
+                    files = [os.path.join(self.data_directory, f) for f in files]
+            elif self.store is not None:
+                files = self.store.tiles_for_class(class_code)
+            else:
+                files = sorted(glob(os.path.join(directory, "*pkl")))
+            self._class_files[directory] = files
+        files = list(self._class_files[directory])
+        if self.shard_by_class:
+            self._epoch_rng(directory).shuffle(files)
+            files = self._shard(files)
+        return files
+
+
     def _get_files(self):
-        dirs = os.listdir(self.data_directory)
+        self._class_files = {}
+        if is_tile_store(self.data_directory):
+            self.store = TileStore(self.data_directory)
+        if has_manifest(self.data_directory):
+            self.manifest = TileManifest(self.data_directory)
+            dirs = ['class_{}_data'.format(c) for c in self.manifest.class_codes()]
+        elif self.store is not None:
+            # the store holds every class; keep the class_N_data naming
+            # so that target_classes and the file dicts work unchanged.
+            dirs = ['class_{}_data'.format(c) for c in self.store.class_codes()]
+        else:
+            dirs = os.listdir(self.data_directory)
+            for d in dirs:
+                if not os.path.isdir(os.path.join(self.data_directory, d)):
+                    raise ValueError("Non-directory object exists in data_directory")
         if self.n_classes is None:
             self.n_classes = len(dirs)
-        for d in os.listdir(self.data_directory):
-            if not os.path.isdir(os.path.join(self.data_directory, d)):
-                raise ValueError("Non-directory object exists in data_directory")
         dirs = [os.path.join(self.data_directory, d) for d in dirs \
                 if self._check_if_directory_is_in_targets(d)]
         self.dirs = dirs
+        if self.sample_by_pixels:
+            if self.manifest is None:
+                raise ValueError("sample_by_pixels requires a tile manifest in data_directory")
+            self._list_builder = self._pixel_weighted_file_list
+            self.n_files = self._build_file_list(first=True)
+            # tiles drawn with replacement, weighted so that every class
+            # contributes the same expected number of labelled pixels.
+            return
         if not self.balance and not self.balance_examples_per_batch:
-            self.n_files = self._unbalanced_file_list(dirs, first=True)
-            self._on_epoch_end = self._unbalanced_file_list
+            self._list_builder = self._unbalanced_file_list
+            self.n_files = self._build_file_list(first=True)
             # all training examples, randomly selected
             # number of files in an epoch is the sum of the files
             # for each class
             return
         elif self.balance:
-            self.n_files = self._balanced_file_list(dirs, first=True)
-            self._on_epoch_end = self._balanced_file_list
+            self._list_builder = self._balanced_file_list
+            self.n_files = self._build_file_list(first=True)
             # balanced file list with random selection
             # i.e. the number of files in an epoch
             # is n classes * min number of training examples for any class
             return
         if self.balance_examples_per_batch:
-            self.n_files = self._balanced_queue(dirs, first=True)
-            self._on_epoch_end = self._balanced_queue
+            self._list_builder = self._balanced_queue
+            self.n_files = self._build_file_list(first=True)
             # all training examples, fed to the network in sequential order 
             # i.e. 1, 2, 3, 4, 1, 2, 3, 4
             # the number of files in an epoch is 
@@ -258,19 +437,58 @@ class DataGenerator(SatDataGenerator):
     def on_epoch_end(self):
         # Recreates the file list if you're training,
         # otherwise the validation file list stays the same.
-        self._on_epoch_end(self.dirs, first=False)
+        self._reset_prefetch()
+        if not self.training:
+            return
+        self.epoch += 1
+        self._build_file_list(first=False)
 
 
-    def __getitem__(self, idx):
-        # model.fit_generator does not pull batches in order.
-        batch = self.files[idx * self.batch_size:(idx + 1)*self.batch_size]
-        data_tiles = [self._from_pickle(x) for x in batch]
-        self.batch = batch
-        if self.n_classes == 2:
-            batch_x, batch_y = self._binary_labels_and_features(data_tiles)
-        else:
-            batch_x, batch_y = self._labels_and_features(data_tiles)
+    def set_epoch(self, epoch):
+        ''' Rebuilds the file list for epoch, e.g. when resuming. '''
+        self._reset_prefetch()
+        self.epoch = epoch
+        self._build_file_list(first=False)
+
+
+    def _epoch_rng(self, *keys):
+        # Seeded from (seed, epoch), so every rank builds the same
+        # global order before taking its slice.
+        if self.seed is None:
+            return Random()
+        return Random('-'.join(str(k) for k in (self.seed, self.epoch) + keys))
+
+
+    def _build_file_list(self, first):
+        self._rng = self._epoch_rng()
+        self._list_builder(self.dirs, first)
+        if not self.shard_by_class and not self.sample_by_pixels:
+            self.files = self._shard(self.files)
+        return len(self.files)
+
+
+    def _n_epoch_files(self):
+        # steps_per_epoch is per rank; the global list is sharded afterwards
+        # unless the class lists were already sharded.
+        n = self.steps_per_epoch*self.batch_size
+        if not self.shard_by_class:
+            n *= self.world_size
+        return n
 
+
+    def _shard(self, files):
+        # Equal length slices, so all ranks run the same number of steps.
+        if self.world_size == 1:
+            return files
+        n = len(files) // self.world_size
+        return files[self.rank::self.world_size][:n]
+
+
+    def __getitem__(self, idx):
+        # model.fit_generator does not pull batches in order
+        # unless it's called with shuffle=False.
+        self.batch = self._batch_files(idx)
+        batch_x, batch_y = self._get_batch(idx)
         return batch_x, batch_y
     
 
@@ -279,56 +497,87 @@ class DataGenerator(SatDataGenerator):
         if first:
             self.files = []
             for d in dirs:
-                self.files.extend(glob(os.path.join(d, "*pkl")))
-            shuffle(self.files)
+                self.files.extend(self._files_in(d))
+            self._rng.shuffle(self.files)
             self.entire_corpus = self.files.copy()
             if not self.training and self.steps_per_epoch is not None:
                 self.entire_corpus = self.files.copy()
-                self.files = self.entire_corpus[:self.steps_per_epoch*self.batch_size]
+                self.files = self.entire_corpus[:self._n_epoch_files()]
             elif not self.training:
                 self.files = self.entire_corpus
             return len(self.files)
         else:
-            shuffle(self.entire_corpus)
+            # sort first so the order only depends on (seed, epoch).
+            self.entire_corpus.sort()
+            self._rng.shuffle(self.entire_corpus)
             if self.steps_per_epoch is None:
                 self.files = self.entire_corpus
             else:
-                self.files = self.entire_corpus[:self.steps_per_epoch*self.batch_size]
+                self.files = self.entire_corpus[:self._n_epoch_files()]
     
     
+    def _pixel_weighted_file_list(self, dirs, first):
+        class_codes = [int(os.path.basename(d).split('_')[1]) for d in dirs]
+        if first:
+            self._weighted_files = self.manifest.tiles(class_codes)
+            if self.store is None:
+                self._weighted_files = [os.path.join(self.data_directory, f) for f in
+                        self._weighted_files]
+            self._weights = self.manifest.pixel_weights(class_codes)
+        # the tiles are split between the ranks before drawing, each rank
+        # drawing (with replacement) only from its own slice, so no tile
+        # is seen by two ranks in an epoch. The split is redrawn every
+        # epoch from the shared (seed, epoch) order.
+        random_state = np.random.RandomState(self._rng.randrange(2**32))
+        population = np.arange(len(self._weighted_files))
+        if self.world_size > 1:
+            population = self._shard(random_state.permutation(population))
+        weights = self._weights[population]
+        if weights.sum() > 0:
+            weights = weights / weights.sum()
+        else:
+            weights = None
+        n = len(population)
+        if self.steps_per_epoch is not None:
+            n = self.steps_per_epoch*self.batch_size
+        idx = random_state.choice(population, size=n, p=weights)
+        self.files = [self._weighted_files[i] for i in idx]
+        return len(self.files)
+
+
     def _balanced_file_list(self, dirs, first):
         if first:
             self.file_dict = {}
             self.n_minority = np.inf
             for d in dirs:
-                files = glob(os.path.join(d, "*pkl"))
-                shuffle(files)
+                files = self._files_in(d)
+                self._rng.shuffle(files)
                 self.file_dict[d] = files
                 if len(files) < self.n_minority:
                     self.n_minority = len(files)
             self.files = []
             for key in self.file_dict:
-                self.files.extend(sample(self.file_dict[key], self.n_minority))
+                self.files.extend(self._rng.sample(self.file_dict[key], self.n_minority))
             return len(self.files)
         else:
             self.files = []
             for key in self.file_dict:
-                self.files.extend(sample(self.file_dict[key], self.n_minority))
-            shuffle(self.files)
+                self.files.extend(self._rng.sample(self.file_dict[key], self.n_minority))
+            self._rng.shuffle(self.files)
 
     def _balanced_queue(self, dirs, first):
         # do this until the majority class file list is empty
         self.file_dict = {}
         self.n_minority = np.inf
         for d in dirs:
-            files = glob(os.path.join(d, "*pkl"))
-            shuffle(files)
+            files = self._files_in(d)
+            self._rng.shuffle(files)
             self.file_dict[d] = files
             if len(files) < self.n_minority:
                 self.n_minority = len(files)
         if not first:
             for key in self.file_dict:
-                shuffle(self.file_dict[key])
+                self._rng.shuffle(self.file_dict[key])
         self.files = []
         to_empty = self.file_dict.copy()
         while True:
@@ -343,43 +592,185 @@ class DataGenerator(SatDataGenerator):
         return len(self.files)
 
 
-def _flip_lr(feature_tile, one_hot, binary=False):
-    for i in range(feature_tile.shape[2]):
-        feature_tile[:, :, i] = np.fliplr(feature_tile[:, :, i])
-    if binary:
-        one_hot = np.fliplr(one_hot)
-        return feature_tile, one_hot
-    for i in range(one_hot.shape[2]):
-        one_hot[:, :, i] = np.fliplr(one_hot[:, :, i])
-    return feature_tile, one_hot
+class RandomWindowGenerator(SatDataGenerator):
+    '''
+    Crops random tile_size windows at batch time from whole path/row
+    cubes (see training_cubes.py) instead of reading pre-cut tiles.
+
+    Windows are stratified by class coverage: each window picks a class
+    uniformly among the classes present, a cube with probability
+    proportional to that class's pixel count, and one of up to
+    max_candidates pixels of that class in the cube. The window is centred
+    on the pixel, jittered by up to a quarter tile, and clipped to the cube.
+    Training windows are redrawn every epoch; validation windows are
+    drawn once.
+    '''
+    def __init__(self, cube_directory, batch_size, n_classes, steps_per_epoch, tile_size=608,
+            max_candidates=100000, training=True, balance_pixels_per_batch=False,
+            apply_irrigated_weights=False, augment_data=False, use_cdl=False, prefetch_batches=0,
+            prefetch_workers=1, prefetch_backend='thread', prefetch_memory_bytes=None, seed=None,
+            sparse_labels=False, cache_bytes=None, cache_spill_directory=None,
+            cache_spill_bytes=None, band_statistics=None):
+        super().__init__(batch_size, n_classes, balance_pixels_per_batch=balance_pixels_per_batch,
+                training=training, apply_irrigated_weights=apply_irrigated_weights,
+                augment_data=augment_data, use_cdl=use_cdl, prefetch_batches=prefetch_batches,
+                prefetch_workers=prefetch_workers, prefetch_backend=prefetch_backend,
+                prefetch_memory_bytes=prefetch_memory_bytes, seed=seed,
+                sparse_labels=sparse_labels, cache_bytes=cache_bytes,
+                cache_spill_directory=cache_spill_directory, cache_spill_bytes=cache_spill_bytes,
+                band_statistics=band_statistics)
+        self.cube_directory = cube_directory
+        self.steps_per_epoch = steps_per_epoch
+        self.tile_size = tile_size
+        self.max_candidates = max_candidates
+        self._cubes = None
+        self._get_files()
+
+
+    def _get_files(self):
+        self.cube_directories = find_training_cubes(self.cube_directory)
+        if not len(self.cube_directories):
+            raise ValueError("no training cubes in {}".format(self.cube_directory))
+        # candidates[c][k]: flat pixel indices of class c in cube k;
+        # pixel_counts[c, k]: all pixels of class c in cube k.
+        self.shapes = []
+        self.candidates = defaultdict(dict)
+        self.pixel_counts = np.zeros((self.n_classes, len(self.cube_directories)), dtype=np.int64)
+        for k in range(len(self.cube_directories)):
+            _, class_map, _ = self._cube(k)
+            if min(class_map.shape) < self.tile_size:
+                raise ValueError("cube {} {} is smaller than tile_size {}".format(
+                    self.cube_directories[k], class_map.shape, self.tile_size))
+            self.shapes.append(class_map.shape)
+            flat = class_map.ravel()
+            labelled = np.flatnonzero(flat < self.n_classes)
+            classes = flat[labelled]
+            # one pass over the labelled pixels, grouped by class.
+            order = np.argsort(classes, kind='stable')
+            counts = np.bincount(classes, minlength=self.n_classes)
+            starts = np.cumsum(counts) - counts
+            for c in np.flatnonzero(counts):
+                pixels = labelled[order[starts[c]:starts[c] + counts[c]]]
+                if pixels.shape[0] > self.max_candidates:
+                    pixels = self.random_state.choice(pixels, self.max_candidates, replace=False)
+                self.candidates[c][k] = pixels
+                self.pixel_counts[c, k] = counts[c]
+        self.classes = np.flatnonzero(self.pixel_counts.sum(axis=1))
+        self.n_files = self._draw_windows()
+
+
+    def _cube(self, k):
+        # memory maps are opened lazily so that process workers reopen
+        # them instead of receiving pickled copies of the arrays.
+        if self._cubes is None:
+            self._cubes = {}
+        if k not in self._cubes:
+            self._cubes[k] = load_training_cube(self.cube_directories[k])
+        return self._cubes[k]
+
+
+    def _draw_windows(self):
+        n = self.steps_per_epoch*self.batch_size
+        self.files = []
+        for c in self.random_state.choice(self.classes, n):
+            weights = self.pixel_counts[c] / self.pixel_counts[c].sum()
+            k = self.random_state.choice(len(weights), p=weights)
+            pixel = self.random_state.choice(self.candidates[c][k])
+            height, width = self.shapes[k]
+            i, j = np.unravel_index(pixel, (height, width))
+            jitter = self.random_state.randint(-(self.tile_size // 4), self.tile_size // 4 + 1,
+                    size=2)
+            i = int(np.clip(i - self.tile_size // 2 + jitter[0], 0, height - self.tile_size))
+            j = int(np.clip(j - self.tile_size // 2 + jitter[1], 0, width - self.tile_size))
+            self.files.append((k, i, j, int(c)))
+        return len(self.files)
+
+
+    def _load_tile(self, window):
+        if self.cache is not None:
+            tile = self.cache.get(window)
+            if tile is not None:
+                return tile
+        k, i, j, class_code = window
+        features, class_map, cdl = self._cube(k)
+        window_slice = (slice(i, i + self.tile_size), slice(j, j + self.tile_size))
+        tile = {'data': np.array(features[window_slice]),
+                'class_map': np.array(class_map[window_slice]),
+                'cdl': np.array(cdl[window_slice]),
+                'class_code': class_code}
+        if self.cache is not None:
+            self.cache.put(window, tile)
+        return tile
 
 
-def _flip_ud(feature_tile, one_hot, binary=False):
+    def __len__(self):
+        return self.steps_per_epoch
 
-    for i in range(feature_tile.shape[2]):
-        feature_tile[:, :, i] = np.flipud(feature_tile[:, :, i])
-    if binary:
-        one_hot = np.flipud(one_hot)
-        return feature_tile, one_hot
-    for i in range(one_hot.shape[2]):
-        one_hot[:, :, i] = np.flipud(one_hot[:, :, i])
-    return feature_tile, one_hot
 
+    def on_epoch_end(self):
+        self._reset_prefetch()
+        if self.training:
+            self.epoch += 1
+            self._draw_windows()
 
-def _flip_lr_ud(feature_tile, one_hot, binary=False):
-    feature_tile, one_hot = _flip_lr(feature_tile, one_hot, binary)
-    feature_tile, one_hot = _flip_ud(feature_tile, one_hot, binary)
-    return feature_tile, one_hot
+
+    def __getitem__(self, idx):
+        return self._get_batch(idx)
 
 
-def _do_nothing(feature_tile, one_hot, binary):
-    return feature_tile, one_hot
+    def __getstate__(self):
+        state = super().__getstate__()
+        state['_cubes'] = None
+        return state
 
 
-def _augment_data(feature_tile, one_hot, binary=False):
-    ''' Applies rotation | lr | ud | lr_ud | flipping, or doesn't. '''
-    possible_augments = [_flip_ud, _flip_lr, _flip_lr_ud, _do_nothing]
-    return choice(possible_augments)(feature_tile, one_hot, binary)
+def balanced_pixel_mask(labels, n_classes, random_state=None, min_count=None):
+    '''
+    labels: (B, H, W) class indices; anything outside [0, n_classes),
+    e.g. LABEL_NODATA, is nodata.
+    Returns a boolean mask of the same shape that keeps min_count randomly
+    chosen pixels of every class present in every tile. min_count defaults
+    to the smallest nonzero per-tile class count in the batch.
+
+    Each labelled pixel gets a (tile, class) group id plus a uniform key in
+    [0, 1); one argsort of group + key is a random permutation within every
+    group, so ranks below min_count are the kept pixels. Whole (y, x)
+    positions are sampled, not ys and xs separately.
+    '''
+    if random_state is None:
+        random_state = np.random
+    flat = labels.reshape(labels.shape[0], -1)
+    valid = (flat >= 0) & (flat < n_classes)
+    tiles = np.broadcast_to(np.arange(flat.shape[0])[:, None], flat.shape)
+    group = tiles[valid] * n_classes + flat[valid]
+    counts = np.bincount(group, minlength=flat.shape[0]*n_classes)
+    if min_count is None:
+        if not np.any(counts):
+            return valid.reshape(labels.shape)
+        min_count = counts[counts > 0].min()
+    order = np.argsort(group + random_state.random_sample(group.shape[0]))
+    starts = np.cumsum(counts) - counts
+    rank = np.empty_like(order)
+    rank[order] = np.arange(order.shape[0]) - starts[group[order]]
+    keep = np.zeros(flat.shape, dtype=bool)
+    keep[valid] = rank < min_count
+    return keep.reshape(labels.shape)
+
+
+_worker_generator = None
+
+def _init_prefetch_worker(generator):
+    global _worker_generator
+    _worker_generator = generator
+
+
+def _prefetch_worker_batch(batch, random_state):
+    return _worker_generator._batch_from_files(batch, random_state)
+
+
+def _nbytes(batch):
+    batch_x, batch_y = batch
+    return sum(np.asarray(arr).nbytes for arr in list(batch_x) + list(batch_y))
 
 
 if __name__ == '__main__':
@@ -2,7 +2,7 @@ import os
 import geopandas as gpd
 import json
 import pdb
-import datetime
+import tempfile
 import numpy as np
 
 from fiona import open as fopen
@@ -14,18 +14,22 @@ from shapely.geometry import shape, mapping
 from collections import defaultdict
 from rasterio import float32, open as rasopen
 from shapely.geometry import shape, Polygon, mapping
-from rasterio.mask import mask
+from rasterio.features import geometry_mask
+from rasterio.vrt import WarpedVRT
+from rasterio.windows import Window, from_bounds as window_from_bounds, transform as window_transform
+from rasterio.enums import Resampling
 from pickle import load
 from multiprocessing import Pool
+from contextlib import ExitStack, contextmanager
 from sat_image.image import Landsat8
 
 from prepare_images import ImageStack
 from crop_data_layer import CropDataLayer as Cdl
 from shapefile_utils import get_features
-from sat_image.warped_vrt import warp_single_image
-from runspec import landsat_rasters, static_rasters, climate_rasters
+from runspec import landsat_rasters, static_rasters, climate_rasters, wrs2_index, WRS2_DESCENDING_USA
+from raster_catalog import raster_catalog, LANDSAT_SCENE
 
-WRS2 = '../spatial_data/wrs2_descending_usa.shp'
+WRS2 = WRS2_DESCENDING_USA
 
 def download_cdl_over_path_row(path, row, year, image_directory):
 
@@ -42,7 +46,7 @@ def download_cdl_over_path_row(path, row, year, image_directory):
     print(path, row, year)
     for r in sub_dirs:
         if os.path.isdir(os.path.join(out_dir, r)):
-            if 'climate' not in r:
+            if LANDSAT_SCENE.match(r):
                 random_landsat_dir = os.path.join(out_dir, r)
                 break
 
@@ -103,107 +107,59 @@ def _download_images(project_directory, path, row, year, satellite,
     return image_stack
 
 
-def _parse_landsat_capture_date(landsat_scene):
-    '''
-    returns: calendar date of scene capture
-    landsat_scene is a directory (i.e data/38_27_2013/')
-    scene ID:
-       LXSPPPRRRYYYYDDDGSIVV
-       L = Landsat
-       X = Sensor
-       S = Satellite
-       PPP = WRS Path
-       RRR = WRS Row
-       YYYY = Year
-       DDD = Julian day
-       GSI = Ground station ident
-       VV = Archived version number
-    '''
-    julian_year_day = landsat_scene[-10:-5]
-    return datetime.datetime.strptime(julian_year_day, '%y%j').date()
+def _band_names(satellite=8):
+    return list(landsat_rasters()[satellite]) + list(static_rasters()) + list(climate_rasters())
 
 
 def _landsat_band_map(subdirectory, satellite=8):
-    band_map = dict()
-
-    for band in landsat_rasters()[satellite]:
-        band_map[band] = None
-    for band in static_rasters():
-        band_map[band] = None
-    for band in climate_rasters():
-        band_map[band] = None
-
-    extensions = (".tif", ".TIF")
-    for dirpath, dirnames, filenames in os.walk(subdirectory):
-        for f in filenames:
-            if any(ext in f for ext in extensions):
-                for band in band_map:
-                    if f.endswith(band):
-                        band_map[band] = os.path.join(dirpath, f)
+    band_map = dict((band, None) for band in _band_names(satellite))
+    for raster in raster_catalog(subdirectory).query(subdirectory, list(band_map)):
+        band_map[raster.band] = raster.filepath
     return band_map
 
 
 def _climate_band_map(directory, band_map, date):
-
-    files = glob(os.path.join(directory, '*.tif'))
-    files.extend(glob(os.path.join(directory, '*.TIF')))
-    for f in files:
-        datestring = os.path.basename(f)[:10]
-        cur = datetime.datetime.strptime(datestring, '%Y-%m-%d').date()
-        if date == cur:
-            for band in band_map:
-                if f.endswith(band):
-                    band_map[band] = os.path.join(directory, f)
+    for raster in raster_catalog(directory).query(directory, list(band_map), recursive=False,
+            acquisition_date=date):
+        band_map[raster.band] = raster.filepath
     return band_map
 
 
-def paths_mapping_single_scene(landsat_directory):
-    directories = [os.path.join(landsat_directory, f) for f in os.listdir(landsat_directory) if
-            os.path.isdir(os.path.join(landsat_directory, f))]
+def paths_mapping_single_scene(landsat_directory, satellite=8):
+    ''' {capture date: {band: raster}} for every Landsat scene in
+    landsat_directory, each with the climate rasters of its date and the
+    static rasters of the path/row. '''
+    catalog = raster_catalog(landsat_directory)
     climate_directory  = os.path.join(landsat_directory, 'climate_rasters')
-    other_rasters = [os.path.join(landsat_directory, f) for f in os.listdir(landsat_directory) if
-            not os.path.isdir(os.path.join(landsat_directory, f))]
+    static = catalog.query(landsat_directory, static_rasters(), recursive=False)
+    scenes = defaultdict(list)
+    for raster in catalog.query(landsat_directory, landsat_rasters()[satellite]):
+        if raster.scene_directory is not None:
+            scenes[raster.scene_directory].append(raster)
     date_dict = dict()
-    for d in directories:
-        if 'climate' in d:
-            continue
-        pm = _landsat_band_map(d)
-        date = _parse_landsat_capture_date(d)
-        cm = _climate_band_map(climate_directory, pm, date)
-        for raster in other_rasters:
-            for band in static_rasters():
-                if raster.endswith(band):
-                    pm[band] = raster
+    for scene in sorted(scenes):
+        pm = dict((band, None) for band in _band_names(satellite))
+        for raster in scenes[scene] + static:
+            pm[raster.band] = raster.filepath
+        date = scenes[scene][0].acquisition_date
+        _climate_band_map(climate_directory, pm, date)
         date_dict[date] = pm 
     return date_dict
 
 
 def paths_map_multiple_scenes(image_directory, satellite=8):
-    ''' Recursively get all rasters in image_directory
-    and its subdirectories, and adds them to band_map. '''
+    ''' All rasters in image_directory and its subdirectories, by band,
+    each band's sorted by time. Looked up in the raster catalog (see
+    raster_catalog.py), which is brought up to date first. '''
     band_map = defaultdict(list)
-    for band in landsat_rasters()[satellite]:
-        band_map[band] = []
-    for band in static_rasters():
-        band_map[band] = []
-    for band in climate_rasters():
-        band_map[band] = []
-
-    extensions = (".tif", ".TIF")
-    for dirpath, dirnames, filenames in os.walk(image_directory):
-        for f in filenames:
-            if any(ext in f for ext in extensions):
-                for band in band_map:
-                    if f.endswith(band):
-                        band_map[band].append(os.path.join(dirpath, f))
-
-    for band in band_map:
-        band_map[band] = sorted(band_map[band]) # ensures ordering within bands - sort by time.
-
+    catalog = raster_catalog(image_directory)
+    band_map.update(catalog.band_paths(image_directory, _band_names(satellite)))
     return band_map
 
 
 def mean_of_three(paths_map, image_stack, target_shape, satellite=8):
+    ''' Superseded by compositing.py, which masks clouds and takes any
+    number of scenes; kept as the baseline of benchmark_compositing.py. '''
 
     # iterate over paths_map
     # iterate over each raster in paths_map
@@ -226,6 +182,7 @@ def mean_of_three(paths_map, image_stack, target_shape, satellite=8):
 
 
 def median_of_three(paths_map, image_stack, target_shape, satellite=8):
+    ''' Superseded by compositing.py, like mean_of_three. '''
 
     j = 0
     out_image_stack = np.zeros((19, target_shape[1], target_shape[2]))
@@ -245,121 +202,97 @@ def median_of_three(paths_map, image_stack, target_shape, satellite=8):
     return out_image_stack
 
 
-def map_bands_to_indices(target_bands, satellite=8):
+def map_bands_to_indices(target_bands, image_directory, satellite=8):
+    ''' Indices of the rasters of target_bands in the stack of
+    image_directory (see stack_rasters for the order). '''
+    stack = _stack_order(paths_map_multiple_scenes(image_directory, satellite))
+    return [i for i, raster in enumerate(stack) if any(raster.endswith(band)
+        for band in target_bands)]
 
-    band_map = defaultdict(list)
-    for band in landsat_rasters()[satellite]:
-        band_map[band] = []
-    for band in static_rasters():
-        band_map[band] = []
-    for band in climate_rasters():
-        band_map[band] = []
-
-    image_directory = '/home/thomas/share/image_data/train/37_28_2013/'
-    extensions = (".tif", ".TIF")
-    for dirpath, dirnames, filenames in os.walk(image_directory):
-        for f in filenames:
-            if any(ext in f for ext in extensions):
-                for band in band_map:
-                    if f.endswith(band):
-                        band_map[band].append(os.path.join(dirpath, f))
-
-    for band in band_map:
-        band_map[band] = sorted(band_map[band]) # ensures ordering within bands - sort by time.
-
-    indices = []
-    i = 0
-    for feat in sorted(band_map.keys()): # ensures the stack is in the same order each time.
-        feature_rasters = band_map[feat]
-        for feature_raster in feature_rasters:
-            for band in target_bands:
-                if feature_raster.endswith(band):
-                    indices.append(i)
-                    i += 1
-    return indices
 
+def on_target_grid(src, target_geo):
+    ''' True if the open raster src already has the crs, transform and
+    shape of target_geo; only the headers are compared. '''
+    return (src.crs == target_geo['crs'] and src.transform == target_geo['transform']
+            and (src.height, src.width) == (target_geo['height'], target_geo['width']))
 
-def _maybe_warp(feature_raster, target_geo, target_shape):
-    arr, _ = load_raster(feature_raster)
-    if not arr.shape == target_shape:
-        arr = warp_single_image(feature_raster, target_geo)
-    return arr, feature_raster
 
+def aligned(src, target_geo):
+    ''' src itself if it's on the target_geo grid, otherwise a WarpedVRT that
+    reprojects it onto that grid as it's read. The caller closes the VRT. '''
+    if on_target_grid(src, target_geo):
+        return src
+    return WarpedVRT(src, crs=target_geo['crs'], transform=target_geo['transform'],
+            width=target_geo['width'], height=target_geo['height'], resampling=Resampling.nearest)
 
-def _load_rasters(paths_map, target_geo, target_shape):
-    single_band = False
-    num_rasters = 0
-    for key in paths_map:
-        if isinstance(paths_map[key], str):
-            single_band = True
-            num_rasters += 1
-        else:
-            num_rasters += len(paths_map[key])
-    j = 0
 
-    if not single_band:
-        feature_rasters = [feature_raster for feat in paths_map.keys() for feature_raster in
-        paths_map[feat]]
-    else:
-        feature_rasters = [paths_map[feat] for feat in paths_map.keys()]
-    tg = [target_geo]*len(feature_rasters)
-    ts = [target_shape]*len(feature_rasters)
-    if not single_band:
-        feature_rasters = [feature_raster for feat in paths_map.keys() for feature_raster in
-        paths_map[feat]]
-    else:
-        feature_rasters = [paths_map[feat] for feat in paths_map.keys()]
-    tg = [target_geo]*len(feature_rasters)
-    ts = [target_shape]*len(feature_rasters)
-    with Pool() as pool:
-        # Multiprocess the loading of rasters into memory.
-        # Speedup of ~40s.
-        out = pool.starmap(_maybe_warp, zip(feature_rasters, tg, ts))
-    rasters = {feature_raster: array for (array, feature_raster) in out}
-    return rasters, num_rasters
-
-
-def stack_rasters_multiprocess(paths_map, target_geo, target_shape):
-    first = True
-    stack = None
-    single_band = False
-    j = 0
-    rasters, num_rasters = _load_rasters(paths_map, target_geo, target_shape)
-    for feat in sorted(paths_map.keys()): # ensures the stack is in the same order each time.
-        # Ordering within bands is assured by sorting the list that
-        # each band corresponding to, as that's sorted by date.
-        feature_rasters = paths_map[feat] # maps bands to their location in filesystem.
-        if not single_band:
-            for feature_raster in feature_rasters:
-                arr = rasters[feature_raster]
-                if first:
-                    stack = np.zeros((num_rasters, target_shape[1], target_shape[2]), np.uint16)
-                    stack[j, :, :] = arr
-                    j += 1
-                    first = False
-                else:
-                    stack[j, :, :] = arr
-                    j += 1 
+@contextmanager
+def open_aligned(raster, target_geo):
+    with rasopen(raster, 'r') as src:
+        dataset = aligned(src, target_geo)
+        try:
+            yield dataset
+        finally:
+            if dataset is not src:
+                dataset.close()
+
+
+def read_aligned(raster, target_geo, window=None):
+    ''' Reads raster (count, height, width) on the target_geo grid, warping
+    only if the headers differ. The source is read exactly once. '''
+    with open_aligned(raster, target_geo) as src:
+        return src.read(window=window)
+
+
+def _stack_order(paths_map):
+    # the stack is in the same order each time: sorted band names, and
+    # within a band the (date sorted) list of rasters.
+    paths = []
+    for feat in sorted(paths_map.keys()):
+        if isinstance(paths_map[feat], str):
+            paths.append(paths_map[feat])
         else:
+            paths.extend(paths_map[feat])
+    return paths
 
-            arr, _ = _select_correct_band(rasters, feat)
 
-            # somehow select
-            if first:
-                stack = np.zeros((num_rasters, target_shape[1], target_shape[2]), np.uint16)
-                stack[j, :, :] = arr
-                j += 1
-                first = False
-            else:
-                stack[j, :, :] = arr
-                j += 1 
-    return stack
+def _read_into_stack(feature_raster, target_geo, stack_file, index, stack_shape):
+    # Runs in a worker: reads the band straight into its slot of the shared
+    # stack, so the parent only hears back the index.
+    stack = np.memmap(stack_file, dtype=np.uint16, mode='r+', shape=stack_shape)
+    with open_aligned(feature_raster, target_geo) as src:
+        if src.dtypes[0] == 'uint16':
+            src.read(1, out=stack[index])
+        else:
+            # GDAL would round on conversion; numpy truncates, as the stack
+            # always has.
+            stack[index] = src.read(1)
+    stack.flush()
+    del stack
+    return index
 
 
-def _select_correct_band(rasters, target_feat):
-    for path in rasters:
-        if path.endswith(target_feat):
-            return rasters[path], path
+def stack_rasters_multiprocess(paths_map, target_geo, target_shape, temporary_directory=None):
+    '''
+    (n_rasters, height, width) uint16 stack of every raster in paths_map,
+    aligned to target_geo. Worker processes write their band directly into
+    a memory mapped stack at a precomputed index; no band goes through
+    pickling or is copied again in the parent. The backing file is created
+    in temporary_directory (the system default if None) and unlinked once
+    the stack is mapped, so it goes away with the returned array.
+    '''
+    paths = _stack_order(paths_map)
+    stack_shape = (len(paths), target_shape[1], target_shape[2])
+    fd, stack_file = tempfile.mkstemp(suffix='.stack', dir=temporary_directory)
+    os.close(fd)
+    try:
+        stack = np.memmap(stack_file, dtype=np.uint16, mode='w+', shape=stack_shape)
+        with Pool() as pool:
+            pool.starmap(_read_into_stack, [(path, target_geo, stack_file, i, stack_shape)
+                for i, path in enumerate(paths)])
+    finally:
+        os.remove(stack_file)
+    return stack
 
 
 def stack_rasters(paths_map, target_geo, target_shape):
@@ -373,80 +306,253 @@ def stack_rasters(paths_map, target_geo, target_shape):
         # each band corresponding to, as that's sorting by date.
         feature_rasters = paths_map[feat] # maps bands to their location in filesystem.
         for feature_raster in feature_rasters:
-            with rasopen(feature_raster, mode='r') as src:
-                arr = src.read()
+            arr = read_aligned(feature_raster, target_geo)
             if first:
                 stack = np.zeros((num_rasters, target_shape[1], target_shape[2]), np.uint16)
-                stack[j, :, :] = arr
-                j += 1
                 first = False
-            else:
-                try:
-                    stack[j, :, :] = arr
-                    j += 1
-                except ValueError: 
-                    arr = warp_single_image(feature_raster, target_geo)
-                    stack[j, :, :] = arr
-                    j += 1
+            stack[j, :, :] = arr
+            j += 1
     return stack
 
 
+class SceneStack(object):
+    '''
+    Every raster of a paths_map (see paths_map_multiple_scenes) as one
+    (n_bands, height, width) stack on the target_geo grid, read lazily.
+    Band order is that of stack_rasters: sorted band names, and the (date
+    sorted) rasters within each band; a raster with several bands adds all
+    of them in turn, under their band descriptions if they have them (as
+    scene_cube.py's cubes do). Files are opened once and kept open, and read() takes
+    only the requested bands and window from each, warping through a
+    WarpedVRT where a raster isn't on the grid. A scene sized array is only
+    built when read() is called without a window.
+
+    target_geo: rasterio meta dict of the grid; the header of the first
+    raster if None.
+    dtype: of the arrays read; that of the first raster if None.
+
+    with SceneStack(paths_map, target_geo) as stack:
+        chunk = stack.read(window=(row_off, col_off, 608, 608)) # (n_bands, 608, 608)
+        blue = stack.read('B2.TIF') # every B2 of the scene, in full
+    '''
+
+    def __init__(self, paths_map, target_geo=None, dtype=None):
+        self.paths = []
+        self._path_names = []
+        for feat in sorted(paths_map.keys()):
+            paths = _stack_order({feat: paths_map[feat]})
+            self.paths.extend(paths)
+            self._path_names.extend([feat]*len(paths))
+        self.target_geo = target_geo
+        self.dtype = dtype
+        self.band_names = None
+        self._bands = None
+        self._stack = None
+        self._sources = None
+
+
+    def open(self):
+        if self._sources is not None:
+            return self
+        if self.target_geo is None:
+            with rasopen(self.paths[0], 'r') as src:
+                self.target_geo = src.meta.copy()
+        self._stack = ExitStack()
+        self._sources = []
+        self._bands = []
+        self.band_names = []
+        try:
+            for k, path in enumerate(self.paths):
+                src = self._stack.enter_context(open_aligned(path, self.target_geo))
+                self._sources.append(src)
+                for b in src.indexes:
+                    self._bands.append((k, b))
+                    self.band_names.append(src.descriptions[b - 1] or self._path_names[k])
+        except Exception:
+            self.close()
+            raise
+        if self.dtype is None:
+            self.dtype = self._sources[0].dtypes[0]
+        return self
+
+
+    def close(self):
+        if self._stack is not None:
+            self._stack.close()
+        self._stack = None
+        self._sources = None
+
+
+    def __enter__(self):
+        return self.open()
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    @property
+    def height(self):
+        return self.target_geo['height']
+
+
+    @property
+    def width(self):
+        return self.target_geo['width']
+
+
+    @property
+    def n_bands(self):
+        self._check_open()
+        return len(self._bands)
+
+
+    @property
+    def shape(self):
+        return (self.n_bands, self.height, self.width)
+
+
+    @property
+    def meta(self):
+        ''' target_geo as the meta of a raster holding the whole stack. '''
+        meta = self.target_geo.copy()
+        meta.update(count=self.n_bands, dtype=self.dtype)
+        return meta
+
+
+    def band_indices(self, band_name):
+        ''' Stack indices of every raster of band_name, in date order. '''
+        self._check_open()
+        return [k for k, name in enumerate(self.band_names) if name == band_name]
+
+
+    def window(self, row_off, col_off, height, width):
+        ''' The Window clipped to the scene, like a numpy slice. '''
+        row0 = min(max(int(row_off), 0), self.height)
+        col0 = min(max(int(col_off), 0), self.width)
+        row1 = min(max(int(row_off + height), row0), self.height)
+        col1 = min(max(int(col_off + width), col0), self.width)
+        return Window(col_off=col0, row_off=row0, width=col1 - col0, height=row1 - row0)
+
+
+    def read(self, bands=None, window=None):
+        '''
+        bands: a stack index, a sequence or slice of them, a band name
+        (every raster of that band) or None for all.
+        window: rasterio Window or (row_off, col_off, height, width),
+        clipped to the scene; None for the whole scene.
+        Returns (n, height, width), or (height, width) for a single index.
+        '''
+        self._check_open()
+        if window is None:
+            window = Window(col_off=0, row_off=0, width=self.width, height=self.height)
+        elif isinstance(window, Window):
+            window = self.window(window.row_off, window.col_off, window.height, window.width)
+        else:
+            window = self.window(*window)
+        if bands is None:
+            bands = slice(None)
+        elif isinstance(bands, str):
+            bands = self.band_indices(bands)
+        bands = np.arange(len(self._bands))[bands]
+        if np.ndim(bands) == 0:
+            return self._read(int(bands), window)
+        out = np.empty((len(bands), int(window.height), int(window.width)), dtype=self.dtype)
+        if out.size:
+            for k, b in enumerate(bands):
+                out[k] = self._read(b, window)
+        return out
+
+
+    def _read(self, band, window):
+        if not (window.height and window.width):
+            return np.empty((int(window.height), int(window.width)), dtype=self.dtype)
+        source, index = self._bands[band]
+        # cast by numpy rather than GDAL, which rounds, to match stack_rasters.
+        return self._sources[source].read(index, window=window).astype(self.dtype, copy=False)
+
+
+    def _check_open(self):
+        if self._sources is None:
+            raise ValueError("{} must be opened before reading".format(type(self).__name__))
+
+
+class WindowedRasterStack(SceneStack):
+    '''
+    SceneStack indexed like np.swapaxes(stack_rasters_multiprocess(paths_map, ...), 0, 2),
+    the (x, y, band) layout extraction and training use:
+
+    with WindowedRasterStack(paths_map, target_geo) as stack:
+        tile = stack[x:x+608, y:y+608, :] # (608, 608, n_bands)
+    '''
+
+    @property
+    def shape(self):
+        return (self.width, self.height, self.n_bands)
+
+
+    def __len__(self):
+        return self.width
+
+
+    def __getitem__(self, key):
+        # x and y must be slices with step 1, and are clipped to the scene
+        # like numpy slices.
+        if not isinstance(key, tuple):
+            key = (key,)
+        key = key + (slice(None),)*(3 - len(key))
+        x_slice, y_slice, band_key = key
+        x0, x1, _ = x_slice.indices(self.width)
+        y0, y1, _ = y_slice.indices(self.height)
+        window = self.window(y0, x0, y1 - y0, x1 - x0)
+        return np.swapaxes(self.read(band_key, window), 0, -1)
+
+
 def get_wrs2_features(path, row):
 
-    with fopen(WRS2) as src:
-        for feat in src:
-            poly = shape(feat['geometry'])
-            propr = feat['properties']
-            if propr['PATH'] == path and propr['ROW'] == row:
-                return [feat]
-    return None
+    feat = wrs2_index(WRS2).feature(path, row)
+    if feat is None:
+        return None
+    return [feat]
 
 
 def all_rasters(image_directory, satellite=8):
     ''' Recursively get all rasters in image_directory
     and its subdirectories, and adds them to band_map. '''
-    band_map = defaultdict(list)
-    for band in landsat_rasters()[satellite]:
-        band_map[band] = []
-    for band in static_rasters():
-        band_map[band] = []
-    for band in climate_rasters():
-        band_map[band] = []
-
-    extensions = (".tif", ".TIF")
-    for dirpath, dirnames, filenames in os.walk(image_directory):
-        for f in filenames:
-            if any(ext in f for ext in extensions):
-                for band in band_map:
-                    if f.endswith(band):
-                        band_map[band].append(os.path.join(dirpath, f))
-
-    for band in band_map:
-        band_map[band] = sorted(band_map[band]) # ensures ordering within bands - sort by time.
-
-    return band_map
+    return paths_map_multiple_scenes(image_directory, satellite)
 
 
 def _get_path_row_geometry(path, row):
-    shp = gpd.read_file(WRS2)
-    out = shp[shp['PATH'] == int(path)]
-    out = out[out['ROW'] == int(row)]
-    return out
+    index = wrs2_index(WRS2)
+    geometry = index.geometry(path, row)
+    rows = [] if geometry is None else [(int(path), int(row), geometry)]
+    return gpd.GeoDataFrame(rows, columns=['PATH', 'ROW', 'geometry'],
+            crs=index.meta['crs_wkt'])
 
 
 def clip_raster(evaluated, path, row, outfile=None):
+    ''' evaluated inside the WRS-2 footprint of path/row, nan outside it.
+    Only the window around the footprint is read. '''
 
     out = _get_path_row_geometry(path, row)
 
-    with rasopen(evaluated, 'r') as src:
-        out = out.to_crs(src.crs['init'])
+    with SceneStack({'evaluated': evaluated}) as stack:
+        out = out.to_crs(stack.target_geo['crs']['init'])
         features = get_features(out)
-        # if crop == true for mask, you have to update the metadata.
-        out_image, out_transform = mask(src, shapes=features, crop=True, nodata=np.nan)
-        meta = src.meta.copy()
+        window = window_from_bounds(*out.total_bounds, transform=stack.target_geo['transform'])
+        row_off, col_off = np.floor(window.row_off), np.floor(window.col_off)
+        window = stack.window(row_off, col_off, np.ceil(window.row_off + window.height) - row_off,
+                np.ceil(window.col_off + window.width) - col_off)
+        out_transform = window_transform(window, stack.target_geo['transform'])
+        out_image = stack.read(window=window).astype(np.float32)
+        meta = stack.meta
         count = out_image.shape[0]
+    outside = geometry_mask(features, out_shape=out_image.shape[1:], transform=out_transform)
+    out_image[:, outside] = np.nan
 
     meta.update({"driver": "GTiff",
+                 "dtype": np.float32,
+                 "nodata": np.nan,
                  "height": out_image.shape[1],
                  "width": out_image.shape[2],
                  "transform": out_transform})
@@ -7,8 +7,10 @@ import pdb
 import argparse
 
 from sys import stdout
+from contextlib import ExitStack
 from tensorflow.keras.models import load_model
 from glob import glob
+from rasterio import open as rasopen
 from rasterio.errors import RasterioIOError
 from matplotlib.pyplot import imshow, show, subplots
 from multiprocessing import Pool
@@ -18,31 +20,43 @@ from scipy.stats import mode
 from train_utils import softmax
 from runspec import irrigated_path_rows_mt
 from data_utils import (save_raster, stack_rasters, stack_rasters_multiprocess,
-        paths_map_multiple_scenes, load_raster, clip_raster, paths_mapping_single_scene,
-        mean_of_three)
+        paths_map_multiple_scenes, load_raster, clip_raster, paths_mapping_single_scene)
 from losses import *
-from extract_training_data import concatenate_fmasks
+from fmask_cache import load_combined_fmask, fmask_paths
+from compositing import composite_scene, COMPOSITE_METHODS
+from scene_cube import open_scene_cube
+from band_statistics import load_band_statistics
 
 _epsilon = tf.convert_to_tensor(K.epsilon(), tf.float32)
 
 masked_binary_xent = masked_binary_xent(pos_weight=1.0)
 custom_objects = {'masked_binary_xent':masked_binary_xent, 'binary_acc':binary_acc}
 
-def _evaluate_image_return_logits(model, raster, n_classes, n_overlaps=4):
+def _evaluate_image_return_logits(model, raster, n_classes, n_overlaps=4, band_statistics=None):
+    '''
+    raster: (x, y, bands), either a WindowedRasterStack, which reads each
+    chunk from the band files as it's evaluated, or an array, e.g.
+    np.swapaxes(image_stack, 0, 2). nan (a composite's pixels with no clear
+    scene) is evaluated as 0, the fill value of the stacks models are
+    trained on; such pixels are fmasked in the output anyway.
+    '''
     chunk_size = 608
     diff = 608
     stride = 608
     overlap_step = 10
-    raster = np.swapaxes(raster, 0, 2)
-    raster = np.expand_dims(raster, 0)
-    out = np.zeros((raster.shape[1], raster.shape[2], n_classes))
+    out = np.zeros((raster.shape[0], raster.shape[1], n_classes))
     for k in range(0, n_overlaps*overlap_step, overlap_step):
-        for i in range(k, raster.shape[1]-diff, stride):
-            for j in range(k, raster.shape[2]-diff, stride):
-                sub_raster = raster[:, i:i+chunk_size, j:j+chunk_size, :]
+        for i in range(k, raster.shape[0]-diff, stride):
+            for j in range(k, raster.shape[1]-diff, stride):
+                sub_raster = raster[i:i+chunk_size, j:j+chunk_size, :][np.newaxis]
+                if np.issubdtype(sub_raster.dtype, np.floating):
+                    sub_raster = np.nan_to_num(sub_raster, nan=0.0)
+                if band_statistics is not None:
+                    # the same standardization the generators apply in training.
+                    sub_raster = band_statistics.standardize(sub_raster)
                 preds = model.predict([sub_raster]) 
                 out[i:i+chunk_size, j:j+chunk_size, :] += preds[0]
-            stdout.write("K: {} of {}. Percent done: {:.2f}\r".format(k // overlap_step + 1, n_overlaps, i / raster.shape[1]))
+            stdout.write("K: {} of {}. Percent done: {:.2f}\r".format(k // overlap_step + 1, n_overlaps, i / raster.shape[0]))
     out = np.swapaxes(out, 0, 2)
     out = out.astype(np.float32)
     return out
@@ -52,19 +66,22 @@ def fmask_evaluated_image(evaluated_image, path, row, year, landsat_directory):
     image, meta = load_raster(evaluated_image)
     suffix = str(path) + '_' + str(row) + '_' + str(year)
     image_subdirectory = os.path.join(landsat_directory, suffix)
-    temp_mask = np.expand_dims(np.zeros_like(image)[0], 0)
-    meta.update(count=1)
-    masked_image = concatenate_fmasks(image_subdirectory, temp_mask, meta, nodata=1)
-    for i in range(image.shape[0]):
-        image[i, :, :][masked_image.mask[0]] = np.nan
+    obscured = load_combined_fmask(image_subdirectory, meta)
+    image[:, obscured] = np.nan
     meta.update(count=image.shape[0])
     meta.update(nodata=np.nan)
     return image, meta
     
 
 def evaluate_image_many_shot(image_directory, model_paths, n_classes=4,
-        n_overlaps=4, outfile=None, custom_objects=None, preprocessing_func=None):
-    ''' To recover from same padding, slide many different patches over the image. '''
+        n_overlaps=4, outfile=None, custom_objects=None, preprocessing_func=None,
+        band_statistics=None, percentile=50):
+    '''
+    To recover from same padding, slide many different patches over the image.
+    band_statistics: the band_stats.json the model was trained with, if any.
+    percentile: q of the 'percentile' composite.
+    '''
+    band_statistics = load_band_statistics(band_statistics)
     print(outfile)
     if not isinstance(model_paths, list):
         model_paths = [model_paths]
@@ -75,23 +92,30 @@ def evaluate_image_many_shot(image_directory, model_paths, n_classes=4,
         print('Images not downloaded for {}'.format(image_directory))
         return
     paths_mapping = paths_map_multiple_scenes(image_directory)
-    template, meta = load_raster(paths_mapping['B1.TIF'][0])
-    image_stack = stack_rasters_multiprocess(paths_mapping, meta, template.shape)
-    if preprocessing_func is not None:
-        image_stack = mean_of_three(image_stack, paths_mapping)
-    out_arr = np.zeros((n_classes, image_stack.shape[1], image_stack.shape[2]))
-    for i, model_path in enumerate(model_paths):
-        print('loading {}'.format(model_path))
-        model = load_model(model_path, custom_objects=custom_objects)
-        out_arr += _evaluate_image_return_logits(model, image_stack, n_classes=n_classes,
-            n_overlaps=n_overlaps)
-        del model
+    with rasopen(paths_mapping['B1.TIF'][0], 'r') as src:
+        # only the header; the bands are read chunk by chunk from the scene's cube.
+        meta = src.meta.copy()
+    with ExitStack() as stack:
+        if preprocessing_func is not None:
+            # preprocessing_func names a composite (see compositing.py), built
+            # chunk by chunk on a process pool and masked by the scenes' fmasks.
+            image_stack, _ = composite_scene(paths_mapping, meta, method=preprocessing_func,
+                    fmask_paths=fmask_paths(image_directory), percentile=percentile)
+            image_stack = np.swapaxes(image_stack, 0, 2)
+        else:
+            image_stack = stack.enter_context(open_scene_cube(image_directory, paths_mapping,
+                meta, dtype=np.uint16))
+        out_arr = np.zeros((n_classes, meta['height'], meta['width']))
+        for i, model_path in enumerate(model_paths):
+            print('loading {}'.format(model_path))
+            model = load_model(model_path, custom_objects=custom_objects)
+            out_arr += _evaluate_image_return_logits(model, image_stack, n_classes=n_classes,
+                n_overlaps=n_overlaps, band_statistics=band_statistics)
+            del model
 
     out_arr = softmax(out_arr)
-    temp_mask = np.zeros((1, out_arr.shape[1], out_arr.shape[2]))
-    fmasked_image = concatenate_fmasks(image_directory, temp_mask, meta, nodata=1)
-    for i in range(out_arr.shape[0]):
-        out_arr[i, :, :][fmasked_image.mask[0]] = np.nan
+    obscured = load_combined_fmask(image_directory, meta)
+    out_arr[:, obscured] = np.nan
 
     out_arr = out_arr.astype(np.float32)
     meta.update(dtype=np.float32)
@@ -113,9 +137,16 @@ if __name__ == '__main__':
     parser.add_argument('--use-gpu', action='store_true')
     parser.add_argument('--include-path-row', action='store_true')
     parser.add_argument('--evaluate-all-mt', action='store_true')
-    parser.add_argument('--preprocessing-func', type=str)
+    parser.add_argument('--preprocessing-func', type=str, choices=COMPOSITE_METHODS,
+            help='evaluate a composite of the scenes rather than the stack of every date')
+    parser.add_argument('--percentile', type=float, default=50,
+            help='q (0 to 100) of --preprocessing-func percentile')
     parser.add_argument('--year', type=int, default=2013)
+    parser.add_argument('--band-statistics', type=str,
+            help='band_stats.json of the training data, if the model was trained standardized')
     args = parser.parse_args()
+    if not 0 <= args.percentile <= 100:
+        parser.error('--percentile must be between 0 and 100')
     if args.out_dir is None:
         out_dir = os.path.dirname(os.path.splitext(args.model)[0])
         if not os.path.isdir(out_dir):
@@ -147,7 +178,10 @@ if __name__ == '__main__':
                      n_classes=args.n_classes,
                      n_overlaps=1,
                      outfile=outfile,
-                     custom_objects=custom_objects)
+                     custom_objects=custom_objects,
+                     preprocessing_func=args.preprocessing_func,
+                     band_statistics=args.band_statistics,
+                     percentile=args.percentile)
             image_directory = args.image_dir
     else:
         outfile = args.outfile
@@ -162,4 +196,6 @@ if __name__ == '__main__':
                  n_overlaps=1,
                  outfile=outfile,
                  custom_objects=custom_objects,
-                 preprocessing_func=args.preprocessing_func)
+                 preprocessing_func=args.preprocessing_func,
+                 band_statistics=args.band_statistics,
+                 percentile=args.percentile)
@@ -11,18 +11,34 @@ import matplotlib.pyplot as plt
 from glob import glob
 from random import sample, shuffle, choice
 from scipy.ndimage.morphology import distance_transform_edt
-from rasterio import open as rasopen, band
+from rasterio import open as rasopen
 from rasterio.errors import RasterioIOError
-from rasterio.warp import calculate_default_transform, reproject, Resampling
+from rasterio.enums import Resampling
+from rasterio.vrt import WarpedVRT
 from skimage import transform
-from sat_image.warped_vrt import warp_single_image
 from multiprocessing import Pool 
 from collections import defaultdict
+from contextlib import contextmanager
+from math import gcd
 
 from runspec import (landsat_rasters, climate_rasters, mask_rasters, assign_shapefile_class_code,
         assign_shapefile_year, cdl_crop_values, cdl_non_crop_values)
-from data_utils import load_raster, paths_map_multiple_scenes, stack_rasters, stack_rasters_multiprocess, download_from_pr, paths_mapping_single_scene, mean_of_three, median_of_three
+from data_utils import WindowedRasterStack, load_raster, paths_map_multiple_scenes, stack_rasters, stack_rasters_multiprocess, download_from_pr, paths_mapping_single_scene, mean_of_three, median_of_three
 from shapefile_utils import get_shapefile_path_row, mask_raster_to_shapefile, filter_shapefile_overlapping, mask_raster_to_features
+from tile_store import TileStoreWriter
+from label_encoding import class_map_from_labels
+from tile_manifest import TileManifestWriter, tile_record, tile_id, scene_manifest_records
+from tile_writers import PickleTileWriter, AsyncTileWriter
+from label_rasters import rasterize_class_labels, masked_class_labels
+from fmask_cache import load_combined_fmask
+from tile_coverage import CoverageIndex, class_code_from_counts
+from training_cubes import save_training_cube
+from band_statistics import BandStatistics, ScenePixels, load_scene_statistics, save_scene_statistics
+from scene_cube import open_scene_cube
+from raster_catalog import raster_catalog
+
+# metres; the grid every path/row is extracted on (see _template_raster).
+TEMPLATE_RESOLUTION = 30.0
 
 
 def distance_map(mask):
@@ -34,10 +50,10 @@ def distance_map(mask):
 
 class DataTile(object):
 
-    def __init__(self, data, one_hot, class_code, cdl_mask):
+    def __init__(self, data, class_map, class_code, cdl_mask):
         self.dict = {}
         self.dict['data'] = data
-        self.dict['one_hot'] = one_hot
+        self.dict['class_map'] = class_map
         self.dict['class_code'] = class_code
         self.dict['cdl'] = cdl_mask
 
@@ -48,227 +64,287 @@ class DataTile(object):
                 'class_{}_data/'.format(self.dict['class_code']))
         if not os.path.isdir(template):
             os.mkdir(template)
-        outfile = os.path.join(template, str(time.time()) + ".pkl")
-        if not os.path.isfile(outfile):
-            with open(outfile, 'wb') as f:
-                pickle.dump(self.dict, f, protocol=pickle.HIGHEST_PROTOCOL)
+        if self.dict.get('tile_id') is not None:
+            outfile = os.path.join(template, self.dict['tile_id'] + ".pkl")
         else:
-            raise ValueError()
-
-
-def _pickle_datatile(datatile, training_directory):
-        template = os.path.join(training_directory,
-                'class_{}_data/'.format(datatile.dict['class_code']))
-        if not os.path.isdir(template):
-            os.mkdir(template)
-        outfile = os.path.join(template, str(time.time()) + ".pkl")
+            outfile = os.path.join(template, str(time.time()) + ".pkl")
         if not os.path.isfile(outfile):
             with open(outfile, 'wb') as f:
-                pickle.dump(datatile.dict, f, protocol=pickle.HIGHEST_PROTOCOL)
+                pickle.dump(self.dict, f, protocol=pickle.HIGHEST_PROTOCOL)
         else:
-            pass
+            raise ValueError("{} already exists".format(outfile))
 
 
 def concatenate_fmasks(image_directory, class_mask, class_mask_geo, nodata=0, target_directory=None):
     ''' 
     ``Fmasks'' are masks of clouds and water. We don't want clouds/water in
-    the training set, so this function gets all the fmasks for a landsat
-    scene (contained in image_directory), and merges them into one raster. 
-    They may not be the same size, so warp_vrt is used to make them align. 
+    the training set, so this function masks class_mask (1, H, W) wherever
+    any fmask of the landsat scenes in image_directory flags a pixel.
+    The aligned union of the fmasks is built once per scene and cached
+    (see fmask_cache.py).
     '''
-    class_mask = class_mask.copy()
-    paths = []
-    for dirpath, dirnames, filenames in os.walk(image_directory):
-        for f in filenames:
-            for suffix in mask_rasters():
-                if f.endswith(suffix):
-                    pth = os.path.join(dirpath, f)
-                    paths.append(pth)
-    for fmask_file in paths:
-        fmask, _ = load_raster(fmask_file)
-        # clouds, water present where fmask == 1.
-        try:
-            class_mask = ma.masked_where(fmask == 1, class_mask)
-        except (ValueError, IndexError) as e:
-            fmask = warp_single_image(fmask_file, class_mask_geo)
-            class_mask = ma.masked_where(fmask == 1, class_mask)
-
-    return class_mask
+    obscured = load_combined_fmask(image_directory, class_mask_geo)
+    return ma.masked_where(np.broadcast_to(obscured, class_mask.shape), class_mask)
 
 
+@contextmanager
 def reproject_if_needed(source, target):
+    '''
+    Opens source in the CRS of the raster target. If the CRSs differ, source
+    is reprojected lazily through a WarpedVRT as it's read; the file on
+    disk is never rewritten.
+
+    with reproject_if_needed(source, target) as src:
+        arr = src.read()
+    '''
     with rasopen(target, 'r') as dst:
-        dst_crs = dst.meta['crs']
-
-    with rasopen(source) as src:
-        if src.meta['crs'] == dst_crs:
-            return source
-        transform, width, height = calculate_default_transform(
-            src.crs, dst_crs, src.width, src.height, *src.bounds)
-        kwargs = src.meta.copy()
-        kwargs.update({
-            'crs': dst_crs,
-            'transform': transform,
-            'width': width,
-            'height': height
-        })
-
-        with rasopen(source, 'w', **kwargs) as dst:
-            for i in range(1, src.count + 1):
-                reproject(
-                    source=band(src, i),
-                    destination=band(dst, i),
-                    src_transform=src.transform,
-                    src_crs=src.crs,
-                    dst_transform=transform,
-                    dst_crs=dst_crs,
-                    resampling=Resampling.nearest)
-    return source
+        dst_crs = dst.crs
+    with rasopen(source, 'r') as src:
+        if src.crs == dst_crs:
+            yield src
+        else:
+            with WarpedVRT(src, crs=dst_crs, resampling=Resampling.nearest) as vrt:
+                yield vrt
 
 
 def extract_training_data_over_path_row(test_train_shapefiles, path, row, year, image_directory,
         training_data_root_directory, n_classes, assign_shapefile_class_code, path_map_func=None,
-        preprocessing_func=None, tile_size=608):
+        preprocessing_func=None, tile_size=608, tile_format='pickle', class_priority=None,
+        label_cache_directory=None, stride=None, min_labelled_fraction=0.0):
+    '''
+    tile_format: one of 'pickle' (one file per tile), 'store'
+    (see tile_store.py), 'tfrecord' (see tfrecord_pipeline.py) or 'cube'
+    (the whole aligned path/row, for RandomWindowGenerator; see training_cubes.py).
+    class_priority: class codes, lowest priority first, deciding which class
+    wins where polygons overlap; by default the last shapefile wins.
+    label_cache_directory: where rasterized labels are cached (see
+    label_rasters.py). Defaults to <training_data_root_directory>/label_cache.
+    stride: pixels between tiles, tile_size by default; smaller strides
+    extract overlapping tiles.
+    min_labelled_fraction: skip tiles with fewer labelled pixels than this.
+    Returns False if the images of the path/row couldn't be read.
+    '''
 
     if path_map_func is None:
         path_map_func = paths_map_multiple_scenes
 
     if not isinstance(test_train_shapefiles, dict):
         raise ValueError("expected dict, got {}".format(type(test_train_shapefiles)))
+    if label_cache_directory is None:
+        label_cache_directory = os.path.join(training_data_root_directory, 'label_cache')
     
     path_row_year = str(path) + '_' + str(row) +  '_' + str(year)
     image_path = os.path.join(image_directory, path_row_year)
     if not os.path.isdir(image_path):
         download_from_pr(path, row, year, image_directory)
     image_path_maps = path_map_func(image_path)
-    mask_file = _random_tif_from_directory(image_path)
-    mask, mask_meta = load_raster(mask_file)
-    mask = np.zeros_like(mask).astype(np.int)
+    mask_file = _template_raster(image_path)
+    with rasopen(mask_file, 'r') as src:
+        mask_meta = src.meta.copy()
     cdl_path = os.path.join(image_path, 'cdl_mask.tif')
-    cdl_raster, cdl_meta = load_raster(cdl_path)
-    if mask.shape != cdl_raster.shape:
-        cdl_raster = warp_single_image(cdl_path, mask_meta)
-    cdl_raster = np.swapaxes(cdl_raster, 0, 2)
+    # The feature stack and CDL are never loaded whole: tiles are read
+    # window by window from the scene's cached cube once their labels are known.
+    cdl_raster = WindowedRasterStack({'cdl': cdl_path}, mask_meta)
+    image_stack = None
     try:
-        image_stack = stack_rasters_multiprocess(image_path_maps, target_geo=mask_meta, target_shape=mask.shape)
-        image_stack = np.swapaxes(image_stack, 0, 2)
+        image_stack = open_scene_cube(image_path, image_path_maps, mask_meta, dtype=np.uint16)
+        image_stack.open()
+        cdl_raster.open()
     except RasterioIOError as e:
         print("Redownload images for", path_row_year)
         print(e)
-        return
+        if image_stack is not None:
+            image_stack.close()
+        cdl_raster.close()
+        return False
+    with image_stack, cdl_raster:
+        _extract_from_stacks(test_train_shapefiles, path, row, year, image_path, mask_meta,
+                image_stack, cdl_raster, training_data_root_directory, n_classes,
+                assign_shapefile_class_code, tile_size, tile_format, class_priority,
+                label_cache_directory, stride, min_labelled_fraction)
+    return True
+
+
+def _extract_from_stacks(test_train_shapefiles, path, row, year, image_path, mask_meta,
+        image_stack, cdl_raster, training_data_root_directory, n_classes,
+        assign_shapefile_class_code, tile_size, tile_format, class_priority,
+        label_cache_directory, stride, min_labelled_fraction):
+    path_row_year = str(path) + '_' + str(row) +  '_' + str(year)
     for key, shapefiles in test_train_shapefiles.items():
         if key.lower() not in ('test', 'train'):
             raise ValueError("expected key to be one of case-insenstive {test, train},\
             got {}".format(key))
 
         training_data_directory = os.path.join(training_data_root_directory, key)
-        first = True
-        class_labels = None
         for f in shapefiles:
-            class_code = assign_shapefile_class_code(f)
-            print(f, class_code)
-            out, _ = mask_raster_to_shapefile(f, mask_file, return_binary=False)
-            if first:
-                class_labels = out
-                class_labels[~class_labels.mask] = class_code
-                first = False
-            else:
-                class_labels[~out.mask] = class_code
-        class_labels = concatenate_fmasks(image_path, class_labels, mask_meta) 
+            print(f, assign_shapefile_class_code(f))
+        class_map = rasterize_class_labels(shapefiles, assign_shapefile_class_code, mask_meta,
+                class_priority=class_priority, cache_directory=label_cache_directory)
+        class_labels = concatenate_fmasks(image_path, masked_class_labels(class_map), mask_meta)
         class_labels = np.swapaxes(class_labels, 0, 2)
         class_labels = np.squeeze(class_labels)
-        tiles_y, tiles_x = _target_indices_from_class_labels(class_labels, tile_size)
-        _save_training_data_from_indices(image_stack, class_labels, cdl_raster,
-                training_data_directory, n_classes, tiles_x, tiles_y, tile_size)
-
-
-def _target_indices_from_class_labels(class_labels, tile_size):
-    where = np.nonzero(~class_labels.mask)
-    max_y = np.max(where[0])
-    min_y = np.min(where[0])
-    max_x = np.max(where[1])
-    min_x = np.min(where[1])
-    max_y += (tile_size - ((max_y - min_y) % tile_size))
-    max_x += (tile_size - ((max_x - min_x) % tile_size))
-    tiles_y = range(min_y, max_y, tile_size)
-    tiles_x = range(min_x, max_x, tile_size)
-    return tiles_y, tiles_x
-
+        if tile_format == 'cube':
+            # cubes keep the whole scene, so this is the one place it's read in
+            # full, and only if the saved scene is older than the stacks' files.
+            save_training_cube(image_stack, class_labels, cdl_raster,
+                    training_data_root_directory, key, path_row_year,
+                    source_paths=image_stack.paths + cdl_raster.paths)
+            continue
+        windows = _select_windows(class_labels, n_classes, tile_size, stride,
+                min_labelled_fraction)
+        tile_writer = _tile_writer(tile_format, training_data_directory)
+        _save_training_data_from_windows(image_stack, class_labels, cdl_raster,
+                training_data_directory, n_classes, windows, tile_size,
+                tile_writer=tile_writer, path_row_year=(path, row, year))
+
+
+def _tile_writer(tile_format, training_data_directory):
+    if tile_format == 'pickle':
+        return PickleTileWriter(training_data_directory)
+    if tile_format == 'store':
+        return TileStoreWriter(training_data_directory)
+    if tile_format == 'tfrecord':
+        # imported here so that extraction doesn't need tensorflow otherwise.
+        from tfrecord_pipeline import TFRecordTileWriter
+        return TFRecordTileWriter(training_data_directory)
+    raise ValueError("tile_format must be one of pickle, store, tfrecord, cube, got {}".format(
+        tile_format))
+
+
+def _select_windows(class_labels, n_classes, tile_size, stride=None, min_labelled_fraction=0.0):
+    ''' (x, y, class_code) of every tile worth extracting, from a coverage
+    index over class_labels rather than scanning each candidate tile. '''
+    if stride is None:
+        stride = tile_size
+    # the coverage index needs windows aligned to its blocks.
+    block_size = gcd(gcd(tile_size, stride), 16)
+    index = CoverageIndex(class_labels, n_classes, block_size=block_size)
+    windows = index.select_windows(tile_size, stride, min_labelled_fraction)
+    return [(x, y, class_code_from_counts(counts)) for x, y, counts in windows]
+
+
+def _save_training_data_from_windows(image_stack, class_labels, cdl_raster,
+        training_data_directory, n_classes, windows, tile_size, tile_writer=None,
+        path_row_year=None):
+    '''
+    windows: (x, y, class_code) of the tiles to save (see _select_windows).
+    tile_writer: defaults to one pickle per tile. Tiles are handed to it on
+    background threads (see tile_writers.AsyncTileWriter) while the next
+    windows are read.
+    path_row_year: (path, row, year) of the scene. If given, every tile
+    gets a content addressed id (see tile_manifest.tile_id) and is listed in
+    the scene's manifest. Tiles whose id is already in that manifest aren't
+    read or written again, and pickles of tiles the scene no longer has
+    (e.g. after a shapefile edit) are removed. The band statistics of the
+    scene's tiles are saved alongside (see band_statistics.py), counting
+    each scene pixel once however much the tiles overlap.
+    '''
+    if tile_writer is None:
+        tile_writer = PickleTileWriter(training_data_directory)
+    if path_row_year is None:
+        with AsyncTileWriter(tile_writer) as writer:
+            for i, j, class_code in windows:
+                writer.add(_data_tile(image_stack, class_labels, cdl_raster, i, j, tile_size,
+                    class_code).dict)
+        return
 
-def _assign_class_code_to_tile(class_label_tile):
-    if np.any(class_label_tile == 3):
-        return 3
-    if np.all(class_label_tile != 0):
-        unique, unique_count = np.unique(class_label_tile, return_counts=True)
-        unique = unique[:-1] # assume np.ma.masked is last.
-        unique_count = unique_count[:-1]
-        return unique[np.argmax(unique_count)]
-    # if a tile has any irrigated pixels, return 0.
-    return 0
+    scene = '_'.join(str(p) for p in path_row_year)
+    previous = {r['tile_id']: r for r in scene_manifest_records(training_data_directory, scene)
+            if r.get('tile_id') is not None}
+    # the stack is one cached cube, so its bands are told apart by the names
+    # scene_cube writes into their descriptions, not by file.
+    bands = list(image_stack.band_names)
+    crop = list(cdl_crop_values().keys())
+    tile_ids = [tile_id(*path_row_year, window=(i, j, tile_size),
+        class_map=class_map_from_labels(class_labels[i:i+tile_size, j:j+tile_size]), bands=bands)
+        for i, j, _ in windows]
+    # the statistics only need recomputing if the scene's tiles changed.
+    stats = load_scene_statistics(training_data_directory, scene, tile_ids)
+    update_stats = stats is None
+    if update_stats:
+        stats = BandStatistics(image_stack.n_bands)
+        pixels = ScenePixels(class_labels.shape[:2])
+    kept = set()
+    n_written = 0
+    # if extraction fails the scene keeps its previous manifest.
+    with TileManifestWriter(training_data_directory, scene, overwrite=True) as manifest, \
+            AsyncTileWriter(tile_writer, manifest) as writer:
+        for (i, j, class_code), tid in zip(windows, tile_ids):
+            if tid in previous and _tile_exists(tile_writer, previous[tid]['tile']):
+                kept.add(tid)
+                manifest.append(previous[tid])
+                if update_stats:
+                    stats.update(pixels.new_pixels((i, j),
+                        image_stack[i:i+tile_size, j:j+tile_size, :]))
+                continue
+            dt = _data_tile(image_stack, class_labels, cdl_raster, i, j, tile_size, class_code)
+            dt.dict['tile_id'] = tid
+            if update_stats:
+                stats.update(pixels.new_pixels((i, j), dt.dict['data']))
+            # the tile reference is filled in once the tile is written.
+            record = tile_record(dt.dict, None, n_classes, *path_row_year,
+                    window=(i, j, tile_size), crop_values=crop)
+            writer.add(dt.dict, record)
+            n_written += 1
+    if update_stats:
+        save_scene_statistics(training_data_directory, scene, stats, tile_ids)
+    stale = [r for tid, r in previous.items() if tid not in kept]
+    if hasattr(tile_writer, 'remove'):
+        for record in stale:
+            tile_writer.remove(record['tile'])
+    print('{}: wrote {} tiles, skipped {} unchanged, dropped {} stale'.format(scene, n_written,
+        len(kept), len(stale)))
+
+
+def _data_tile(image_stack, class_labels, cdl_raster, i, j, tile_size, class_code):
+    sub_class_map = class_map_from_labels(class_labels[i:i+tile_size, j:j+tile_size])
+    sub_cdl = cdl_raster[i:i+tile_size, j:j+tile_size, :]
+    sub_image_stack = image_stack[i:i+tile_size, j:j+tile_size, :]
+    return DataTile(sub_image_stack, sub_class_map, class_code, sub_cdl)
+
+
+def _tile_exists(tile_writer, tile_ref):
+    # shard writers can't check a single tile; trust their manifest.
+    if hasattr(tile_writer, 'exists'):
+        return tile_writer.exists(tile_ref)
+    return True
 
 
-def _save_training_data_from_indices(image_stack, class_labels, cdl_raster,
-        training_data_directory, n_classes, indices_y, indices_x, tile_size):
-    out = []
-    for i in indices_x:
-        for j in indices_y:
-            class_label_tile = class_labels[i:i+tile_size, j:j+tile_size]
-            shape = class_label_tile.shape
-            if np.all(class_label_tile.mask):
-                continue
-            if (shape[0], shape[1]) != (tile_size, tile_size):
-                continue
-            class_code = _assign_class_code_to_tile(class_label_tile)
-            sub_one_hot = _one_hot_from_labels(class_label_tile, n_classes)
-            sub_cdl = cdl_raster[i:i+tile_size, j:j+tile_size, :]
-            sub_image_stack = image_stack[i:i+tile_size, j:j+tile_size, :]
-            sub_image_stack = image_stack[i:i+tile_size, j:j+tile_size, :]
-            dt = DataTile(sub_image_stack, sub_one_hot, class_code, sub_cdl)
-            out.append(dt)
-            if len(out) > 50:
-                with Pool() as pool:
-                    td = [training_data_directory]*len(out)
-                    pool.starmap(_pickle_datatile, zip(out, td))
-                out = []
-    if len(out):
-        with Pool() as pool:
-            td = [training_data_directory]*len(out)
-            pool.starmap(_pickle_datatile, zip(out, td))
-            out = []
-
-
-def _random_tif_from_directory(image_directory):
-
-    bleh = os.listdir(image_directory)
-    for d in bleh:
-        if os.path.isdir(os.path.join(image_directory, d)):
-            tiffs = glob(os.path.join(os.path.join(image_directory, d), "*.TIF"))
-            tiffs = [tif for tif in tiffs if 'BQA' not in tif]
-            break
-    shuffle(tiffs)
-    return tiffs[0]
+def _template_raster(image_directory, resolution=TEMPLATE_RESOLUTION):
+    '''
+    The raster whose grid the labels, fmasks and feature stack of a
+    path/row are aligned to: the first (sorted) band of the first (sorted)
+    Landsat scene under image_directory with resolution metre pixels, so
+    that the grid keyed caches (labels, fmasks, scene cube) and tile ids
+    are the same from one run to the next. The panchromatic band is
+    only taken if no other band has that resolution.
+    '''
+    landsat_bands = set()
+    for bands in landsat_rasters().values():
+        landsat_bands.update(bands)
+    rasters = [r for r in raster_catalog(image_directory).query(image_directory, landsat_bands)
+            if r.scene_directory is not None]
+    if not len(rasters):
+        raise ValueError("no Landsat scenes in {}".format(image_directory))
+    first_scene = min(r.scene_directory for r in rasters)
+    candidates = sorted(r.filepath for r in rasters if r.scene_directory == first_scene)
+    for candidate in candidates:
+        with rasopen(candidate, 'r') as src:
+            if np.allclose(src.res, resolution):
+                return candidate
+    return candidates[0]
 
 
 def min_data_tiles_to_cover_labels(shapefiles, path, row, year, image_directory, tile_size=608):
     path_row_year = "_".join([str(path), str(row), str(year)])
     image_directory = os.path.join(image_directory, path_row_year)
-    mask_file = _random_tif_from_directory(image_directory)
-    mask, mask_meta = load_raster(mask_file)
-    mask = np.zeros_like(mask).astype(np.int)
-    first = True
-    class_labels = None
+    mask_file = _template_raster(image_directory)
+    with rasopen(mask_file, 'r') as src:
+        mask_meta = src.meta.copy()
     if not isinstance(shapefiles, list):
         shapefiles = [shapefiles]
-    for f in shapefiles:
-        class_code = assign_shapefile_class_code(f)
-        out, _ = mask_raster_to_shapefile(f, mask_file, return_binary=False)
-        if first:
-            class_labels = out
-            class_labels[~class_labels.mask] = class_code
-            first = False
-        else:
-            class_labels[~out.mask] = class_code
-    class_labels = concatenate_fmasks(image_directory, class_labels, mask_meta) 
+    class_map = rasterize_class_labels(shapefiles, assign_shapefile_class_code, mask_meta)
+    class_labels = concatenate_fmasks(image_directory, masked_class_labels(class_map), mask_meta)
     where = np.nonzero(~class_labels.mask[0])
     max_y = np.max(where[0])
     min_y = np.min(where[0])
@@ -311,7 +387,7 @@ def _one_hot_from_labels(labels, n_classes):
         #     border_labels = make_border_labels(one_hot[:, :, 1], border_width=1)
         #     border_labels = border_labels.astype(np.uint8)
         #     one_hot[:, :, n_classes-1][border_labels == 1] = 1
-    return one_hot.astype(np.int)
+    return one_hot.astype(np.int64)
 
 
 def _weights_from_one_hot(one_hot, n_classes):
@@ -358,29 +434,7 @@ def make_border_labels(mask, border_width):
 
 
 if __name__ == '__main__':
-    
-    image_directory = '/home/thomas/share/image_data/'
-    shapefiles = glob('shapefile_data/test/*.shp') + glob('shapefile_data/train/*.shp')
-    training_root_directory = '/home/thomas/share/multiclass_with_separate_fallow_directory_and_cdl/'
-    if not os.path.isdir(training_root_directory):
-        os.makedirs(training_root_directory)
-
-    n_classes = 4
-    done = set()
-
-    for f in shapefiles:
-        if f in done:
-            continue
-        test_shapefiles = all_matching_shapefiles(f, 'shapefile_data/test/', assign_shapefile_year)
-        train_shapefiles = all_matching_shapefiles(f, 'shapefile_data/train/', assign_shapefile_year)
-        for e in test_shapefiles + train_shapefiles:
-            done.add(e)
-        bs = os.path.splitext(os.path.basename(f))[0]
-        _, path, row = bs[-7:].split("_")
-        year = assign_shapefile_year(f)
-        print("extracting data for", path, row, year)
-        paths_map_func = paths_map_multiple_scenes
-        test_train_shapefiles = {'test':test_shapefiles, 'train':train_shapefiles}
-        extract_training_data_over_path_row(test_train_shapefiles, path, row, year, image_directory,
-                training_root_directory, n_classes, assign_shapefile_class_code, path_map_func=paths_map_func)
-
+    # the scheduler runs path/rows in parallel and resumes interrupted runs;
+    # see extraction_scheduler.py for its options.
+    from extraction_scheduler import main
+    main()
@@ -0,0 +1,231 @@
+import os
+import json
+import time
+import hashlib
+import argparse
+import traceback
+
+from glob import glob
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import cpu_count
+
+from runspec import assign_shapefile_class_code, assign_shapefile_year
+from extract_training_data import extract_training_data_over_path_row, all_matching_shapefiles
+from band_statistics import band_statistics_from_scenes, has_scene_statistics, STATS_FILE
+from label_rasters import SHAPEFILE_PARTS
+
+JOURNAL_FILE = 'extraction_journal.jsonl'
+SPLITS = ('test', 'train')
+# formats whose writers append shards to one index per split directory;
+# they allocate shards and rewrite the index unlocked, so only one process
+# may write them.
+SHARDED_FORMATS = ('store', 'tfrecord')
+
+
+def extraction_jobs(shapefile_root, assign_shapefile_year=assign_shapefile_year):
+    '''
+    All (path, row, year, split) jobs for the shapefiles in
+    <shapefile_root>/test and <shapefile_root>/train, grouped by scene:
+    an OrderedDict of (path, row, year) -> {split: shapefiles}.
+    Splits without shapefiles are left out.
+    '''
+    scenes = OrderedDict()
+    for split in SPLITS:
+        for f in sorted(glob(os.path.join(shapefile_root, split, '*.shp'))):
+            bs = os.path.splitext(os.path.basename(f))[0]
+            _, path, row = bs[-7:].split("_")
+            key = (int(path), int(row), int(assign_shapefile_year(f)))
+            if split in scenes.get(key, {}):
+                continue
+            scenes.setdefault(key, {})[split] = all_matching_shapefiles(f,
+                    os.path.join(shapefile_root, split), assign_shapefile_year)
+    return scenes
+
+
+def job_fingerprint(shapefiles, image_directory, n_classes, tile_format):
+    '''
+    Hash of what a job's tiles are made from: its shapefiles (every part's
+    path, size and mtime, and the class code each is assigned), the image
+    directory and the extraction parameters. A finished job whose
+    fingerprint has changed since is extracted again.
+    '''
+    sha = hashlib.sha1()
+    for shapefile in sorted(shapefiles):
+        base = os.path.splitext(os.path.abspath(shapefile))[0]
+        parts = []
+        for ext in SHAPEFILE_PARTS:
+            if os.path.isfile(base + ext):
+                st = os.stat(base + ext)
+                parts.append([ext, st.st_size, st.st_mtime])
+        sha.update(json.dumps([base, parts, assign_shapefile_class_code(shapefile)]).encode())
+    sha.update(json.dumps([os.path.abspath(image_directory), int(n_classes),
+        tile_format]).encode())
+    return sha.hexdigest()
+
+
+class ExtractionJournal(object):
+    '''
+    Append-only JSONL record of finished extraction jobs, so an interrupted
+    run can resume where it stopped. Each line is written with one
+    O_APPEND write and fsynced, so worker processes can share the file.
+    A job that was running when the run died has no line and is redone.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+
+
+    def done(self):
+        ''' job -> fingerprint (see job_fingerprint) of the last run that
+        finished it; None for entries written without one. '''
+        done = {}
+        if not os.path.isfile(self.path):
+            return done
+        with open(self.path, 'r') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue # a line cut short by a crash.
+                if entry['status'] == 'done':
+                    done[tuple(entry['job'])] = entry.get('fingerprint')
+        return done
+
+
+    def append(self, job, status, **info):
+        entry = dict(job=list(job), status=status, time=time.time(), **info)
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, (json.dumps(entry) + '\n').encode())
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+def _extract_scene(scene, splits, fingerprints, journal_path, image_directory,
+        training_root_directory, n_classes, tile_format):
+    # One process per scene, so the splits of a path/row never race on
+    # downloading its images or writing its shared cube.
+    journal = ExtractionJournal(journal_path)
+    path, row, year = scene
+    results = []
+    for split, shapefiles in splits.items():
+        job = (path, row, year, split)
+        start = time.time()
+        try:
+            ok = extract_training_data_over_path_row({split: shapefiles}, path, row, year,
+                    image_directory, training_root_directory, n_classes,
+                    assign_shapefile_class_code, tile_format=tile_format)
+        except Exception:
+            journal.append(job, 'failed', fingerprint=fingerprints[split],
+                    error=traceback.format_exc())
+            results.append((job, 'failed'))
+            continue
+        status = 'done' if ok is not False else 'failed'
+        journal.append(job, status, fingerprint=fingerprints[split],
+                seconds=time.time() - start)
+        results.append((job, status))
+    return results
+
+
+def n_workers_for_budget(memory_budget_bytes, job_memory_bytes, max_workers=None):
+    if max_workers is None:
+        max_workers = cpu_count()
+    return max(1, min(max_workers, int(memory_budget_bytes // job_memory_bytes)))
+
+
+def run_extraction(scenes, image_directory, training_root_directory, n_classes,
+        memory_budget_bytes, job_memory_bytes, tile_format='pickle', max_workers=None,
+        rerun=False):
+    '''
+    Runs every job of scenes (see extraction_jobs) that the journal in
+    training_root_directory hasn't recorded as done with the job's current
+    fingerprint (see job_fingerprint), on as many processes as
+    memory_budget_bytes allows at job_memory_bytes each. The sharded
+    tile formats (see SHARDED_FORMATS) run on a single process.
+    rerun: run every job, whatever the journal says.
+    Returns the jobs that failed.
+    '''
+    if tile_format in SHARDED_FORMATS:
+        if max_workers is not None and max_workers > 1:
+            raise ValueError("tile_format {} can't be written by {} processes at once; use "
+                    "max_workers=1 or tile_format pickle".format(tile_format, max_workers))
+        max_workers = 1
+    if not os.path.isdir(training_root_directory):
+        os.makedirs(training_root_directory)
+    journal_path = os.path.join(training_root_directory, JOURNAL_FILE)
+    done = {} if rerun else ExtractionJournal(journal_path).done()
+    pending = OrderedDict()
+    n_done = 0
+    for scene, splits in scenes.items():
+        todo, fingerprints = {}, {}
+        for split, shapefiles in splits.items():
+            fingerprint = job_fingerprint(shapefiles, image_directory, n_classes, tile_format)
+            if done.get(scene + (split,)) == fingerprint:
+                n_done += 1
+                continue
+            todo[split] = shapefiles
+            fingerprints[split] = fingerprint
+        if todo:
+            pending[scene] = (todo, fingerprints)
+    n_jobs = sum(len(todo) for todo, _ in pending.values())
+    n_workers = n_workers_for_budget(memory_budget_bytes, job_memory_bytes, max_workers)
+    print("{} jobs done, {} to run on {} processes".format(n_done, n_jobs, n_workers))
+    failed = []
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = [executor.submit(_extract_scene, scene, todo, fingerprints, journal_path,
+            image_directory, training_root_directory, n_classes, tile_format)
+            for scene, (todo, fingerprints) in pending.items()]
+        for future in as_completed(futures):
+            for job, status in future.result():
+                print(status, job)
+                if status != 'done':
+                    failed.append(job)
+    return failed
+
+
+def main():
+    ap = argparse.ArgumentParser(description='extract training data for every path/row/year '
+            'with shapefiles, resuming from the journal in the training directory; jobs whose '
+            'shapefiles or parameters changed since they were done are extracted again')
+    ap.add_argument('--shapefile-root', type=str, default='shapefile_data/',
+            help='directory with test/ and train/ shapefiles')
+    ap.add_argument('--image-directory', type=str, default='/home/thomas/share/image_data/')
+    ap.add_argument('--training-root', type=str,
+            default='/home/thomas/share/multiclass_with_separate_fallow_directory_and_cdl/')
+    ap.add_argument('--n-classes', type=int, default=4)
+    ap.add_argument('--tile-format', type=str, default='pickle',
+            choices=['pickle', 'store', 'tfrecord', 'cube'])
+    ap.add_argument('--memory-gb', type=float, default=32,
+            help='memory available to all extraction processes together')
+    ap.add_argument('--job-memory-gb', type=float, default=4,
+            help='peak memory of one path/row extraction')
+    ap.add_argument('--max-workers', type=int,
+            help='store and tfrecord are always extracted on one process')
+    ap.add_argument('--rerun', action='store_true',
+            help='extract every job again, ignoring the journal')
+    args = ap.parse_args()
+    if args.tile_format in SHARDED_FORMATS and args.max_workers is not None \
+            and args.max_workers > 1:
+        ap.error('--tile-format {} needs --max-workers 1'.format(args.tile_format))
+
+    scenes = extraction_jobs(args.shapefile_root)
+    failed = run_extraction(scenes, args.image_directory, args.training_root, args.n_classes,
+            int(args.memory_gb * 1e9), int(args.job_memory_gb * 1e9),
+            tile_format=args.tile_format, max_workers=args.max_workers, rerun=args.rerun)
+    if failed:
+        print("failed jobs (rerun to retry):", failed)
+    # merged from the statistics extraction saved per scene; no extra pass.
+    train_directory = os.path.join(args.training_root, 'train')
+    if args.tile_format != 'cube' and has_scene_statistics(train_directory):
+        stats = band_statistics_from_scenes(train_directory)
+        stats.save(os.path.join(train_directory, STATS_FILE))
+        print("band statistics of {} pixels saved to {}".format(stats.count, train_directory))
+
+
+if __name__ == '__main__':
+    main()
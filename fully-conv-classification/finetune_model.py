@@ -10,10 +10,12 @@ from tensorflow.keras.callbacks import (TensorBoard, ModelCheckpoint, LearningRa
 from functools import partial
 from tensorflow.keras.models import load_model 
 from glob import glob
+from sys import exit
 
 
 from models import unet
 from data_generators import DataGenerator
+from tfrecord_pipeline import make_dataset
 from train_utils import lr_schedule
 from losses import (binary_focal_loss, binary_acc, masked_binary_xent, masked_categorical_xent,
         multiclass_acc)
@@ -42,6 +44,8 @@ if __name__ == '__main__':
     ap = ArgumentParser()
     ap.add_argument("--model-to-finetune", type=str, required=True)
     ap.add_argument("--loss-func", type=str)
+    ap.add_argument("--backend", type=str, default='sequence', choices=['sequence', 'tfdata'],
+            help='sequence: DataGenerator over pickles/tile store, tfdata: TFRecord shards')
     args = ap.parse_args()
 
     input_shape = (None, None, 51)
@@ -82,6 +86,18 @@ if __name__ == '__main__':
     loss_func = masked_categorical_xent
     batch_size = 8
     model_frozen.compile(opt, loss=loss_func, metrics=[multiclass_acc])
+    if args.backend == 'tfdata':
+        train_data = make_dataset(train_dir, batch_size, n_classes, training=True,
+                apply_irrigated_weights=True)
+        test_data = make_dataset(test_dir, batch_size, n_classes, training=False)
+        model_frozen.fit(train_data,
+                epochs=40,
+                steps_per_epoch=200,
+                validation_data=test_data,
+                callbacks=[lr_scheduler, checkpoint],
+                verbose=1)
+        exit(0)
+
     train_generator = DataGenerator(train_dir, batch_size, target_classes=None, 
             n_classes=n_classes, training=True, apply_irrigated_weights=True,
             steps_per_epoch=200)
@@ -0,0 +1,83 @@
+import os
+import json
+import hashlib
+import numpy as np
+
+from runspec import mask_rasters
+from data_utils import WindowedRasterStack
+from raster_catalog import raster_catalog
+
+ROWS_PER_BLOCK = 1024
+
+
+def fmask_paths(image_directory):
+    ''' Every fmask under image_directory, sorted, from the raster catalog. '''
+    catalog = raster_catalog(image_directory)
+    return [r.filepath for r in catalog.query(image_directory, mask_rasters())]
+
+
+def load_combined_fmask(image_directory, target_geo, window=None):
+    '''
+    Union of every fmask (clouds, water: fmask == 1) under image_directory,
+    aligned to target_geo (a rasterio meta dict), as a boolean (H, W) array
+    that is True where any scene is obscured.
+
+    The union is built once and cached next to the scenes as a bit packed
+    .npy (one bit per pixel) with a JSON sidecar listing the fmasks and
+    their mtimes; it is rebuilt when that list changes.
+    window: (row_off, col_off, height, width); only those rows of the
+    cache are read and unpacked.
+    '''
+    packed = _cached_packed_fmask(image_directory, target_geo)
+    width = target_geo['width']
+    if window is None:
+        return np.unpackbits(packed, axis=1)[:, :width].astype(bool)
+    row_off, col_off, height, win_width = window
+    first_byte = col_off // 8
+    last_byte = (col_off + win_width + 7) // 8
+    rows = packed[row_off:row_off + height, first_byte:last_byte]
+    bits = np.unpackbits(rows, axis=1)
+    start = col_off - first_byte*8
+    return bits[:, start:start + win_width].astype(bool)
+
+
+def _cached_packed_fmask(image_directory, target_geo):
+    paths = fmask_paths(image_directory)
+    sources = {os.path.relpath(p, image_directory): os.path.getmtime(p) for p in paths}
+    cache_file, sidecar = _cache_files(image_directory, target_geo)
+    if os.path.isfile(cache_file) and os.path.isfile(sidecar):
+        with open(sidecar, 'r') as f:
+            if json.load(f).get('sources') == sources:
+                return np.load(cache_file, mmap_mode='r')
+
+    packed = _packed_union(paths, target_geo)
+    tmp = cache_file + '.tmp'
+    with open(tmp, 'wb') as f:
+        np.save(f, packed)
+    os.replace(tmp, cache_file)
+    tmp = sidecar + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump({'sources': sources, 'shape': [target_geo['height'], target_geo['width']]}, f)
+    os.replace(tmp, sidecar)
+    return packed
+
+
+def _packed_union(paths, target_geo):
+    # Block by block over rows, so the full uint8 fmasks are never in memory.
+    height, width = target_geo['height'], target_geo['width']
+    packed = np.zeros((height, (width + 7) // 8), dtype=np.uint8)
+    if not len(paths):
+        return packed
+    with WindowedRasterStack({'fmask': paths}, target_geo) as fmasks:
+        for y in range(0, height, ROWS_PER_BLOCK):
+            block = fmasks[:, y:y + ROWS_PER_BLOCK, :] # (width, rows, n_fmasks)
+            union = np.any(block == 1, axis=2).T
+            packed[y:y + union.shape[0]] = np.packbits(union, axis=1)
+    return packed
+
+
+def _cache_files(image_directory, target_geo):
+    grid = hashlib.sha1(str((str(target_geo['crs']), tuple(target_geo['transform']),
+        target_geo['height'], target_geo['width'])).encode()).hexdigest()[:12]
+    base = os.path.join(image_directory, 'combined_fmask_{}'.format(grid))
+    return base + '.npy', base + '.json'
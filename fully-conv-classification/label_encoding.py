@@ -0,0 +1,39 @@
+import numpy as np
+
+# Tiles store labels as one uint8 class index per pixel. Pixels
+# without a label (outside the shapefiles, clouds, balanced out)
+# get LABEL_NODATA, which is never a valid class code.
+LABEL_NODATA = 255
+
+
+def class_map_from_labels(class_labels):
+    ''' class_labels: masked array of class codes, masked where there's no data. '''
+    return np.ma.filled(class_labels, LABEL_NODATA).astype(np.uint8)
+
+
+def class_map_from_one_hot(one_hot):
+    ''' (..., C) one hot -> (...) uint8 class indices, LABEL_NODATA where
+    the one hot vector is all zeros. '''
+    class_map = np.argmax(one_hot, axis=-1).astype(np.uint8)
+    class_map[~np.any(one_hot, axis=-1)] = LABEL_NODATA
+    return class_map
+
+
+def one_hot_from_class_map(class_map, n_classes, dtype=np.float32):
+    '''
+    Expands a (...) uint8 class map (a single tile or a whole batch) into
+    a (..., n_classes) one hot array with a single table lookup. Nodata
+    pixels (and any code >= n_classes) are all zeros along the last axis,
+    which is what masked_categorical_xent expects.
+    '''
+    table = np.zeros((256, n_classes), dtype=dtype)
+    table[np.arange(n_classes), np.arange(n_classes)] = 1
+    return table[class_map]
+
+
+def tile_class_map(tile):
+    ''' Class map of a DataTile dict. Tiles extracted before class maps
+    were stored only have a one hot array. '''
+    if 'class_map' in tile:
+        return tile['class_map']
+    return class_map_from_one_hot(tile['one_hot'])
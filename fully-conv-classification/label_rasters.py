@@ -0,0 +1,88 @@
+import os
+import hashlib
+import numpy as np
+import geopandas as gpd
+
+from pyproj import CRS
+from rasterio.features import rasterize
+
+from label_encoding import LABEL_NODATA
+
+SHAPEFILE_PARTS = ('.shp', '.shx', '.dbf', '.prj', '.cpg')
+
+
+def rasterize_class_labels(shapefiles, assign_shapefile_class_code, target_geo,
+        class_priority=None, cache_directory=None):
+    '''
+    Burns every shapefile into one uint8 class map on the target_geo grid
+    (a rasterio meta dict: crs, transform, height, width) with a single
+    rasterize call. Unlabelled pixels are LABEL_NODATA.
+
+    Where polygons overlap, the later shapefile wins, as when the masked
+    label arrays were merged one after the other. class_priority (class
+    codes, lowest priority first) instead lets higher priority classes win
+    regardless of shapefile order.
+
+    If cache_directory is given the class map is saved there, keyed by
+    the content of the shapefiles, their class codes, the priority and the
+    grid, and later calls with the same inputs load it instead.
+    '''
+    codes = [assign_shapefile_class_code(f) for f in shapefiles]
+    cache_file = None
+    if cache_directory is not None:
+        key = _cache_key(shapefiles, codes, class_priority, target_geo)
+        cache_file = os.path.join(cache_directory, key + '.npy')
+        if os.path.isfile(cache_file):
+            return np.load(cache_file)
+
+    order = list(range(len(shapefiles)))
+    if class_priority is not None:
+        rank = {c: i for i, c in enumerate(class_priority)}
+        # stable, so shapefile order still breaks ties within a class.
+        order.sort(key=lambda i: rank.get(codes[i], -1))
+    crs = CRS(target_geo['crs']['init'])
+    shapes = []
+    for i in order:
+        shp = gpd.read_file(shapefiles[i])
+        shp = shp[shp.geometry.notnull()].to_crs(crs)
+        shapes.extend((geometry, codes[i]) for geometry in shp.geometry)
+
+    shape = (target_geo['height'], target_geo['width'])
+    if len(shapes):
+        class_map = rasterize(shapes, out_shape=shape, transform=target_geo['transform'],
+                fill=LABEL_NODATA, dtype=np.uint8)
+    else:
+        class_map = np.full(shape, LABEL_NODATA, dtype=np.uint8)
+
+    if cache_file is not None:
+        if not os.path.isdir(cache_directory):
+            os.makedirs(cache_directory)
+        tmp = cache_file + '.tmp'
+        with open(tmp, 'wb') as f:
+            np.save(f, class_map)
+        os.replace(tmp, cache_file)
+    return class_map
+
+
+def masked_class_labels(class_map):
+    ''' (1, H, W) masked array in the layout mask_raster_to_shapefile returned. '''
+    return np.ma.masked_array(class_map, mask=class_map == LABEL_NODATA)[np.newaxis]
+
+
+def _cache_key(shapefiles, codes, class_priority, target_geo):
+    sha = hashlib.sha1()
+    for shapefile, code in zip(shapefiles, codes):
+        base = os.path.splitext(shapefile)[0]
+        for ext in SHAPEFILE_PARTS:
+            part = base + ext
+            if os.path.isfile(part):
+                sha.update(ext.encode())
+                with open(part, 'rb') as f:
+                    for chunk in iter(lambda: f.read(1 << 20), b''):
+                        sha.update(chunk)
+        sha.update(str(code).encode())
+    sha.update(str(class_priority).encode())
+    sha.update(str(target_geo['crs']).encode())
+    sha.update(str(tuple(target_geo['transform'])).encode())
+    sha.update(str((target_geo['height'], target_geo['width'])).encode())
+    return sha.hexdigest()
@@ -2,6 +2,8 @@ import keras.backend as K
 import tensorflow as tf
 from sklearn.metrics import confusion_matrix
 
+from label_encoding import LABEL_NODATA
+
 _epsilon = tf.convert_to_tensor(K.epsilon(), tf.float32)
 
 def binary_focal_loss(gamma=2, alpha=0.25):
@@ -118,6 +120,26 @@ def masked_categorical_xent(y_true, y_pred):
     return tf.nn.softmax_cross_entropy_with_logits_v2(y_true, y_pred)
 
 
+def masked_sparse_categorical_xent(y_true, y_pred):
+    # y_true is a (B, H, W, 1) class map with LABEL_NODATA
+    # where there isn't a data pixel, so the one hot targets
+    # never have to be materialized.
+    y_true = tf.cast(tf.squeeze(y_true, axis=-1), tf.int32)
+    mask = tf.not_equal(y_true, LABEL_NODATA)
+    y_true = tf.boolean_mask(y_true, mask)
+    y_pred = tf.boolean_mask(y_pred, mask)
+    return tf.nn.sparse_softmax_cross_entropy_with_logits(labels=y_true, logits=y_pred)
+
+
+def sparse_m_acc(y_true, y_pred):
+    y_true = tf.cast(tf.squeeze(y_true, axis=-1), tf.int64)
+    mask = tf.not_equal(y_true, LABEL_NODATA)
+    y_pred = tf.argmax(y_pred, axis=-1)
+    y_true_masked = tf.boolean_mask(y_true, mask)
+    y_pred_masked = tf.boolean_mask(y_pred, mask)
+    return K.mean(K.equal(y_pred_masked, y_true_masked))
+
+
 def binary_acc(y_true, y_pred):
     y_pred = tf.round(tf.nn.sigmoid(y_pred))
     mask = tf.not_equal(y_true, -1)
@@ -0,0 +1,315 @@
+import os
+import re
+import sqlite3
+import datetime
+import argparse
+
+from collections import namedtuple
+
+from runspec import landsat_rasters, static_rasters, climate_rasters, mask_rasters
+
+# the database lives in its own directory, so that its journal coming and
+# going doesn't change the mtime of the image directory it catalogs.
+CATALOG_DIRECTORY = '.raster_catalog'
+CATALOG_FILE = 'catalog.sqlite'
+PATH_ROW_YEAR = re.compile(r'^(\d+)_(\d+)_(\d{4})$')
+# LXSPPPRRRYYYYDDDGSIVV, see _parse_landsat_capture_date.
+LANDSAT_SCENE = re.compile(r'^L[A-Z]\d{14}[A-Z0-9]{3}\d{2}$')
+
+Raster = namedtuple('Raster', ['filepath', 'path', 'row', 'year', 'acquisition_date', 'sensor',
+    'band', 'scene_directory', 'mtime'])
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS rasters (
+    filepath TEXT PRIMARY KEY,
+    directory TEXT NOT NULL,
+    path INTEGER,
+    row INTEGER,
+    year INTEGER,
+    acquisition_date TEXT,
+    sensor TEXT,
+    band TEXT NOT NULL,
+    scene_directory TEXT,
+    mtime REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS rasters_scene ON rasters (path, row, year, band, acquisition_date);
+CREATE INDEX IF NOT EXISTS rasters_sensor ON rasters (sensor, band);
+CREATE INDEX IF NOT EXISTS rasters_directory ON rasters (directory, band);
+CREATE TABLE IF NOT EXISTS directories (
+    directory TEXT PRIMARY KEY,
+    parent TEXT,
+    mtime REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS directories_parent ON directories (parent);
+'''
+
+
+def _parse_landsat_capture_date(landsat_scene):
+    '''
+    returns: calendar date of scene capture
+    landsat_scene is a directory (i.e data/38_27_2013/')
+    scene ID:
+       LXSPPPRRRYYYYDDDGSIVV
+       L = Landsat
+       X = Sensor
+       S = Satellite
+       PPP = WRS Path
+       RRR = WRS Row
+       YYYY = Year
+       DDD = Julian day
+       GSI = Ground station ident
+       VV = Archived version number
+    '''
+    julian_year_day = landsat_scene[-10:-5]
+    return datetime.datetime.strptime(julian_year_day, '%y%j').date()
+
+
+def catalog_bands():
+    ''' Every band suffix the catalog records, longest first so that a
+    file is filed under the most specific band it ends with. '''
+    bands = set(static_rasters()) | set(climate_rasters()) | set(mask_rasters())
+    for satellite_bands in landsat_rasters().values():
+        bands.update(satellite_bands)
+    return sorted(bands, key=lambda b: (-len(b), b))
+
+
+class RasterCatalog(object):
+    '''
+    SQLite index of the band rasters under root, by path, row, year,
+    acquisition date, sensor and band, so finding a scene's rasters is an
+    indexed query instead of an os.walk that tests every file name.
+
+    scan() keeps it current incrementally: a directory is only listed
+    again if its mtime changed (files were added, removed or renamed);
+    otherwise its subdirectories are taken from the catalog and only
+    stat'ed. full=True lists everything again.
+
+    The database uses SQLite's default rollback journal rather than WAL,
+    which needs shared memory that network filesystems don't provide.
+    '''
+
+    def __init__(self, root, db_file=None):
+        self.root = os.path.abspath(root)
+        if db_file is None:
+            os.makedirs(os.path.join(self.root, CATALOG_DIRECTORY), exist_ok=True)
+            db_file = os.path.join(self.root, CATALOG_DIRECTORY, CATALOG_FILE)
+        self.db_file = db_file
+        self._bands = catalog_bands()
+        self._db = sqlite3.connect(db_file, timeout=60)
+        self._db.executescript(_SCHEMA)
+
+
+    def __len__(self):
+        return self._db.execute('SELECT COUNT(*) FROM rasters').fetchone()[0]
+
+
+    def close(self):
+        self._db.close()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+    def scan(self, directory=None, full=False):
+        '''
+        Brings the catalog of directory (the root if None) up to date.
+        Returns the number of rasters added and removed.
+        '''
+        added = removed = 0
+        stack = [self._relative(directory if directory is not None else self.root)]
+        with self._db:
+            while stack:
+                rel_dir = stack.pop()
+                abs_dir = self._absolute(rel_dir)
+                try:
+                    mtime = os.stat(abs_dir).st_mtime
+                except FileNotFoundError:
+                    removed += self._forget(rel_dir)
+                    continue
+                known = self._db.execute('SELECT mtime FROM directories WHERE directory = ?',
+                        (rel_dir,)).fetchone()
+                children = [r[0] for r in self._db.execute(
+                    'SELECT directory FROM directories WHERE parent = ?', (rel_dir,))]
+                if known is not None and known[0] == mtime and not full:
+                    stack.extend(children)
+                    continue
+                subdirectories = []
+                rasters = []
+                for entry in os.scandir(abs_dir):
+                    if entry.name == CATALOG_DIRECTORY:
+                        continue
+                    rel = os.path.join(rel_dir, entry.name) if rel_dir else entry.name
+                    if entry.is_dir():
+                        subdirectories.append(rel)
+                    elif entry.is_file():
+                        raster = self._describe(rel, entry.stat().st_mtime)
+                        if raster is not None:
+                            rasters.append(raster)
+                for gone in set(children) - set(subdirectories):
+                    removed += self._forget(gone)
+                previous = set(r[0] for r in self._db.execute(
+                    'SELECT filepath FROM rasters WHERE directory = ?', (rel_dir,)))
+                current = set(r.filepath for r in rasters)
+                added += len(current - previous)
+                removed += len(previous - current)
+                self._db.execute('DELETE FROM rasters WHERE directory = ?', (rel_dir,))
+                self._db.executemany('INSERT INTO rasters VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                        [(r.filepath, rel_dir) + tuple(r[1:]) for r in rasters])
+                self._db.execute('INSERT OR REPLACE INTO directories VALUES (?, ?, ?)',
+                        (rel_dir, os.path.dirname(rel_dir) if rel_dir else None, mtime))
+                stack.extend(subdirectories)
+        return added, removed
+
+
+    def query(self, directory=None, bands=None, recursive=True, **columns):
+        '''
+        Rasters under directory (the whole catalog if None; only directly
+        in it if not recursive) of the given bands, filtered by any of the
+        path, row, year, acquisition_date (a datetime.date), sensor and
+        scene_directory columns. Returns Rasters ordered by filepath,
+        with filepath joined onto directory as given.
+        '''
+        where = []
+        params = []
+        prefix = ''
+        if directory is not None:
+            prefix = self._relative(directory)
+            if not recursive:
+                where.append('directory = ?')
+                params.append(prefix)
+            elif prefix:
+                # a range over the primary key: every filepath starting with prefix/.
+                where.append('filepath > ? AND filepath < ?')
+                params.extend([prefix + os.sep, prefix + chr(ord(os.sep) + 1)])
+        if bands is not None:
+            bands = list(bands)
+            where.append('band IN ({})'.format(', '.join('?'*len(bands))))
+            params.extend(bands)
+        for column, value in columns.items():
+            if column not in Raster._fields:
+                raise ValueError("can't query by {}".format(column))
+            if column == 'acquisition_date' and value is not None:
+                value = value.isoformat()
+            where.append('{} = ?'.format(column))
+            params.append(value)
+        sql = 'SELECT {} FROM rasters'.format(', '.join(Raster._fields))
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY filepath'
+        rasters = []
+        for r in self._db.execute(sql, params):
+            r = Raster(*r)
+            if directory is not None:
+                filepath = os.path.join(directory, os.path.relpath(r.filepath, prefix or '.'))
+            else:
+                filepath = self._absolute(r.filepath)
+            date = r.acquisition_date
+            if date is not None:
+                date = datetime.datetime.strptime(date, '%Y-%m-%d').date()
+            rasters.append(r._replace(filepath=filepath, acquisition_date=date))
+        return rasters
+
+
+    def band_paths(self, directory, bands, **columns):
+        ''' {band: [filepaths, sorted]} for every band, empty if none. '''
+        band_map = dict((band, []) for band in bands)
+        for r in self.query(directory, bands, **columns):
+            band_map[r.band].append(r.filepath)
+        return band_map
+
+
+    def _describe(self, rel, mtime):
+        filename = os.path.basename(rel)
+        band = next((b for b in self._bands if filename.endswith(b)), None)
+        if band is None:
+            return None
+        path = row = year = acquisition_date = sensor = scene_directory = None
+        root_parts = self.root.split(os.sep)
+        parts = root_parts + rel.split(os.sep)
+        # the directories holding the file, nearest first; the scene and
+        # path/row/year directories may be the root or above it.
+        for k in range(len(parts) - 2, -1, -1):
+            match = PATH_ROW_YEAR.match(parts[k])
+            if match and path is None:
+                path, row, year = (int(g) for g in match.groups())
+            if LANDSAT_SCENE.match(parts[k]) and scene_directory is None:
+                sensor = parts[k][:3]
+                acquisition_date = _parse_landsat_capture_date(parts[k]).isoformat()
+                scene_directory = os.sep.join(parts[len(root_parts):k + 1])
+        if band in climate_rasters():
+            sensor = 'climate'
+            try:
+                acquisition_date = datetime.datetime.strptime(filename[:10],
+                        '%Y-%m-%d').date().isoformat()
+            except ValueError:
+                pass
+        elif band in static_rasters():
+            sensor = 'static'
+        return Raster(rel, path, row, year, acquisition_date, sensor, band, scene_directory, mtime)
+
+
+    def _forget(self, rel_dir):
+        # drops a directory that no longer exists and everything below it.
+        n = 0
+        for d in [rel_dir] + [r[0] for r in self._db.execute(
+                'SELECT directory FROM directories WHERE directory > ? AND directory < ?',
+                (rel_dir + os.sep, rel_dir + chr(ord(os.sep) + 1)))]:
+            n += self._db.execute('DELETE FROM rasters WHERE directory = ?', (d,)).rowcount
+            self._db.execute('DELETE FROM directories WHERE directory = ?', (d,))
+        return n
+
+
+    def _relative(self, directory):
+        rel = os.path.relpath(os.path.abspath(directory), self.root)
+        if rel == os.curdir:
+            return ''
+        if rel == os.pardir or rel.startswith(os.pardir + os.sep):
+            raise ValueError("{} is outside the catalog of {}".format(directory, self.root))
+        return rel
+
+
+    def _absolute(self, rel):
+        return os.path.join(self.root, rel) if rel else self.root
+
+
+_catalogs = {}
+
+
+def raster_catalog(directory, scan=True):
+    '''
+    The catalog covering directory: the nearest one at or above it, or a new one in directory. One connection per process.
+    With scan=True the part of the catalog under directory is brought up
+    to date first, which costs a stat per directory.
+    '''
+    directory = os.path.abspath(directory)
+    root = directory
+    while not os.path.isfile(os.path.join(root, CATALOG_DIRECTORY, CATALOG_FILE)):
+        parent = os.path.dirname(root)
+        if parent == root:
+            root = directory
+            break
+        root = parent
+    key = (root, os.getpid())
+    if key not in _catalogs:
+        _catalogs[key] = RasterCatalog(root)
+    catalog = _catalogs[key]
+    if scan:
+        catalog.scan(directory)
+    return catalog
+
+
+if __name__ == '__main__':
+
+    ap = argparse.ArgumentParser(description='create or update the raster catalog of an image directory')
+    ap.add_argument('image_directory', type=str)
+    ap.add_argument('--full', action='store_true', help='list every directory again')
+    args = ap.parse_args()
+    with RasterCatalog(args.image_directory) as catalog:
+        added, removed = catalog.scan(full=args.full)
+        print('{} rasters added, {} removed, {} in the catalog'.format(added, removed,
+            len(catalog)))
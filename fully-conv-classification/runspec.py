@@ -18,6 +18,10 @@ from glob import glob
 abspath = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 sys.path.append(abspath)
 
+# the WRS-2 tile index is shared with pixel_classification; the other
+# modules take it from here rather than reaching into that package.
+from pixel_classification.wrs2_index import wrs2_index, WRS2_DESCENDING, WRS2_DESCENDING_USA
+
 target_bands = ('B1.TIF', 'B2.TIF', 'B3.TIF', 'B4.TIF')
 
 def assign_shapefile_class_code_binary(shapefile):
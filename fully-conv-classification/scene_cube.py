@@ -0,0 +1,80 @@
+import os
+import json
+import hashlib
+import numpy as np
+
+from rasterio import open as rasopen
+from data_utils import SceneStack, WindowedRasterStack
+
+ROWS_PER_BLOCK = 1024
+BLOCK_SIZE = 256
+
+
+def scene_cube(image_directory, paths_map, target_geo, dtype=np.uint16):
+    '''
+    Every raster of paths_map (see data_utils.paths_map_multiple_scenes)
+    aligned to target_geo, cached in image_directory as one tiled, deflate
+    compressed, band interleaved GeoTIFF in SceneStack's band order, each
+    band described by its band name. A JSON sidecar lists the sources and
+    their mtimes; the cube is rebuilt only when those change, so a path/row
+    is read and warped band by band once rather than every time it's used.
+    Returns the path of the cube.
+    '''
+    sources = [[band, os.path.relpath(p, image_directory), os.path.getmtime(p)]
+            for band in sorted(paths_map.keys()) for p in _band_paths(paths_map[band])]
+    if not len(sources):
+        raise ValueError("no rasters to cache in {}".format(image_directory))
+    cube_file, sidecar = _cache_files(image_directory, target_geo)
+    if os.path.isfile(cube_file) and os.path.isfile(sidecar):
+        with open(sidecar, 'r') as f:
+            cached = json.load(f)
+        if cached.get('sources') == sources and cached.get('dtype') == np.dtype(dtype).name:
+            return cube_file
+
+    _write_cube(paths_map, target_geo, dtype, cube_file)
+    tmp = sidecar + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump({'sources': sources, 'dtype': np.dtype(dtype).name,
+            'shape': [len(sources), target_geo['height'], target_geo['width']]}, f)
+    os.replace(tmp, sidecar)
+    return cube_file
+
+
+def open_scene_cube(image_directory, paths_map, target_geo, dtype=np.uint16,
+        stack_class=WindowedRasterStack):
+    '''
+    The cached cube of paths_map (built if missing or stale, see
+    scene_cube) as an unopened stack_class, which reads it with a single
+    file open. Bands keep their names from paths_map.
+    '''
+    cube_file = scene_cube(image_directory, paths_map, target_geo, dtype)
+    return stack_class({'scene_cube': cube_file}, target_geo, dtype=dtype)
+
+
+def _band_paths(paths):
+    return [paths] if isinstance(paths, str) else sorted(paths)
+
+
+def _write_cube(paths_map, target_geo, dtype, cube_file):
+    # Band by band and block by block over rows, so at most ROWS_PER_BLOCK
+    # rows of one band are in memory.
+    tmp = cube_file + '.tmp'
+    with SceneStack(paths_map, target_geo, dtype=dtype) as stack:
+        meta = stack.meta
+        meta.update(driver='GTiff', tiled=True, blockxsize=BLOCK_SIZE, blockysize=BLOCK_SIZE,
+                compress='deflate', interleave='band', BIGTIFF='IF_SAFER',
+                predictor=2 if np.issubdtype(dtype, np.integer) else 3)
+        with rasopen(tmp, 'w', **meta) as dst:
+            for b in range(stack.n_bands):
+                dst.set_band_description(b + 1, stack.band_names[b])
+                for y in range(0, stack.height, ROWS_PER_BLOCK):
+                    window = stack.window(y, 0, ROWS_PER_BLOCK, stack.width)
+                    dst.write(stack.read(b, window), b + 1, window=window)
+    os.replace(tmp, cube_file)
+
+
+def _cache_files(image_directory, target_geo):
+    grid = hashlib.sha1(str((str(target_geo['crs']), tuple(target_geo['transform']),
+        target_geo['height'], target_geo['width'])).encode()).hexdigest()[:12]
+    base = os.path.join(image_directory, 'scene_cube_{}'.format(grid))
+    return base + '.tif', base + '.json'
@@ -8,9 +8,10 @@ from rasterio.mask import mask
 from pyproj import CRS
 from rasterio import open as rasopen
 from shapely.geometry import shape, mapping, Polygon
-from sklearn.neighbors import KDTree
 from collections import defaultdict
 
+from runspec import wrs2_index, WRS2_DESCENDING_USA
+
 
 def get_features(gdf):
     tmp = loads(gdf.to_json())
@@ -33,7 +34,6 @@ def mask_raster_to_shapefile(shapefile, raster, return_binary=True):
         crs = CRS(src.crs['init'])
         shp = shp.to_crs(crs)
         features = get_features(shp)
-        arr = src.read()
         out_image, out_transform = mask(src, shapes=features, filled=False)
         if return_binary:
             out_image[out_image != 0] = 1 
@@ -52,7 +52,6 @@ def mask_raster_to_features(raster, features, features_meta):
         print(crs)
         shp = gdf.to_crs(src.crs)
         features = get_features(shp)
-        arr = src.read()
         out_image, out_transform = mask(src, shapes=features)
         out_image[out_image != 0] = 1 
         meta = src.meta
@@ -69,22 +68,10 @@ def get_shapefile_lat_lon(shapefile):
     return latc, lonc 
 
 
-def _construct_kdtree(wrs2):
-    centroids = []
-    path_rows = [] # a mapping
-    features = []
-    for feature in wrs2:
-        tile = shape(feature['geometry'])
-        centroid = tile.centroid.coords[0]
-        centroids.append([centroid[0], centroid[1]])
-        z = feature['properties']
-        p = z['PATH']
-        r = z['ROW']
-        path_rows.append(str(p) + "_" + str(r))
-        features.append(feature)
-
-    tree = KDTree(asarray(centroids))
-    return tree, asarray(path_rows), asarray(features)
+def _path_rows_within(poly):
+    ''' "path_row" of every WRS-2 tile that poly lies within. '''
+    return [str(p) + "_" + str(r) for p, r in
+            wrs2_index(WRS2_DESCENDING_USA).path_rows_containing(poly)]
 
 
 def get_pr(poly, wrs2):
@@ -149,22 +136,11 @@ def filter_shapefile_overlapping(shapefile, out_directory=None):
     the shapefile into separate files for each path/row/year
     contained in the shapefile. """
     path_row_map = defaultdict(list)
-    wrs2 = fopen('../spatial_data/wrs2_descending_usa.shp', 'r')
-    tree, path_rows, features = _construct_kdtree(wrs2)
-    wrs2.close()
-
-    cent_arr = array([0, 0])
     with fopen(shapefile, "r") as src:
         meta = deepcopy(src.meta)
         for feat in src:
             poly = shape(feat['geometry'])
-            centroid = poly.centroid.coords[0]
-            cent_arr[0] = centroid[0]
-            cent_arr[1] = centroid[1]
-            centroid = cent_arr.reshape(1, -1)
-            dist, ind = tree.query(centroid, k=10)
-            tiles = features[ind[0]]
-            prs = get_pr_subset(poly, tiles) # gets the matching path/rows
+            prs = _path_rows_within(poly) # gets the matching path/rows
 
             for p in prs:
                 path_row_map[p].append(feat)
@@ -192,25 +168,13 @@ def filter_shapefile_non_overlapping(base, base_shapefile, data_directory):
     base: directory containing base_shapefile."""
     path_row = defaultdict(list) 
     id_mapping = {}
-    # TODO: un hardcode this directory.
-    wrs2 = fopen('../spatial_data/wrs2_descending_usa.shp', 'r')
-    tree, path_rows, features = _construct_kdtree(wrs2)
-    wrs2.close()
-
-    cent_arr = array([0, 0])
     with fopen(os.path.join(base, base_shapefile), "r") as src:
         meta = deepcopy(src.meta)
         for feat in src:
             idd = feat['id']
             id_mapping[idd] = feat
             poly = shape(feat['geometry'])
-            centroid = poly.centroid.coords[0]
-            cent_arr[0] = centroid[0]
-            cent_arr[1] = centroid[1]
-            centroid = cent_arr.reshape(1, -1)
-            dist, ind = tree.query(centroid, k=10)
-            tiles = features[ind[0]]
-            prs = get_pr_subset(poly, tiles)
+            prs = _path_rows_within(poly)
             for p in prs:
                 path_row[p].append(idd)
 
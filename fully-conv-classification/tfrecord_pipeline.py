@@ -0,0 +1,269 @@
+import os
+import json
+import pickle
+import numpy as np
+import tensorflow as tf
+
+from glob import glob
+
+from runspec import cdl_crop_values
+from label_encoding import class_map_from_one_hot
+from tile_manifest import TileManifest, has_manifest
+from band_statistics import load_band_statistics
+
+INDEX_FILE = 'tfrecord_index.json'
+AUTOTUNE = tf.data.experimental.AUTOTUNE
+
+
+def _bytes_feature(value):
+    return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
+
+
+def _int64_feature(values):
+    return tf.train.Feature(int64_list=tf.train.Int64List(value=list(values)))
+
+
+def _tile_example(tile):
+    data = np.ascontiguousarray(tile['data'], dtype=np.uint16)
+    class_map = np.ascontiguousarray(tile['class_map'], dtype=np.uint8)
+    cdl = np.ascontiguousarray(tile['cdl'], dtype=np.uint8)
+    feature = {'data': _bytes_feature(data.tobytes()),
+               'data_shape': _int64_feature(data.shape),
+               'class_map': _bytes_feature(class_map.tobytes()),
+               'cdl': _bytes_feature(cdl.tobytes()),
+               'class_code': _int64_feature([tile['class_code']]),
+               'tile_id': _bytes_feature((tile.get('tile_id') or '').encode())}
+    return tf.train.Example(features=tf.train.Features(feature=feature))
+
+
+class TFRecordTileWriter(object):
+    '''
+    Writes DataTile dicts into TFRecord shards of tiles_per_shard
+    examples each, for the tf.data backend. A small JSON index keeps
+    the number of tiles per shard so that steps_per_epoch can be
+    computed without reading the records. Writing into a directory
+    that already has shards appends new ones; like TileStoreWriter, only
+    one writer at a time.
+    '''
+
+    def __init__(self, directory, tiles_per_shard=256):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.index = load_index(directory)
+        self.tiles_per_shard = tiles_per_shard
+        self._writer = None
+        self._shard_name = None
+
+
+    def _open_shard(self):
+        self._shard_name = 'tiles-{:05d}.tfrecord'.format(len(self.index['shards']))
+        self._writer = tf.io.TFRecordWriter(os.path.join(self.directory, self._shard_name))
+        self.index['shards'][self._shard_name] = 0
+
+
+    def _close_shard(self):
+        if self._writer is None:
+            return
+        self._writer.close()
+        self._writer = None
+
+
+    def add(self, tile):
+        if tile.get('class_map') is None:
+            raise ValueError("TFRecord tiles require a class_map")
+        if self._writer is None:
+            self._open_shard()
+        shard_name = self._shard_name
+        self._writer.write(_tile_example(tile).SerializeToString())
+        self.index['shards'][shard_name] += 1
+        if self.index['shards'][shard_name] == self.tiles_per_shard:
+            self._close_shard()
+        return shard_name
+
+
+    def close(self):
+        self._close_shard()
+        tmp = os.path.join(self.directory, INDEX_FILE + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(tmp, os.path.join(self.directory, INDEX_FILE))
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def load_index(directory):
+    index_path = os.path.join(directory, INDEX_FILE)
+    if not os.path.isfile(index_path):
+        return {'shards': {}}
+    with open(index_path, 'r') as f:
+        return json.load(f)
+
+
+def live_tiles(directory):
+    '''
+    The (shard, tile_id) of every tile the manifest of directory lists, or
+    None if it has no manifest. Incremental re-extraction appends changed
+    tiles to new shards and leaves the replaced ones where they are, so
+    only these examples are current; tiles extracted without an id have
+    tile_id ''. Shards that have since been deleted are left out.
+    '''
+    if not has_manifest(directory):
+        return None
+    shards = load_index(directory)['shards']
+    return set((r['tile'], r.get('tile_id') or '') for r in TileManifest(directory).records
+            if r['tile'] in shards)
+
+
+def count_tiles(directory):
+    live = live_tiles(directory)
+    if live is not None:
+        return len(live)
+    return sum(load_index(directory)['shards'].values())
+
+
+def _parse_tile(serialized, n_classes, use_cdl, sparse_labels, apply_irrigated_weights=False):
+    spec = {'data': tf.io.FixedLenFeature([], tf.string),
+            'data_shape': tf.io.FixedLenFeature([3], tf.int64),
+            'class_map': tf.io.FixedLenFeature([], tf.string),
+            'cdl': tf.io.FixedLenFeature([], tf.string),
+            'class_code': tf.io.FixedLenFeature([1], tf.int64),
+            'tile_id': tf.io.FixedLenFeature([], tf.string, default_value='')}
+    example = tf.io.parse_single_example(serialized, spec)
+    shape = tf.cast(example['data_shape'], tf.int32)
+    data = tf.reshape(tf.io.decode_raw(example['data'], tf.uint16), shape)
+    class_map = tf.reshape(tf.io.decode_raw(example['class_map'], tf.uint8), shape[:2])
+    cdl = tf.reshape(tf.io.decode_raw(example['cdl'], tf.uint8), [shape[0], shape[1], 1])
+    if sparse_labels:
+        labels = tf.expand_dims(class_map, -1)
+    else:
+        # tf.one_hot gives all zeros for LABEL_NODATA, like one_hot_from_class_map.
+        labels = tf.one_hot(tf.cast(class_map, tf.int32), n_classes, dtype=tf.float32)
+        if apply_irrigated_weights:
+            # DataGenerator's labels[..., 0] *= 50.
+            weights = tf.one_hot(0, n_classes, on_value=50.0, off_value=1.0)
+            labels = labels * weights
+    if use_cdl:
+        crop = tf.constant(list(cdl_crop_values().keys()), dtype=tf.uint8)
+        cdl = tf.reduce_any(tf.equal(tf.expand_dims(cdl, -1), crop), axis=-1)
+        return data, labels, cdl
+    return data, labels
+
+
+def _live_filter(live):
+    # keeps the examples whose "<shard>/<tile_id>" is in live.
+    keys = sorted('{}/{}'.format(shard, tid) for shard, tid in live)
+    table = tf.lookup.StaticHashTable(tf.lookup.KeyValueTensorInitializer(keys,
+        tf.ones(len(keys), dtype=tf.int32)), default_value=0)
+
+    def is_live(shard, serialized):
+        spec = {'tile_id': tf.io.FixedLenFeature([], tf.string, default_value='')}
+        tid = tf.io.parse_single_example(serialized, spec)['tile_id']
+        return table.lookup(tf.strings.join([shard, tid], separator='/')) > 0
+    return is_live
+
+
+def _standardizer(band_statistics):
+    # BandStatistics.standardize, on the features of a parsed tile.
+    mean, inv_std = (tf.constant(v) for v in band_statistics.scale())
+
+    def standardize(data, *rest):
+        return ((tf.cast(data, tf.float32) - mean) * inv_std,) + rest
+    return standardize
+
+
+def _augment(*tensors):
+    ''' Applies the same random rotation and flip to every tensor. '''
+    k = tf.random.uniform([], 0, 4, dtype=tf.int32)
+    flip = tf.random.uniform([]) < 0.5
+    out = []
+    for t in tensors:
+        t = tf.image.rot90(t, k)
+        t = tf.cond(flip, lambda t=t: tf.reverse(t, axis=[1]), lambda t=t: t)
+        out.append(t)
+    return tuple(out)
+
+
+def _to_model_inputs(*tensors):
+    # Same structure as DataGenerator batches: ([features], [labels(, cdl)])
+    return (tensors[0],), tuple(tensors[1:])
+
+
+def make_dataset(directory, batch_size, n_classes, training=True, augment_data=False,
+        use_cdl=False, sparse_labels=False, apply_irrigated_weights=False, cache=False,
+        shuffle_buffer=64, cycle_length=4, band_statistics=None, rank=0, world_size=1):
+    '''
+    tf.data alternative to DataGenerator over the shards written by
+    TFRecordTileWriter. Shards are read with a parallel interleave,
+    examples are decoded and augmented with parallel maps, and batches are
+    prefetched. cache: False, True (in memory) or a filename to cache
+    decoded tiles on local disk. Training datasets repeat forever, so
+    pass steps_per_epoch to fit. apply_irrigated_weights scales the
+    irrigated (class 0) one hot labels by 50, as DataGenerator does.
+    If the directory has a manifest, only the tiles it lists are read (see
+    live_tiles), so tiles replaced by incremental re-extraction are
+    skipped; count_tiles counts the same tiles.
+    band_statistics: a BandStatistics or its json file (see
+    band_statistics.py); features are standardized with it, as
+    DataGenerator does, before augmentation.
+    rank, world_size: read only every world_size'th shard from rank, so
+    that the nodes of a distributed run see disjoint tiles.
+    '''
+    if world_size < 1 or not 0 <= rank < world_size:
+        raise ValueError("rank must be in [0, world_size), got rank {} and world_size {}".format(
+            rank, world_size))
+    if sparse_labels and apply_irrigated_weights:
+        raise ValueError("apply_irrigated_weights requires one hot labels")
+    files = sorted(glob(os.path.join(directory, '*.tfrecord')))
+    live = live_tiles(directory)
+    if live is not None:
+        live_shards = set(shard for shard, _ in live)
+        files = [f for f in files if os.path.basename(f) in live_shards]
+    if not len(files):
+        raise ValueError("no TFRecord shards in {}".format(directory))
+    if len(files) < world_size:
+        raise ValueError("{} TFRecord shards in {} can't be split between {} ranks".format(
+            len(files), directory, world_size))
+    ds = tf.data.Dataset.from_tensor_slices(([os.path.basename(f) for f in files], files))
+    # sharded before the shuffle, over the sorted file list every rank shares.
+    ds = ds.shard(world_size, rank)
+    if training:
+        ds = ds.shuffle(len(files))
+    ds = ds.interleave(lambda shard, f: tf.data.TFRecordDataset(f).map(lambda x: (shard, x)),
+            cycle_length=cycle_length, num_parallel_calls=AUTOTUNE)
+    if live is not None:
+        ds = ds.filter(_live_filter(live))
+    ds = ds.map(lambda shard, x: _parse_tile(x, n_classes, use_cdl, sparse_labels,
+                apply_irrigated_weights), num_parallel_calls=AUTOTUNE)
+    if cache:
+        ds = ds.cache(cache if isinstance(cache, str) else '')
+    band_statistics = load_band_statistics(band_statistics)
+    if band_statistics is not None:
+        ds = ds.map(_standardizer(band_statistics), num_parallel_calls=AUTOTUNE)
+    if training:
+        ds = ds.shuffle(shuffle_buffer).repeat()
+        if augment_data:
+            ds = ds.map(_augment, num_parallel_calls=AUTOTUNE)
+    ds = ds.batch(batch_size)
+    ds = ds.map(_to_model_inputs, num_parallel_calls=AUTOTUNE)
+    return ds.prefetch(AUTOTUNE)
+
+
+def convert_pickle_directory(pickle_directory, tfrecord_directory, tiles_per_shard=256):
+    ''' Writes every class_N_data/*.pkl tile under pickle_directory into
+    TFRecord shards. Returns the number of tiles converted. '''
+    files = sorted(glob(os.path.join(pickle_directory, 'class_*_data', '*.pkl')))
+    with TFRecordTileWriter(tfrecord_directory, tiles_per_shard) as writer:
+        for f in files:
+            with open(f, 'rb') as src:
+                tile = pickle.load(src)
+            if 'class_map' not in tile:
+                tile['class_map'] = class_map_from_one_hot(tile.pop('one_hot'))
+            writer.add(tile)
+    return len(files)
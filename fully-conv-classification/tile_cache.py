@@ -0,0 +1,132 @@
+import os
+import pickle
+import hashlib
+import threading
+import numpy as np
+
+from collections import OrderedDict
+
+
+def _tile_nbytes(tile):
+    return sum(v.nbytes for v in tile.values() if isinstance(v, np.ndarray))
+
+
+class TileCache(object):
+    '''
+    In-process LRU cache of decoded tiles (DataTile dicts) with a byte
+    budget. Tiles evicted from memory can optionally be spilled to a
+    local directory (e.g. an SSD) as pickles, with their own byte
+    budget, and are promoted back into memory when they're read again.
+    Thread safe, so it can be shared with a thread prefetch pool.
+    '''
+
+    def __init__(self, max_bytes, spill_directory=None, spill_max_bytes=None):
+        self.max_bytes = max_bytes
+        self.spill_directory = spill_directory
+        self.spill_max_bytes = spill_max_bytes
+        if spill_directory is not None and not os.path.isdir(spill_directory):
+            os.makedirs(spill_directory)
+        self.nbytes = 0
+        self.spill_nbytes = 0
+        self.hits = 0
+        self.spill_hits = 0
+        self.misses = 0
+        self._tiles = OrderedDict()
+        self._spilled = OrderedDict()
+        self._lock = threading.Lock()
+
+
+    def get(self, key):
+        with self._lock:
+            if key in self._tiles:
+                self._tiles.move_to_end(key)
+                self.hits += 1
+                return self._tiles[key]
+            if key in self._spilled:
+                self.spill_hits += 1
+                tile = self._load_spilled(key)
+                self._insert(key, tile)
+                return tile
+            self.misses += 1
+            return None
+
+
+    def put(self, key, tile):
+        # Copy memmapped arrays so that a hit never goes back to disk.
+        tile = {k: np.array(v) if isinstance(v, np.ndarray) else v for k, v in tile.items()}
+        with self._lock:
+            if key in self._tiles:
+                return
+            self._insert(key, tile)
+
+
+    def _insert(self, key, tile):
+        nbytes = _tile_nbytes(tile)
+        if nbytes > self.max_bytes:
+            return
+        self._tiles[key] = tile
+        self.nbytes += nbytes
+        while self.nbytes > self.max_bytes:
+            old_key, old_tile = self._tiles.popitem(last=False)
+            self.nbytes -= _tile_nbytes(old_tile)
+            self._spill(old_key, old_tile)
+
+
+    def _spill_path(self, key):
+        name = hashlib.sha1(str(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.spill_directory, name + '.pkl')
+
+
+    def _spill(self, key, tile):
+        if self.spill_directory is None or key in self._spilled:
+            return
+        with open(self._spill_path(key), 'wb') as f:
+            pickle.dump(tile, f, protocol=pickle.HIGHEST_PROTOCOL)
+        nbytes = _tile_nbytes(tile)
+        self._spilled[key] = nbytes
+        self.spill_nbytes += nbytes
+        while self.spill_max_bytes is not None and self.spill_nbytes > self.spill_max_bytes:
+            old_key, old_nbytes = self._spilled.popitem(last=False)
+            os.remove(self._spill_path(old_key))
+            self.spill_nbytes -= old_nbytes
+
+
+    def _load_spilled(self, key):
+        with open(self._spill_path(key), 'rb') as f:
+            tile = pickle.load(f)
+        self._spilled.move_to_end(key)
+        return tile
+
+
+    def __getstate__(self):
+        # Process prefetch workers each get their own (empty) copy.
+        state = self.__dict__.copy()
+        del state['_lock']
+        state['_tiles'] = OrderedDict()
+        state['_spilled'] = OrderedDict()
+        state['nbytes'] = 0
+        state['spill_nbytes'] = 0
+        state['spill_directory'] = None
+        return state
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'spill_hits': self.spill_hits, 'misses': self.misses,
+                    'n_tiles': len(self._tiles), 'nbytes': self.nbytes,
+                    'n_spilled': len(self._spilled), 'spill_nbytes': self.spill_nbytes}
+
+
+    def clear(self):
+        with self._lock:
+            for key in self._spilled:
+                os.remove(self._spill_path(key))
+            self._tiles.clear()
+            self._spilled.clear()
+            self.nbytes = 0
+            self.spill_nbytes = 0
@@ -0,0 +1,102 @@
+import numpy as np
+
+from label_encoding import LABEL_NODATA, class_map_from_labels
+
+
+class CoverageIndex(object):
+    '''
+    Summed area tables of the per class pixel counts of a label raster,
+    so the number of pixels of every class in any window is four lookups
+    instead of a scan of the window. Nodata is whatever is left of the
+    window area.
+
+    The tables are built over block_size x block_size blocks to keep them
+    small (a full path/row at block_size=1 would take n_classes * 4 bytes
+    per pixel); window offsets and sizes must then be multiples of
+    block_size. Counts are exact for such windows.
+
+    class_map: (X, Y) uint8 class map with LABEL_NODATA, or a masked array
+    of class labels as built during extraction.
+    '''
+
+    def __init__(self, class_map, n_classes, block_size=16):
+        if np.ma.isMaskedArray(class_map):
+            class_map = class_map_from_labels(class_map)
+        self.shape = class_map.shape
+        self.n_classes = n_classes
+        self.block_size = block_size
+        n_x = -(-self.shape[0] // block_size)
+        n_y = -(-self.shape[1] // block_size)
+        # (n_x + 1, n_y + 1, n_classes) with a leading row and column of zeros.
+        self.sat = np.zeros((n_x + 1, n_y + 1, n_classes), dtype=np.int64)
+        xs, ys = np.nonzero(class_map < n_classes)
+        if xs.shape[0]:
+            classes = class_map[xs, ys]
+            flat = ((xs // block_size) * n_y + ys // block_size) * n_classes + classes
+            counts = np.bincount(flat, minlength=n_x*n_y*n_classes)
+            self.sat[1:, 1:] = counts.reshape(n_x, n_y, n_classes).cumsum(0).cumsum(1)
+            self.bounds = (xs.min(), xs.max() + 1, ys.min(), ys.max() + 1)
+        else:
+            self.bounds = None
+
+
+    def window_counts(self, xs, ys, size):
+        '''
+        Per class pixel counts of the size x size windows at every
+        (x, y) in xs x ys: a (len(xs), len(ys), n_classes) array.
+        '''
+        xs = np.asarray(xs)
+        ys = np.asarray(ys)
+        if np.any(xs % self.block_size) or np.any(ys % self.block_size) or size % self.block_size:
+            raise ValueError("window offsets and size must be multiples of block_size={}".format(
+                self.block_size))
+        x0 = xs // self.block_size
+        y0 = ys // self.block_size
+        x1 = np.minimum(x0 + size // self.block_size, self.sat.shape[0] - 1)
+        y1 = np.minimum(y0 + size // self.block_size, self.sat.shape[1] - 1)
+        sat = self.sat
+        return (sat[x1[:, None], y1[None, :]] - sat[x0[:, None], y1[None, :]]
+                - sat[x1[:, None], y0[None, :]] + sat[x0[:, None], y0[None, :]])
+
+
+    def counts(self, x, y, size):
+        return self.window_counts([x], [y], size)[0, 0]
+
+
+    def select_windows(self, tile_size, stride=None, min_labelled_fraction=0.0):
+        '''
+        Every tile_size window on a stride grid over the labelled area that
+        lies inside the raster and has at least min_labelled_fraction of its
+        pixels labelled (and at least one). stride defaults to tile_size;
+        smaller strides give overlapping tiles.
+        Returns a list of (x, y, class counts).
+        '''
+        if stride is None:
+            stride = tile_size
+        if self.bounds is None:
+            return []
+        min_x, max_x, min_y, max_y = self.bounds
+        # the grid starts at the first labelled block.
+        min_x -= min_x % self.block_size
+        min_y -= min_y % self.block_size
+        xs = np.arange(min_x, min(max_x, self.shape[0] - tile_size + 1), stride)
+        ys = np.arange(min_y, min(max_y, self.shape[1] - tile_size + 1), stride)
+        if not (xs.shape[0] and ys.shape[0]):
+            return []
+        counts = self.window_counts(xs, ys, tile_size)
+        labelled = counts.sum(axis=2)
+        keep = (labelled > 0) & (labelled >= min_labelled_fraction * tile_size**2)
+        return [(int(xs[i]), int(ys[j]), counts[i, j]) for i, j in zip(*np.nonzero(keep))]
+
+
+def class_code_from_counts(counts):
+    '''
+    The class a tile is filed under, from its per class pixel counts:
+    fallow (3) if there's any, else the most common class if there are no
+    irrigated pixels, else irrigated (0).
+    '''
+    if len(counts) > 3 and counts[3] > 0:
+        return 3
+    if counts[0] == 0:
+        return int(np.argmax(counts))
+    return 0
@@ -0,0 +1,212 @@
+import os
+import json
+import hashlib
+import threading
+import numpy as np
+
+from glob import glob
+from collections import defaultdict
+
+from label_encoding import LABEL_NODATA
+
+MANIFEST_FILE = 'manifest.jsonl'
+SCENE_MANIFEST_TEMPLATE = 'manifest_{}.jsonl'
+
+
+def tile_id(path, row, year, window, class_map, bands):
+    '''
+    Deterministic id of a tile: the same scene, window, labels and feature
+    bands always give the same id, and a change to any of them a new one.
+    class_map: the tile's uint8 labels; bands: names of the feature rasters.
+    '''
+    sha = hashlib.sha1()
+    sha.update(json.dumps([int(path), int(row), int(year), [int(w) for w in window],
+        list(class_map.shape), list(bands)]).encode())
+    sha.update(np.ascontiguousarray(class_map).tobytes())
+    return sha.hexdigest()[:20]
+
+
+def tile_record(tile, tile_ref, n_classes, path, row, year, window, crop_values):
+    '''
+    One manifest entry. tile_ref is whatever the tile writer returned:
+    a path relative to the training directory for pickles, an index for
+    a tile store, or a shard name for TFRecords.
+    window: (x, y, tile_size) pixel offsets into the path/row.
+    '''
+    class_map = tile['class_map']
+    pixel_counts = np.bincount(class_map[class_map != LABEL_NODATA].ravel(), minlength=n_classes)
+    cdl_crop_fraction = float(np.mean(np.isin(tile['cdl'], crop_values)))
+    return {'tile': tile_ref, 'tile_id': tile.get('tile_id'),
+            'class_code': int(tile['class_code']),
+            'pixel_counts': [int(c) for c in pixel_counts[:n_classes]],
+            'nodata_pixels': int(np.count_nonzero(class_map == LABEL_NODATA)),
+            'path': int(path), 'row': int(row), 'year': int(year),
+            'window': [int(w) for w in window],
+            'cdl_crop_fraction': cdl_crop_fraction,
+            'n_pixels': int(np.prod(tile['data'].shape[:-1]))}
+
+
+class TileManifestWriter(object):
+    '''
+    Appends one JSON line per tile as tiles are written, so an
+    interrupted extraction still leaves a valid manifest.
+    scene: write manifest_<scene>.jsonl instead of the shared manifest.jsonl.
+    overwrite: replace that file when closed instead of appending to it,
+    so it lists exactly the tiles of this run. Used as a context manager,
+    a run that raises leaves the previous file in place.
+    '''
+
+    def __init__(self, directory, scene=None, overwrite=False):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.path = _manifest_path(directory, scene)
+        self.overwrite = overwrite
+        self._lock = threading.Lock()
+        if overwrite:
+            self._f = open(self.path + '.tmp', 'w')
+        else:
+            self._f = open(self.path, 'a')
+
+
+    def append(self, record):
+        line = json.dumps(record) + '\n'
+        with self._lock:
+            self._f.write(line)
+            self._f.flush()
+
+
+    def close(self, discard=False):
+        ''' discard: drop what this run wrote instead of replacing the file. '''
+        if self._f.closed:
+            return
+        self._f.close()
+        if not self.overwrite:
+            return
+        if discard:
+            os.remove(self.path + '.tmp')
+        else:
+            os.replace(self.path + '.tmp', self.path)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, *args):
+        self.close(discard=exc_type is not None)
+
+
+class TileManifest(object):
+    '''
+    Per-tile statistics for a training directory, loaded once.
+    Lets the generators build their file lists and pixel weighted
+    sampling distributions without listing directories or
+    opening any tile.
+
+    A scene with its own manifest_<scene>.jsonl is listed from that file
+    alone: its records in the shared manifest.jsonl of older extractions
+    are superseded, since re-extraction may have renamed its tiles.
+    '''
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.records = []
+        scenes = set()
+        for path in _scene_manifest_files(directory):
+            self.records.extend(read_manifest_records(path))
+            scenes.add(_manifest_scene(path))
+        self.records = [r for r in read_manifest_records(_manifest_path(directory))
+                if _record_scene(r) not in scenes] + self.records
+        self._by_class = defaultdict(list)
+        for i, record in enumerate(self.records):
+            self._by_class[record['class_code']].append(i)
+
+
+    def __len__(self):
+        return len(self.records)
+
+
+    def class_codes(self):
+        return sorted(self._by_class)
+
+
+    def tiles_for_class(self, class_code):
+        return [self.records[i]['tile'] for i in self._by_class[class_code]]
+
+
+    def pixel_counts(self, class_codes=None):
+        ''' (n_tiles, n_classes) array of labelled pixels per class,
+        restricted to tiles of class_codes if given. '''
+        records = self._records(class_codes)
+        return np.asarray([r['pixel_counts'] for r in records], dtype=np.int64)
+
+
+    def pixel_weights(self, class_codes=None):
+        '''
+        Sampling probability per tile such that every class contributes
+        the same expected number of labelled pixels: each tile is weighted
+        by sum_c pixels_c / total_pixels_c.
+        '''
+        counts = self.pixel_counts(class_codes).astype(np.float64)
+        totals = counts.sum(axis=0)
+        totals[totals == 0] = 1
+        weights = (counts / totals).sum(axis=1)
+        return weights / weights.sum()
+
+
+    def tiles(self, class_codes=None):
+        return [r['tile'] for r in self._records(class_codes)]
+
+
+    def _records(self, class_codes):
+        if class_codes is None:
+            return self.records
+        return [self.records[i] for c in class_codes for i in self._by_class[c]]
+
+
+def read_manifest_records(path):
+    records = []
+    if not os.path.isfile(path):
+        return records
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                records.append(json.loads(line))
+    return records
+
+
+def scene_manifest_records(directory, scene):
+    return read_manifest_records(_manifest_path(directory, scene))
+
+
+def _manifest_path(directory, scene=None):
+    if scene is None:
+        return os.path.join(directory, MANIFEST_FILE)
+    return os.path.join(directory, SCENE_MANIFEST_TEMPLATE.format(scene))
+
+
+def _scene_manifest_files(directory):
+    return sorted(glob(os.path.join(directory, SCENE_MANIFEST_TEMPLATE.format('*'))))
+
+
+def _manifest_files(directory):
+    # the shared manifest, then one per scene.
+    paths = [_manifest_path(directory)] + _scene_manifest_files(directory)
+    return [p for p in paths if os.path.isfile(p)]
+
+
+def _manifest_scene(path):
+    prefix, suffix = SCENE_MANIFEST_TEMPLATE.split('{}')
+    return os.path.basename(path)[len(prefix):-len(suffix)]
+
+
+def _record_scene(record):
+    # None for records written before they carried their path/row/year.
+    if any(record.get(key) is None for key in ('path', 'row', 'year')):
+        return None
+    return '_'.join(str(record[key]) for key in ('path', 'row', 'year'))
+
+
+def has_manifest(directory):
+    return len(_manifest_files(directory)) > 0
@@ -0,0 +1,199 @@
+import os
+import json
+import pickle
+import argparse
+import numpy as np
+
+from glob import glob
+
+from label_encoding import class_map_from_one_hot
+
+INDEX_FILE = 'index.json'
+ARRAY_KEYS = ('data', 'class_map', 'one_hot', 'cdl')
+
+
+class TileStoreWriter(object):
+    '''
+    Writes DataTile dicts into fixed-size binary shards instead of
+    one pickle per tile. Every array key ('data', 'class_map', 'cdl')
+    gets its own shard file per shard so that a reader can memory
+    map each array independently. The array keys, shapes and dtypes are
+    taken from the first tile added; every subsequent tile must match them.
+    If the directory already contains a store, new tiles are appended
+    in a fresh shard. Only one writer may have a directory open at a
+    time: shards are numbered from the index read on opening, which is
+    rewritten whole on closing.
+    '''
+
+    def __init__(self, store_directory, tiles_per_shard=256):
+        self.store_directory = store_directory
+        if not os.path.isdir(store_directory):
+            os.makedirs(store_directory)
+        index_path = os.path.join(store_directory, INDEX_FILE)
+        if os.path.isfile(index_path):
+            with open(index_path, 'r') as f:
+                self.index = json.load(f)
+            self.shard = self.index['n_shards']
+        else:
+            self.index = {'tiles_per_shard': tiles_per_shard, 'arrays': None,
+                    'n_shards': 0, 'tiles': []}
+            self.shard = 0
+        self.tiles_per_shard = self.index['tiles_per_shard']
+        self.slot = 0
+        self._shard_arrays = None
+
+
+    def _open_shard(self):
+        self._shard_arrays = {}
+        for key, spec in self.index['arrays'].items():
+            shape = (self.tiles_per_shard,) + tuple(spec['shape'])
+            self._shard_arrays[key] = np.memmap(_shard_path(self.store_directory, self.shard, key),
+                    dtype=spec['dtype'], mode='w+', shape=shape)
+        self.index['n_shards'] = self.shard + 1
+        self.slot = 0
+
+
+    def _close_shard(self):
+        if self._shard_arrays is None:
+            return
+        for arr in self._shard_arrays.values():
+            arr.flush()
+        self._shard_arrays = None
+        self.shard += 1
+
+
+    def add(self, tile):
+        ''' tile: dict with the same keys as DataTile.dict.
+        Returns the index of the tile in the store. '''
+        if self.index['arrays'] is None:
+            self.index['arrays'] = {key: {'shape': list(np.shape(tile[key])),
+                'dtype': np.asarray(tile[key]).dtype.str} for key in ARRAY_KEYS if key in tile}
+        keys = sorted(key for key in ARRAY_KEYS if key in tile)
+        if keys != sorted(self.index['arrays']):
+            # e.g. a one_hot tile added to a store of class_map tiles.
+            raise ValueError("tile has arrays {}, store expects {}".format(keys,
+                sorted(self.index['arrays'])))
+        if self._shard_arrays is None:
+            self._open_shard()
+        for key, arr in self._shard_arrays.items():
+            if tuple(np.shape(tile[key])) != arr.shape[1:]:
+                raise ValueError("tile array {} has shape {}, store expects {}".format(key,
+                    np.shape(tile[key]), arr.shape[1:]))
+            arr[self.slot] = tile[key]
+        self.index['tiles'].append({'shard': self.shard, 'slot': self.slot,
+            'class_code': int(tile['class_code'])})
+        self.slot += 1
+        if self.slot == self.tiles_per_shard:
+            self._close_shard()
+        return len(self.index['tiles']) - 1
+
+
+    def close(self):
+        self._close_shard()
+        tmp = os.path.join(self.store_directory, INDEX_FILE + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(tmp, os.path.join(self.store_directory, INDEX_FILE))
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class TileStore(object):
+    '''
+    Read-only view of a store written by TileStoreWriter.
+    Shards are opened lazily with np.memmap and indexing returns
+    views into the mapped files, so no tile is copied until the
+    caller stacks it into a batch.
+    '''
+
+    def __init__(self, store_directory):
+        self.store_directory = store_directory
+        with open(os.path.join(store_directory, INDEX_FILE), 'r') as f:
+            self.index = json.load(f)
+        self.tiles = self.index['tiles']
+        self.tiles_per_shard = self.index['tiles_per_shard']
+        self._shards = {}
+
+
+    def __len__(self):
+        return len(self.tiles)
+
+
+    def _shard(self, shard):
+        if shard not in self._shards:
+            arrays = {}
+            for key, spec in self.index['arrays'].items():
+                shape = (self.tiles_per_shard,) + tuple(spec['shape'])
+                arrays[key] = np.memmap(_shard_path(self.store_directory, shard, key),
+                        dtype=spec['dtype'], mode='r', shape=shape)
+            self._shards[shard] = arrays
+        return self._shards[shard]
+
+
+    def __getitem__(self, idx):
+        record = self.tiles[idx]
+        arrays = self._shard(record['shard'])
+        tile = {key: arr[record['slot']] for key, arr in arrays.items()}
+        tile['class_code'] = record['class_code']
+        return tile
+
+
+    def class_codes(self):
+        return sorted(set(t['class_code'] for t in self.tiles))
+
+
+    def tiles_for_class(self, class_code):
+        return [i for i, t in enumerate(self.tiles) if t['class_code'] == class_code]
+
+
+    def __getstate__(self):
+        # memmaps are reopened in the receiving process.
+        state = self.__dict__.copy()
+        state['_shards'] = {}
+        return state
+
+
+def is_tile_store(directory):
+    return os.path.isfile(os.path.join(directory, INDEX_FILE))
+
+
+def _shard_path(store_directory, shard, key):
+    return os.path.join(store_directory, 'shard_{:05d}_{}.bin'.format(shard, key))
+
+
+def convert_pickle_directory(pickle_directory, store_directory, tiles_per_shard=256,
+        compact_labels=True):
+    '''
+    Converts a directory laid out like the output of extract_training_data
+    (pickle_directory/class_N_data/*.pkl) into a tile store.
+    compact_labels: store one hot tiles as uint8 class maps.
+    Returns the number of tiles converted.
+    '''
+    files = sorted(glob(os.path.join(pickle_directory, 'class_*_data', '*.pkl')))
+    with TileStoreWriter(store_directory, tiles_per_shard) as writer:
+        for f in files:
+            with open(f, 'rb') as src:
+                tile = pickle.load(src)
+            if compact_labels and 'one_hot' in tile:
+                tile['class_map'] = class_map_from_one_hot(tile.pop('one_hot'))
+            writer.add(tile)
+    return len(files)
+
+
+if __name__ == '__main__':
+
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--pickle-directory', type=str, required=True)
+    ap.add_argument('--store-directory', type=str, required=True)
+    ap.add_argument('--tiles-per-shard', type=int, default=256)
+    ap.add_argument('--keep-one-hot', action='store_true')
+    args = ap.parse_args()
+    n = convert_pickle_directory(args.pickle_directory, args.store_directory, args.tiles_per_shard,
+            compact_labels=not args.keep_one_hot)
+    print('converted {} tiles into {}'.format(n, args.store_directory))
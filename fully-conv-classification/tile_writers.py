@@ -0,0 +1,185 @@
+import os
+import time
+import pickle
+import threading
+import numpy as np
+
+from queue import Queue
+
+
+class PickleTileWriter(object):
+    '''
+    Writes one pickle per DataTile dict under class_{class_code}_data/,
+    the layout DataGenerator reads, named <tile_id>.pkl if the tile has a
+    'tile_id' (see tile_manifest.tile_id) and by time otherwise. Each tile
+    goes to a temporary file that is renamed into place, so readers never
+    see a partial pickle; with fsync=True it's also on disk before the
+    rename. add() returns the path relative to training_directory.
+    Safe to call from several threads.
+    '''
+    thread_safe = True
+
+    def __init__(self, training_directory, fsync=False):
+        self.training_directory = training_directory
+        self.fsync = fsync
+        self._lock = threading.Lock()
+        self._n = 0
+
+
+    def add(self, tile):
+        class_directory = 'class_{}_data'.format(tile['class_code'])
+        if tile.get('tile_id') is not None:
+            filename = tile['tile_id'] + '.pkl'
+        else:
+            with self._lock:
+                # time alone isn't unique across threads.
+                filename = '{:.6f}_{}.pkl'.format(time.time(), self._n)
+                self._n += 1
+        directory = os.path.join(self.training_directory, class_directory)
+        os.makedirs(directory, exist_ok=True)
+        outfile = os.path.join(directory, filename)
+        tmp = outfile + '.tmp'
+        with open(tmp, 'wb') as f:
+            pickle.dump(tile, f, protocol=pickle.HIGHEST_PROTOCOL)
+            if self.fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp, outfile)
+        return os.path.join(class_directory, filename)
+
+
+    def exists(self, tile_ref):
+        return os.path.isfile(os.path.join(self.training_directory, tile_ref))
+
+
+    def remove(self, tile_ref):
+        path = os.path.join(self.training_directory, tile_ref)
+        if os.path.isfile(path):
+            os.remove(path)
+
+
+    def close(self):
+        pass
+
+
+class AsyncTileWriter(object):
+    '''
+    Writes tiles on long lived background threads so extraction doesn't
+    wait on disk. writer is any tile writer with add(tile) -> tile reference
+    and close(): PickleTileWriter, TileStoreWriter or TFRecordTileWriter.
+    Writers that aren't thread_safe get a single thread, which keeps their
+    tiles in order.
+
+    add() blocks once max_queue tiles are waiting, which bounds memory.
+    If a manifest (tile_manifest.TileManifestWriter) is given, each record
+    passed to add() is appended to it once its tile is written, with
+    record['tile'] set to the writer's reference. The first error raised
+    on a writer thread is re-raised by the next add() or by close().
+    Leaving a with block on an exception drops the tiles still queued and
+    closes the writer without raising, so that exception is the one seen.
+    '''
+
+    def __init__(self, writer, manifest=None, n_threads=None, max_queue=32, verbose=True):
+        self.writer = writer
+        self.manifest = manifest
+        if n_threads is None:
+            n_threads = 4 if getattr(writer, 'thread_safe', False) else 1
+        if n_threads > 1 and not getattr(writer, 'thread_safe', False):
+            raise ValueError("{} can only be written from one thread".format(
+                type(writer).__name__))
+        self.verbose = verbose
+        self._queue = Queue(maxsize=max_queue)
+        self._manifest_lock = threading.Lock()
+        self._error = None
+        self._discard = False
+        self._n_tiles = 0
+        self._n_bytes = 0
+        self._blocked_seconds = 0.0
+        self._start = time.time()
+        self._threads = [threading.Thread(target=self._run, daemon=True)
+                for _ in range(n_threads)]
+        for thread in self._threads:
+            thread.start()
+
+
+    def add(self, tile, record=None):
+        self._raise_if_failed()
+        start = time.time()
+        self._queue.put((tile, record))
+        self._blocked_seconds += time.time() - start
+
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            tile, record = item
+            if self._error is not None or self._discard:
+                continue # drain the queue so add() and close() can't block.
+            try:
+                tile_ref = self.writer.add(tile)
+                with self._manifest_lock:
+                    self._n_tiles += 1
+                    self._n_bytes += sum(v.nbytes for v in tile.values()
+                            if isinstance(v, np.ndarray))
+                    if self.manifest is not None and record is not None:
+                        record['tile'] = tile_ref
+                        self.manifest.append(record)
+            except Exception as e:
+                self._error = e
+
+
+    def _raise_if_failed(self):
+        if self._error is not None:
+            raise self._error
+
+
+    def stats(self):
+        elapsed = max(time.time() - self._start, 1e-9)
+        return {'tiles': self._n_tiles, 'bytes': self._n_bytes, 'seconds': elapsed,
+                'tiles_per_second': self._n_tiles / elapsed,
+                'mb_per_second': self._n_bytes / 1e6 / elapsed,
+                'producer_blocked_seconds': self._blocked_seconds}
+
+
+    def _stop(self, discard=False):
+        # returns False if the threads were already stopped.
+        if self._threads is None:
+            return False
+        self._discard = discard
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = None
+        return True
+
+
+    def close(self):
+        if not self._stop():
+            return
+        self.writer.close()
+        if self.verbose:
+            stats = self.stats()
+            print('wrote {} tiles ({:.1f} MB) in {:.1f}s: {:.1f} tiles/s, {:.1f} MB/s, '
+                    'extraction waited {:.1f}s on the writer'.format(stats['tiles'],
+                        stats['bytes'] / 1e6, stats['seconds'], stats['tiles_per_second'],
+                        stats['mb_per_second'], stats['producer_blocked_seconds']))
+        self._raise_if_failed()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+            return
+        if self._stop(discard=True):
+            try:
+                self.writer.close()
+            except Exception as e:
+                print('closing {} after an error failed too: {}'.format(
+                    type(self.writer).__name__, e))
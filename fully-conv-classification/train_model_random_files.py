@@ -13,10 +13,12 @@ from scipy.special import expit
 from random import sample
 from glob import glob
 from time import time
+from sys import exit
 
 
 from models import unet, two_headed_unet
-from data_generators import DataGenerator
+from data_generators import DataGenerator, RandomWindowGenerator
+from tfrecord_pipeline import make_dataset, count_tiles
 from train_utils import lr_schedule, F1Score
 from losses import *
 
@@ -34,6 +36,31 @@ if __name__ == '__main__':
 
     ap = ArgumentParser()
     ap.add_argument('--gamma', type=float)
+    ap.add_argument('--prefetch-batches', type=int, default=0)
+    ap.add_argument('--prefetch-workers', type=int, default=1)
+    ap.add_argument('--prefetch-backend', type=str, default='thread',
+            choices=['thread', 'process'])
+    ap.add_argument('--prefetch-memory-gb', type=float)
+    ap.add_argument('--validation-cache-gb', type=float,
+            help='keep decoded validation tiles in memory after the first epoch')
+    ap.add_argument('--validation-spill-directory', type=str,
+            help='local directory for validation tiles that do not fit in memory')
+    ap.add_argument('--seed', type=int)
+    ap.add_argument('--rank', type=int, default=0, help='index of this node')
+    ap.add_argument('--world-size', type=int, default=1, help='number of training nodes')
+    ap.add_argument('--backend', type=str, default='sequence',
+            choices=['sequence', 'tfdata', 'cubes'],
+            help='sequence: DataGenerator over pickles/tile store, tfdata: TFRecord shards, '
+            'cubes: random windows from path/row cubes')
+    ap.add_argument('--tfrecord-root', type=str,
+            help='directory with train/ and test/ TFRecord shards, for --backend tfdata')
+    ap.add_argument('--cube-root', type=str,
+            help='directory with train/ and test/ cubes (extracted with tile_format=cube), '
+            'for --backend cubes')
+    ap.add_argument('--band-statistics', type=str,
+            help='band_stats.json to standardize features with (see band_statistics.py)')
+    ap.add_argument('--steps-per-epoch', type=int, default=1000,
+            help='windows drawn per epoch are steps * batch size, for --backend cubes')
 
     args = ap.parse_args()
 
@@ -76,13 +103,58 @@ if __name__ == '__main__':
     loss_weights = [1.0, 0.25]
     model.compile(opt, loss=[masked_categorical_xent, 'binary_crossentropy'],
             metrics={'irr':metric, 'cdl':'accuracy'}, loss_weights=loss_weights)
-    train_generator = DataGenerator(train_dir, batch_size, target_classes=None, 
-            n_classes=n_classes, balance=False, balance_pixels_per_batch=False, 
-            balance_examples_per_batch=True, apply_irrigated_weights=False,
-            training=True, augment_data=False, use_cdl=True)
-    test_generator = DataGenerator(test_dir, batch_size, target_classes=None, 
-            n_classes=n_classes, training=False, balance=False, steps_per_epoch=30,
-            augment_data=False, use_cdl=True)
+    if args.backend == 'tfdata':
+        tfrecord_root = args.tfrecord_root if args.tfrecord_root is not None else root
+        train_data = make_dataset(join(tfrecord_root, 'train'), batch_size, n_classes,
+                training=True, augment_data=False, use_cdl=True,
+                band_statistics=args.band_statistics, rank=args.rank,
+                world_size=args.world_size)
+        test_data = make_dataset(join(tfrecord_root, 'test'), batch_size, n_classes,
+                training=False, use_cdl=True, band_statistics=args.band_statistics)
+        # each rank reads 1 / world_size of the shards.
+        steps_per_epoch = int(np.ceil(count_tiles(join(tfrecord_root, 'train')) /
+            (batch_size * args.world_size)))
+        model.fit(train_data,
+                epochs=epochs,
+                steps_per_epoch=steps_per_epoch,
+                validation_data=test_data,
+                validation_steps=30,
+                callbacks=[tensorboard, lr_scheduler, checkpoint],
+                verbose=1)
+        exit(0)
+
+    prefetch_memory_bytes = None
+    if args.prefetch_memory_gb is not None:
+        prefetch_memory_bytes = int(args.prefetch_memory_gb * 1e9)
+    cache_bytes = None
+    if args.validation_cache_gb is not None:
+        cache_bytes = int(args.validation_cache_gb * 1e9)
+    if args.backend == 'cubes':
+        cube_root = args.cube_root if args.cube_root is not None else root
+        train_generator = RandomWindowGenerator(join(cube_root, 'train'), batch_size,
+                n_classes, steps_per_epoch=args.steps_per_epoch, training=True,
+                augment_data=True, use_cdl=True, prefetch_batches=args.prefetch_batches,
+                prefetch_workers=args.prefetch_workers, prefetch_backend=args.prefetch_backend,
+                prefetch_memory_bytes=prefetch_memory_bytes, seed=args.seed,
+                band_statistics=args.band_statistics)
+        test_generator = RandomWindowGenerator(join(cube_root, 'test'), batch_size,
+                n_classes, steps_per_epoch=30, training=False, use_cdl=True,
+                cache_bytes=cache_bytes, cache_spill_directory=args.validation_spill_directory,
+                seed=args.seed, band_statistics=args.band_statistics)
+    else:
+        train_generator = DataGenerator(train_dir, batch_size, target_classes=None, 
+                n_classes=n_classes, balance=False, balance_pixels_per_batch=False, 
+                balance_examples_per_batch=True, apply_irrigated_weights=False,
+                training=True, augment_data=False, use_cdl=True,
+                prefetch_batches=args.prefetch_batches, prefetch_workers=args.prefetch_workers,
+                prefetch_backend=args.prefetch_backend, prefetch_memory_bytes=prefetch_memory_bytes,
+                seed=args.seed, rank=args.rank, world_size=args.world_size, shard_by_class=True,
+                band_statistics=args.band_statistics)
+        test_generator = DataGenerator(test_dir, batch_size, target_classes=None, 
+                n_classes=n_classes, training=False, balance=False, steps_per_epoch=30,
+                augment_data=False, use_cdl=True, cache_bytes=cache_bytes,
+                cache_spill_directory=args.validation_spill_directory,
+                band_statistics=args.band_statistics)
     m2 = F1Score(test_generator, n_classes, model_path, batch_size, two_headed_net=True)
     model.fit_generator(train_generator, 
             epochs=epochs,
@@ -91,4 +163,5 @@ if __name__ == '__main__':
             use_multiprocessing=False,
             workers=1,
             max_queue_size=1,
+            shuffle=False, # the generator shuffles its own file list; keeps prefetching in order.
             verbose=1)
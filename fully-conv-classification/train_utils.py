@@ -19,6 +19,8 @@ from multiprocessing import Pool
 from random import sample, shuffle
 from glob import glob
 
+from label_encoding import tile_class_map
+
 
 class F1Score(Callback):
 
@@ -46,6 +48,8 @@ class F1Score(Callback):
                 batch_size=self.batch_size, model=self.model, n_classes=self.n_classes,
                 multi_output=self.two_headed_net)
         print('n pixels per class:', np.sum(cmat, axis=1)) 
+        if getattr(self.validation_data, 'cache', None) is not None:
+            print('validation tile cache:', self.validation_data.cache.stats())
         print(prec)
         print(recall)
         precision_irrigated = prec[0]
@@ -133,7 +137,7 @@ def hardbin(negative_example_directory, models, n_minority, alpha, k, custom_obj
             with open(f, 'rb') as src:
                 data = pickle.load(src)
             y_pred = model.predict(np.expand_dims(data['data'], 0))
-            mask = data['one_hot'][:, :, 0] == 1 # where there is majority class.
+            mask = tile_class_map(data) == 0 # where there is majority class.
             y_pred = expit(y_pred)
             y_pred = y_pred[0, :, :, 0][mask]
             avg_pred_miss = np.mean(y_pred) #
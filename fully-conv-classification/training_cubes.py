@@ -0,0 +1,84 @@
+import os
+import json
+import numpy as np
+
+from label_encoding import class_map_from_labels
+
+CUBE_FILE = 'cube.json'
+SCENE_FILE = 'scene.json'
+
+
+def _save_npy(outfile, arr):
+    # write then rename, so a crash never leaves a truncated cube behind.
+    tmp = outfile + '.tmp'
+    with open(tmp, 'wb') as f:
+        np.save(f, arr)
+    os.replace(tmp, outfile)
+
+
+def save_training_cube(image_stack, class_labels, cdl_raster, training_data_root_directory,
+        split, path_row_year, source_paths=None):
+    '''
+    Saves a whole aligned path/row for random window sampling instead of
+    cutting it into fixed tiles. image_stack (H, W, bands) and cdl_raster
+    (H, W, 1) are shared by the splits and written once to
+    <root>/scenes/<path_row_year>/; the uint8 class map of the split goes to
+    <root>/<split>/<path_row_year>/ next to a cube.json pointing at the scene.
+
+    source_paths: the files image_stack and cdl_raster are read from. A
+    JSON sidecar lists them with their mtimes, and the scene's features
+    and CDL are rewritten (and only then read, if the stacks are lazy)
+    when that list changes; without source_paths they're always rewritten.
+    '''
+    scene_directory = os.path.join(training_data_root_directory, 'scenes', path_row_year)
+    if not os.path.isdir(scene_directory):
+        os.makedirs(scene_directory)
+    sources = None
+    if source_paths is not None:
+        sources = [[os.path.abspath(p), os.path.getmtime(p)] for p in source_paths]
+    if not _scene_is_current(scene_directory, sources):
+        sidecar = os.path.join(scene_directory, SCENE_FILE)
+        if os.path.isfile(sidecar):
+            # a crash while rewriting must not leave the old sidecar vouching for the new files.
+            os.remove(sidecar)
+        _save_npy(os.path.join(scene_directory, 'features.npy'), image_stack[:, :, :])
+        _save_npy(os.path.join(scene_directory, 'cdl.npy'), cdl_raster[:, :, :])
+        if sources is not None:
+            tmp = sidecar + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump({'sources': sources}, f)
+            os.replace(tmp, sidecar)
+
+    label_directory = os.path.join(training_data_root_directory, split, path_row_year)
+    if not os.path.isdir(label_directory):
+        os.makedirs(label_directory)
+    _save_npy(os.path.join(label_directory, 'class_map.npy'), class_map_from_labels(class_labels))
+    with open(os.path.join(label_directory, CUBE_FILE), 'w') as f:
+        json.dump({'scene': os.path.relpath(scene_directory, label_directory)}, f)
+
+
+def _scene_is_current(scene_directory, sources):
+    if sources is None:
+        return False
+    sidecar = os.path.join(scene_directory, SCENE_FILE)
+    for f in (sidecar, os.path.join(scene_directory, 'features.npy'),
+            os.path.join(scene_directory, 'cdl.npy')):
+        if not os.path.isfile(f):
+            return False
+    with open(sidecar, 'r') as f:
+        return json.load(f).get('sources') == sources
+
+
+def load_training_cube(label_directory):
+    ''' Returns memory mapped (features, class_map, cdl) of a saved cube. '''
+    with open(os.path.join(label_directory, CUBE_FILE), 'r') as f:
+        scene_directory = os.path.join(label_directory, json.load(f)['scene'])
+    features = np.load(os.path.join(scene_directory, 'features.npy'), mmap_mode='r')
+    cdl = np.load(os.path.join(scene_directory, 'cdl.npy'), mmap_mode='r')
+    class_map = np.load(os.path.join(label_directory, 'class_map.npy'), mmap_mode='r')
+    return features, class_map, cdl
+
+
+def find_training_cubes(directory):
+    return sorted(os.path.join(directory, d) for d in os.listdir(directory)
+            if os.path.isfile(os.path.join(directory, d, CUBE_FILE)))
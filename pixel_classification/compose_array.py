@@ -32,9 +32,9 @@ from rasterio import open as rasopen
 from shapely.geometry import shape, Point, mapping
 from shapely.ops import unary_union
 
-loc = os.path.dirname(__file__)
-WRS_2 = loc.replace('pixel_classification',
-                    os.path.join('spatial_data', 'wrs2_descending.shp'))
+from pixel_classification.wrs2_index import wrs2_index, WRS2_DESCENDING
+
+WRS_2 = WRS2_DESCENDING
 
 '''
 This script contains a class meant to gather data from rasters using a polygon shapefile.  
@@ -476,18 +476,13 @@ class PixelTrainingArray(object):
 
     @property
     def tile_geometry(self):
-        with fopen(WRS_2, 'r') as wrs:
-            wrs_meta = wrs.meta.copy()
-        return wrs_meta
+        return wrs2_index(WRS_2).meta.copy()
 
     @property
     def tile_bbox(self):
-        with fopen(WRS_2, 'r') as wrs:
-            for feature in wrs:
-                fp = feature['properties']
-                if fp['PATH'] == self.geography.path and fp['ROW'] == self.geography.row:
-                    bbox = feature['geometry']
-                    return bbox
+        feature = wrs2_index(WRS_2).feature(self.geography.path, self.geography.row)
+        if feature is not None:
+            return feature['geometry']
 
 
 if __name__ == '__main__':
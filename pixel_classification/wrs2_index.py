@@ -0,0 +1,164 @@
+# =============================================================================================
+# Copyright 2018 dgketchum
+#
+# Licensed under the Apache License, Version 2. (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# =============================================================================================
+
+import os
+import pickle
+import hashlib
+
+from fiona import open as fopen
+from shapely.geometry import shape, mapping, Point
+from shapely.strtree import STRtree
+
+loc = os.path.dirname(__file__)
+SPATIAL_DATA = loc.replace('pixel_classification', 'spatial_data')
+WRS2_DESCENDING = os.path.join(SPATIAL_DATA, 'wrs2_descending.shp')
+WRS2_DESCENDING_USA = os.path.join(SPATIAL_DATA, 'wrs2_descending_usa.shp')
+CACHE_DIRECTORY = os.path.join(os.environ.get('XDG_CACHE_HOME',
+                                              os.path.join(os.path.expanduser('~'), '.cache')),
+                               'IrrMapper')
+
+'''
+The WRS-2 tiles, shared by pixel_classification and fully-conv-classification.
+Each shapefile is read once per process (see `wrs2_index`), and its parsed tiles
+are pickled so that later processes don't read it at all.
+'''
+
+
+class WRS2Index(object):
+    """
+    Tiles of a WRS-2 shapefile, indexed both ways: path/row to tile by dict lookup, and
+    geometry to path/rows through an STRtree of the tile polygons rather than a scan of
+    every tile.
+
+    The parsed tiles are pickled to cache_directory (the user's cache directory by default,
+    never the tracked spatial_data) and reused for as long as the shapefile's size and mtime
+    are unchanged.
+    """
+
+    def __init__(self, shapefile=WRS2_DESCENDING_USA, cache_directory=None):
+        self.shapefile = os.path.abspath(shapefile)
+        if cache_directory is None:
+            cache_directory = CACHE_DIRECTORY
+        name = os.path.splitext(os.path.basename(self.shapefile))[0]
+        # shapefiles of the same name in different directories get their own caches.
+        key = hashlib.sha1(self.shapefile.encode()).hexdigest()[:10]
+        self.cache_file = os.path.join(cache_directory, '{}_{}.index.pkl'.format(name, key))
+
+        tiles = self._load()
+        self.meta = tiles['meta']
+        self.crs = self.meta['crs']
+        self.path_rows = tiles['path_rows']
+        self.properties = tiles['properties']
+        self.geometries = tiles['geometries']
+        self._index = dict((path_row, k) for k, path_row in enumerate(self.path_rows))
+        self._tree = STRtree(self.geometries)
+        self._tree_index = dict((id(g), k) for k, g in enumerate(self.geometries))
+
+    def __len__(self):
+        return len(self.path_rows)
+
+    def geometry(self, path, row):
+        """ The tile polygon of path/row, or None if the shapefile doesn't have it. """
+        k = self._index.get((int(path), int(row)))
+        return None if k is None else self.geometries[k]
+
+    def feature(self, path, row):
+        """ The tile of path/row as a fiona style feature dict, or None. """
+        k = self._index.get((int(path), int(row)))
+        if k is None:
+            return None
+        return {'type': 'Feature', 'geometry': mapping(self.geometries[k]),
+                'properties': dict(self.properties[k])}
+
+    def path_rows_containing(self, geometry):
+        """ (path, row) of every tile that geometry lies within, sorted. """
+        return sorted(self.path_rows[k] for k in self._candidates(geometry)
+                      if geometry.within(self.geometries[k]))
+
+    def path_rows_intersecting(self, geometry):
+        """ (path, row) of every tile that geometry intersects, sorted. """
+        return sorted(self.path_rows[k] for k in self._candidates(geometry)
+                      if geometry.intersects(self.geometries[k]))
+
+    def path_rows_at(self, x, y):
+        """ (path, row) of every tile containing the point x, y (in the shapefile's crs). """
+        return self.path_rows_intersecting(Point(x, y))
+
+    def _candidates(self, geometry):
+        # tiles whose envelopes intersect geometry's. Shapely 2 returns indices,
+        # earlier versions the tree's geometries themselves.
+        hits = self._tree.query(geometry)
+        return [self._tree_index[id(g)] if hasattr(g, 'geom_type') else int(g) for g in hits]
+
+    def _signature(self):
+        signature = []
+        for ext in ('.shp', '.dbf'):
+            st = os.stat(os.path.splitext(self.shapefile)[0] + ext)
+            signature.append((st.st_size, st.st_mtime))
+        return signature
+
+    def _load(self):
+        signature = self._signature()
+        if os.path.isfile(self.cache_file):
+            try:
+                with open(self.cache_file, 'rb') as f:
+                    tiles = pickle.load(f)
+                if tiles.get('signature') == signature:
+                    return tiles
+            except (pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+                pass  # a cache from other library versions; rebuilt below.
+
+        tiles = self._read_shapefile()
+        tiles['signature'] = signature
+        tmp = '{}.{}.tmp'.format(self.cache_file, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+            with open(tmp, 'wb') as f:
+                pickle.dump(tiles, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, self.cache_file)
+        except OSError as e:
+            # an unwritable cache directory only costs the cache.
+            print('not caching the WRS-2 index: {}'.format(e))
+        return tiles
+
+    def _read_shapefile(self):
+        path_rows, properties, geometries = [], [], []
+        with fopen(self.shapefile, 'r') as wrs:
+            meta = wrs.meta.copy()
+            for feature in wrs:
+                fp = dict(feature['properties'])
+                path_rows.append((int(fp['PATH']), int(fp['ROW'])))
+                properties.append(fp)
+                geometries.append(shape(feature['geometry']))
+        return {'meta': meta, 'path_rows': path_rows, 'properties': properties,
+                'geometries': geometries}
+
+
+_indices = {}
+
+
+def wrs2_index(shapefile=WRS2_DESCENDING_USA):
+    """ The WRS2Index of shapefile, built once per process. """
+    key = os.path.abspath(shapefile)
+    if key not in _indices:
+        _indices[key] = WRS2Index(key)
+    return _indices[key]
+
+
+if __name__ == '__main__':
+    pass
+
+# ========================= EOF ====================================================================
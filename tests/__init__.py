@@ -15,6 +15,14 @@
 # =============================================================================================
 
 import os
+import sys
+
+# fully-conv-classification is a directory of flat modules rather than a
+# package; its tests import them by name.
+FULLY_CONV = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                          'fully-conv-classification')
+if FULLY_CONV not in sys.path:
+    sys.path.append(FULLY_CONV)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,82 @@
+# ===============================================================================
+# Copyright 2018 dgketchum
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+
+
+import unittest
+
+import numpy as np
+
+# importing tests puts fully-conv-classification on the path.
+from tests import FULLY_CONV
+from augmentation import N_TRANSFORMS, d4_view, augment_batch
+
+
+def d4_reference(tile, code):
+    # the same group from np.rot90 and np.transpose on the first two axes.
+    out = np.rot90(tile, code % 4)
+    if code >= 4:
+        out = np.transpose(out, (1, 0) + tuple(range(2, tile.ndim)))
+    return out
+
+
+class AugmentationTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tile = np.arange(5 * 5 * 3).reshape(5, 5, 3)
+
+    def test_d4_view_matches_rot90_and_transpose(self):
+        for code in range(N_TRANSFORMS):
+            np.testing.assert_array_equal(d4_view(self.tile, code), d4_reference(self.tile, code))
+
+    def test_d4_views_are_distinct_views(self):
+        views = [d4_view(self.tile, code) for code in range(N_TRANSFORMS)]
+        self.assertEqual(len(set(v.tobytes() for v in views)), N_TRANSFORMS)
+        for view in views:
+            self.assertTrue(np.shares_memory(view, self.tile))
+
+    def test_named_flips(self):
+        np.testing.assert_array_equal(d4_view(self.tile, 5), self.tile[:, ::-1])
+        np.testing.assert_array_equal(d4_view(self.tile, 7), self.tile[::-1])
+        np.testing.assert_array_equal(d4_view(self.tile, 2), self.tile[::-1, ::-1])
+
+    def test_augment_batch_applies_one_code_per_sample_to_every_array(self):
+        rng = np.random.RandomState(0)
+        features = rng.randint(0, 100, (6, 4, 4, 2))
+        labels = rng.randint(0, 3, (6, 4, 4)).astype(np.uint8)
+        (out_features, out_labels), codes = augment_batch([features, labels], rng)
+        self.assertEqual(codes.shape, (6,))
+        for i, code in enumerate(codes):
+            np.testing.assert_array_equal(out_features[i], d4_reference(features[i], code))
+            np.testing.assert_array_equal(out_labels[i], d4_reference(labels[i], code))
+
+    def test_augment_batch_is_seeded(self):
+        batch = np.arange(8 * 4 * 4).reshape(8, 4, 4)
+        first, codes = augment_batch([batch], np.random.RandomState(3))
+        second, same_codes = augment_batch([batch], np.random.RandomState(3))
+        np.testing.assert_array_equal(codes, same_codes)
+        np.testing.assert_array_equal(first[0], second[0])
+
+    def test_augment_batch_rejects_bad_shapes(self):
+        with self.assertRaises(ValueError):
+            augment_batch([np.zeros((2, 4, 5))])
+        with self.assertRaises(ValueError):
+            augment_batch([np.zeros((2, 4, 4)), np.zeros((3, 4, 4))])
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# ========================= EOF ====================================================================
@@ -0,0 +1,155 @@
+# ===============================================================================
+# Copyright 2018 dgketchum
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+# importing tests puts fully-conv-classification on the path.
+from tests import FULLY_CONV
+from band_statistics import (BandStatistics, ScenePixels, band_statistics_from_scenes,
+                             load_band_statistics, load_scene_statistics, save_scene_statistics,
+                             valid_pixels)
+
+
+class BandStatisticsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.tiles = [rng.randint(1, 10000, (16, 16, 3)).astype(np.uint16) for _ in range(5)]
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def assert_matches(self, stats, pixels):
+        pixels = pixels.reshape(-1, pixels.shape[-1]).astype(np.float64)
+        self.assertEqual(stats.count, pixels.shape[0])
+        np.testing.assert_allclose(stats.mean, pixels.mean(axis=0), rtol=1e-12)
+        np.testing.assert_allclose(stats.variance, pixels.var(axis=0), rtol=1e-10)
+
+    def test_update_matches_numpy(self):
+        stats = BandStatistics(3)
+        for tile in self.tiles:
+            stats.update(tile)
+        self.assert_matches(stats, np.stack(self.tiles))
+
+    def test_merge_matches_numpy(self):
+        merged = BandStatistics(3)
+        for tile in self.tiles:
+            part = BandStatistics(3)
+            part.update(tile)
+            merged.merge(part)
+        self.assert_matches(merged, np.stack(self.tiles))
+
+    def test_merge_moments_of_many_sets(self):
+        parts = [BandStatistics(3) for _ in self.tiles]
+        for part, tile in zip(parts, self.tiles):
+            part.update(tile)
+        stats = BandStatistics(3)
+        stats.merge_moments([p.count for p in parts], [p.mean for p in parts],
+                            [p.m2 for p in parts])
+        self.assert_matches(stats, np.stack(self.tiles))
+
+    def test_nodata_pixels_are_left_out(self):
+        tile = self.tiles[0].copy()
+        tile[:4] = 0
+        tile[4, :, 0] = 0  # nodata in one band only: still a pixel.
+        stats = BandStatistics(3)
+        stats.update(tile)
+        self.assert_matches(stats, tile[4:])
+        self.assertEqual(valid_pixels(tile).shape, (12 * 16, 3))
+
+    def test_histograms_merge_by_addition(self):
+        stats = BandStatistics(3, histogram_bins=8, histogram_range=(0, 10000))
+        for tile in self.tiles:
+            stats.update(tile)
+        pixels = np.stack(self.tiles).reshape(-1, 3)
+        for b in range(3):
+            np.testing.assert_array_equal(stats.histograms[b], np.histogram(pixels[:, b], bins=8,
+                                          range=(0, 10000))[0])
+
+    def test_standardize(self):
+        stats = BandStatistics(3)
+        stats.update(np.stack(self.tiles))
+        out = stats.standardize(self.tiles[0])
+        self.assertEqual(out.dtype, np.float32)
+        expected = (self.tiles[0] - stats.mean) / stats.std
+        np.testing.assert_allclose(out, expected, rtol=1e-4, atol=1e-4)
+
+    def test_scale_leaves_constant_bands_unscaled(self):
+        tile = self.tiles[0].copy()
+        tile[..., 1] = 7
+        stats = BandStatistics(3)
+        stats.update(tile)
+        mean, inv_std = stats.scale()
+        self.assertEqual(mean.dtype, np.float32)
+        self.assertEqual(inv_std.dtype, np.float32)
+        self.assertEqual(inv_std[1], 1)
+        np.testing.assert_allclose(inv_std[[0, 2]], 1 / stats.std[[0, 2]], rtol=1e-6)
+        np.testing.assert_array_equal(stats.standardize(tile)[..., 1], 0)
+
+    def test_save_and_load(self):
+        stats = BandStatistics(3, histogram_bins=4)
+        stats.update(self.tiles[0])
+        path = os.path.join(self.directory, 'band_stats.json')
+        stats.save(path)
+        for source in (path, self.directory):
+            loaded = load_band_statistics(source)
+            self.assertEqual(loaded.count, stats.count)
+            np.testing.assert_allclose(loaded.mean, stats.mean)
+            np.testing.assert_allclose(loaded.m2, stats.m2)
+            np.testing.assert_array_equal(loaded.histograms, stats.histograms)
+        self.assertIsNone(load_band_statistics(None))
+
+    def test_scene_pixels_count_overlaps_once(self):
+        rng = np.random.RandomState(1)
+        scene = rng.randint(1, 10000, (40, 40, 2)).astype(np.uint16)
+        pixels = ScenePixels()
+        stats = BandStatistics(2)
+        windows = [(0, 0), (8, 8), (16, 0), (24, 24), (8, 8)]
+        for x, y in windows:
+            stats.update(pixels.new_pixels((x, y, 16), scene[x:x + 16, y:y + 16]))
+        covered = np.zeros((40, 40), dtype=bool)
+        for x, y in windows:
+            covered[x:x + 16, y:y + 16] = True
+        self.assert_matches(stats, scene[covered])
+
+    def test_scene_statistics(self):
+        first, second = BandStatistics(3), BandStatistics(3)
+        first.update(self.tiles[0])
+        second.update(self.tiles[1])
+        save_scene_statistics(self.directory, '38_27_2013', first, ['b', 'a'])
+        save_scene_statistics(self.directory, '39_27_2013', second, ['c'])
+        self.assertIsNotNone(load_scene_statistics(self.directory, '38_27_2013', ['a', 'b']))
+        self.assertIsNone(load_scene_statistics(self.directory, '38_27_2013', ['a']))
+        self.assertIsNone(load_scene_statistics(self.directory, '40_27_2013'))
+        self.assert_matches(band_statistics_from_scenes(self.directory),
+                            np.stack(self.tiles[:2]))
+
+    def test_no_scene_statistics(self):
+        with self.assertRaises(ValueError):
+            band_statistics_from_scenes(self.directory)
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# ========================= EOF ====================================================================
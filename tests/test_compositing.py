@@ -0,0 +1,153 @@
+# ===============================================================================
+# Copyright 2018 dgketchum
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+from rasterio import open as rasopen
+from rasterio.crs import CRS
+from rasterio.transform import Affine
+
+# importing tests puts fully-conv-classification on the path.
+from tests import FULLY_CONV
+from compositing import MAX_NETWORK_SCENES, choose_scenes, composite, composite_scene
+
+
+def write_raster(filename, arr, transform, crs=CRS.from_epsg(32612)):
+    with rasopen(filename, 'w', driver='GTiff', height=arr.shape[0], width=arr.shape[1],
+                 count=1, dtype=arr.dtype, crs=crs, transform=transform) as dst:
+        dst.write(arr, 1)
+
+
+class CompositeTestCase(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.scenes = rng.randint(1, 10000, (5, 3, 12, 10)).astype(np.float32)
+        self.obscured = rng.random_sample((5, 12, 10)) < 0.4
+        self.obscured[:, 0, 0] = True  # no clear scene.
+        self.obscured[1:, 0, 1] = True  # a single clear scene.
+        self.masked = np.where(self.obscured[:, None], np.nan, self.scenes)
+
+    def test_reductions_match_numpy(self):
+        with np.errstate(invalid='ignore'), self.assertWarns(RuntimeWarning):
+            references = {'mean': np.nanmean(self.masked, axis=0),
+                          'median': np.nanmedian(self.masked, axis=0),
+                          'percentile': np.nanpercentile(self.masked, 20, axis=0)}
+        for method, expected in references.items():
+            out = composite(self.scenes, method, self.obscured, percentile=20)
+            self.assertEqual(out.dtype, np.float32)
+            np.testing.assert_allclose(out, expected, rtol=1e-5, err_msg=method)
+        self.assertTrue(np.all(np.isnan(out[:, 0, 0])))
+        np.testing.assert_array_equal(out[:, 0, 1], self.scenes[0, :, 0, 1])
+
+    def test_many_scenes_sort_with_numpy(self):
+        rng = np.random.RandomState(1)
+        n_scenes = MAX_NETWORK_SCENES + 3
+        scenes = rng.random_sample((n_scenes, 2, 4, 4)).astype(np.float32)
+        obscured = rng.random_sample((n_scenes, 4, 4)) < 0.5
+        expected = np.nanpercentile(np.where(obscured[:, None], np.nan, scenes), 75, axis=0)
+        np.testing.assert_allclose(composite(scenes, 'percentile', obscured, percentile=75),
+                                   expected, rtol=1e-5)
+
+    def test_max_ndvi_takes_the_greenest_clear_scene(self):
+        out = composite(self.scenes, 'max_ndvi', self.obscured, ndvi_bands=(0, 1))
+        red, nir = self.scenes[:, 0], self.scenes[:, 1]
+        ndvi = np.where(self.obscured, -np.inf, (nir - red) / (nir + red))
+        for x in range(12):
+            for y in range(10):
+                if self.obscured[:, x, y].all():
+                    self.assertTrue(np.all(np.isnan(out[:, x, y])))
+                    continue
+                best = np.argmax(ndvi[:, x, y])
+                np.testing.assert_array_equal(out[:, x, y], self.scenes[best, :, x, y])
+
+    def test_medoid_is_closest_to_the_other_clear_scenes(self):
+        choice = choose_scenes(self.masked, 'medoid')
+        for x in range(12):
+            for y in range(10):
+                clear = np.nonzero(~self.obscured[:, x, y])[0]
+                if not clear.shape[0]:
+                    self.assertEqual(choice[x, y], -1)
+                    continue
+                pixels = self.scenes[clear, :, x, y].astype(np.float64)
+                cost = [np.sqrt(np.square(pixels - p).sum(axis=1)).sum() for p in pixels]
+                self.assertAlmostEqual(np.sum(np.sqrt(np.square(
+                    pixels - self.scenes[choice[x, y], :, x, y]).sum(axis=1))),
+                    min(cost), delta=1e-2 * min(cost) + 1e-3)
+
+    def test_unknown_method(self):
+        with self.assertRaises(ValueError):
+            composite(self.scenes, 'mode')
+
+
+class CompositeSceneTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        transform = Affine(30.0, 0.0, 300000.0, 0.0, -30.0, 5200000.0)
+        rng = np.random.RandomState(0)
+        self.paths_map = {}
+        self.bands = {}
+        dates = ('2013150', '2013182', '2013214')
+        for band in ('B4.TIF', 'B5.TIF'):
+            self.paths_map[band] = []
+            self.bands[band] = []
+            for date in dates:
+                arr = rng.randint(1, 10000, (40, 24)).astype(np.uint16)
+                filename = os.path.join(self.directory, 'LC8{}_{}'.format(date, band))
+                write_raster(filename, arr, transform)
+                self.paths_map[band].append(filename)
+                self.bands[band].append(arr)
+        self.paths_map['slope.tif'] = [os.path.join(self.directory, 'slope.tif')]
+        self.slope = rng.randint(0, 90, (40, 24)).astype(np.uint16)
+        write_raster(self.paths_map['slope.tif'][0], self.slope, transform)
+        self.fmask_paths = []
+        self.obscured = rng.random_sample((3, 40, 24)) < 0.3
+        for date, obscured in zip(dates, self.obscured):
+            filename = os.path.join(self.directory, 'LC8{}_cloud_fmask.tif'.format(date))
+            write_raster(filename, obscured.astype(np.uint8), transform)
+            self.fmask_paths.append(filename)
+        with rasopen(self.paths_map['B4.TIF'][0], 'r') as src:
+            self.target_geo = src.meta.copy()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_chunked_composite_matches_whole_scene(self):
+        out, names = composite_scene(self.paths_map, self.target_geo, method='percentile',
+                                     fmask_paths=self.fmask_paths, percentile=30,
+                                     rows_per_chunk=16, n_processes=2,
+                                     temporary_directory=self.directory)
+        self.assertEqual(names, ['B4.TIF', 'B5.TIF', 'slope.tif'])
+        scenes = np.stack([np.stack(self.bands['B4.TIF']), np.stack(self.bands['B5.TIF'])],
+                          axis=1)
+        expected = composite(scenes, 'percentile', self.obscured, percentile=30)
+        np.testing.assert_allclose(out[:2], expected, rtol=1e-5)
+        np.testing.assert_array_equal(out[2], self.slope)
+        # the backing file is gone once the composite is mapped.
+        self.assertEqual(len([f for f in os.listdir(self.directory)
+                              if f.endswith('.composite')]), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# ========================= EOF ====================================================================
@@ -0,0 +1,367 @@
+# ===============================================================================
+# Copyright 2018 dgketchum
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+# importing tests puts fully-conv-classification on the path.
+from tests import FULLY_CONV
+from data_generators import (DataGenerator, RandomWindowGenerator, SatDataGenerator,
+                             balanced_pixel_mask)
+from label_encoding import LABEL_NODATA
+from tile_manifest import TileManifestWriter
+from training_cubes import load_training_cube, save_training_cube
+
+
+class IndexGenerator(SatDataGenerator):
+    ''' Batches of file "names" 0..n_files-1, decoded into arrays that
+    say which files they came from. '''
+
+    def __init__(self, n_files, batch_size, **kwargs):
+        super().__init__(batch_size, n_classes=2, **kwargs)
+        self.files = list(range(n_files))
+        self.requested = []
+
+    def __len__(self):
+        return int(np.ceil(len(self.files) / self.batch_size))
+
+    def __getitem__(self, idx):
+        return self._get_batch(idx)
+
+    def on_epoch_end(self):
+        self._reset_prefetch()
+        self.files = self.files[::-1]
+
+    def _batch_from_files(self, batch, random_state):
+        # the file index plus a draw in [0, 1), as augmentation would make.
+        features = np.repeat(np.asarray(batch, dtype=np.float64)[:, None], 100, axis=1)
+        features += random_state.random_sample(features.shape)
+        return [features], [np.asarray(batch)]
+
+
+def batch_files(batch):
+    return list(batch[1][0])
+
+
+def class_counts(labels, n_classes):
+    return np.array([[np.count_nonzero(tile == c) for c in range(n_classes)] for tile in labels])
+
+
+class PrefetchTestCase(unittest.TestCase):
+
+    def read(self, generator, order):
+        try:
+            return [batch_files(generator[idx]) for idx in order]
+        finally:
+            generator.close()
+
+    def test_prefetched_batches_match_serial(self):
+        order = list(range(7)) + [3, 0, 6, 6, 2]
+        expected = self.read(IndexGenerator(26, 4), order)
+        for backend in ('thread', 'process'):
+            generator = IndexGenerator(26, 4, prefetch_batches=3, prefetch_workers=2,
+                                       prefetch_backend=backend)
+            self.assertEqual(self.read(generator, order), expected, backend)
+
+    def test_seeded_draws_match_serial(self):
+        order = [0, 1, 2, 3, 4, 5, 6, 1]
+
+        def features(generator):
+            try:
+                return [generator[idx][0][0] for idx in order]
+            finally:
+                generator.close()
+        expected = features(IndexGenerator(26, 4, seed=3))
+        self.assertFalse(np.array_equal(expected[0] % 1, expected[2] % 1))
+        np.testing.assert_array_equal(expected[1], expected[-1])
+        for backend in ('thread', 'process'):
+            generator = IndexGenerator(26, 4, seed=3, prefetch_batches=3, prefetch_workers=2,
+                                       prefetch_backend=backend)
+            for batch, expected_batch in zip(features(generator), expected):
+                np.testing.assert_array_equal(batch, expected_batch, backend)
+
+    def test_epoch_end_drops_queued_batches(self):
+        generator = IndexGenerator(12, 4, prefetch_batches=2, prefetch_workers=2)
+        try:
+            self.assertEqual(batch_files(generator[0]), [0, 1, 2, 3])
+            generator.on_epoch_end()
+            self.assertEqual(generator._futures, {})
+            self.assertEqual(batch_files(generator[0]), [11, 10, 9, 8])
+            self.assertEqual(batch_files(generator[1]), [7, 6, 5, 4])
+        finally:
+            generator.close()
+
+    def test_queued_batches_fit_the_memory_budget(self):
+        batch_nbytes = 4 * 100 * 8 + 4 * 8
+        generator = IndexGenerator(64, 4, prefetch_batches=8, prefetch_workers=2,
+                                   prefetch_memory_bytes=3 * batch_nbytes)
+        try:
+            for idx in range(len(generator)):
+                generator[idx]
+                self.assertLessEqual(len(generator._futures), 3)
+            self.assertEqual(generator._batch_nbytes, batch_nbytes)
+        finally:
+            generator.close()
+        generator = IndexGenerator(64, 4, prefetch_batches=8, prefetch_workers=2)
+        try:
+            generator[0]
+            generator[1]
+            self.assertEqual(len(generator._futures), 8)
+        finally:
+            generator.close()
+
+    def test_unknown_backend(self):
+        with self.assertRaises(ValueError):
+            IndexGenerator(4, 2, prefetch_batches=1, prefetch_backend='fibers')
+
+
+class BalancedPixelMaskTestCase(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.n_classes = 3
+        self.labels = rng.choice([0, 0, 0, 1, 2, LABEL_NODATA], size=(4, 16, 16)).astype(np.uint8)
+        self.labels[1][self.labels[1] == 2] = 0  # a tile without class 2.
+
+    def test_keeps_min_count_of_every_present_class(self):
+        keep = balanced_pixel_mask(self.labels, self.n_classes, np.random.RandomState(1))
+        counts = class_counts(self.labels, self.n_classes)
+        min_count = counts[counts > 0].min()
+        kept = class_counts(np.where(keep, self.labels, LABEL_NODATA), self.n_classes)
+        np.testing.assert_array_equal(kept, np.where(counts > 0, min_count, 0))
+        self.assertFalse(np.any(keep & (self.labels == LABEL_NODATA)))
+
+    def test_min_count(self):
+        keep = balanced_pixel_mask(self.labels, self.n_classes, np.random.RandomState(1),
+                                   min_count=5)
+        counts = class_counts(self.labels, self.n_classes)
+        kept = class_counts(np.where(keep, self.labels, LABEL_NODATA), self.n_classes)
+        np.testing.assert_array_equal(kept, np.minimum(counts, 5))
+
+    def test_seeded(self):
+        first = balanced_pixel_mask(self.labels, self.n_classes, np.random.RandomState(7))
+        second = balanced_pixel_mask(self.labels, self.n_classes, np.random.RandomState(7))
+        np.testing.assert_array_equal(first, second)
+
+    def test_every_pixel_of_a_class_is_equally_likely(self):
+        labels = np.zeros((1, 4, 4), dtype=np.uint8)
+        labels[0, 0, :2] = 1
+        rng = np.random.RandomState(3)
+        kept = np.zeros(labels.shape)
+        n_draws = 4000
+        for _ in range(n_draws):
+            kept += balanced_pixel_mask(labels, 2, rng)
+        # 2 of the 14 class 0 pixels, and both class 1 pixels, each time.
+        np.testing.assert_array_equal(kept[labels == 1], n_draws)
+        np.testing.assert_allclose(kept[labels == 0] / n_draws, 2 / 14., atol=0.03)
+
+    def test_negative_labels_are_nodata(self):
+        labels = np.array([[[0, 1, -1, -1]]])
+        keep = balanced_pixel_mask(labels, 2)
+        np.testing.assert_array_equal(keep, [[[True, True, False, False]]])
+
+    def test_no_labels(self):
+        labels = np.full((2, 4, 4), LABEL_NODATA, dtype=np.uint8)
+        self.assertFalse(np.any(balanced_pixel_mask(labels, 2)))
+
+
+class ManifestFileListTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        # the file lists come from the manifest alone; no tile is opened.
+        with TileManifestWriter(self.directory) as writer:
+            for k in range(6):
+                writer.append({'tile': 'class_{}_data/{}.pkl'.format(k % 2, k),
+                               'class_code': k % 2, 'pixel_counts': [10 * (k % 2 == 0), k]})
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_files_come_from_the_manifest(self):
+        generator = DataGenerator(self.directory, 2, n_classes=2, training=False)
+        self.assertEqual(sorted(os.path.relpath(f, self.directory) for f in generator.files),
+                         ['class_{}_data/{}.pkl'.format(k % 2, k) for k in (0, 2, 4, 1, 3, 5)])
+        generator = DataGenerator(self.directory, 2, n_classes=2, training=False,
+                                  target_classes=[1])
+        self.assertEqual(len(generator.files), 3)
+
+    def test_sample_by_pixels(self):
+        generator = DataGenerator(self.directory, 4, n_classes=2, sample_by_pixels=True,
+                                  steps_per_epoch=50, seed=0)
+        self.assertEqual(len(generator.files), 200)
+        counts = {}
+        for f in generator.files:
+            counts[os.path.basename(f)] = counts.get(os.path.basename(f), 0) + 1
+        # tile 0 has no class 1 pixels and a third of the class 0 ones.
+        self.assertGreater(counts['0.pkl'], counts['1.pkl'])
+
+    def test_pixel_weighted_ranks_are_disjoint(self):
+        for epoch in range(3):
+            generators = [DataGenerator(self.directory, 2, n_classes=2, sample_by_pixels=True,
+                                        steps_per_epoch=10, seed=4, rank=rank, world_size=2)
+                          for rank in range(2)]
+            for _ in range(epoch):
+                for g in generators:
+                    g.on_epoch_end()
+            files = [set(g.files) for g in generators]
+            self.assertEqual([len(g.files) for g in generators], [20, 20])
+            self.assertEqual(files[0] & files[1], set())
+
+    def test_sample_by_pixels_needs_a_manifest(self):
+        os.remove(os.path.join(self.directory, 'manifest.jsonl'))
+        os.makedirs(os.path.join(self.directory, 'class_0_data'))
+        with self.assertRaises(ValueError):
+            DataGenerator(self.directory, 2, n_classes=2, sample_by_pixels=True)
+
+
+class ShardingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        # file lists only; no tile is opened.
+        for class_code, n_files in ((0, 23), (1, 11), (2, 7)):
+            class_directory = os.path.join(self.directory, 'class_{}_data'.format(class_code))
+            os.makedirs(class_directory)
+            for k in range(n_files):
+                open(os.path.join(class_directory, '{}.pkl'.format(k)), 'w').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def rank_files(self, world_size=3, epochs=3, **kwargs):
+        generators = [DataGenerator(self.directory, 2, n_classes=3, seed=5, rank=rank,
+                                    world_size=world_size, **kwargs)
+                      for rank in range(world_size)]
+        epoch_files = []
+        for _ in range(epochs):
+            epoch_files.append([list(g.files) for g in generators])
+            for g in generators:
+                g.on_epoch_end()
+        return epoch_files
+
+    def assert_disjoint_and_equal(self, epoch_files):
+        for files in epoch_files:
+            self.assertEqual(len(set(len(f) for f in files)), 1)
+            self.assertGreater(len(files[0]), 0)
+            for f in files:
+                self.assertEqual(len(set(f)), len(f))
+            union = set().union(*files)
+            self.assertEqual(len(union), sum(len(f) for f in files))
+
+    def test_ranks_are_disjoint_and_equal_length(self):
+        self.assert_disjoint_and_equal(self.rank_files())
+        self.assert_disjoint_and_equal(self.rank_files(steps_per_epoch=4))
+        self.assert_disjoint_and_equal(self.rank_files(balance=True))
+        self.assert_disjoint_and_equal(self.rank_files(balance=True, shard_by_class=True))
+
+    def test_ranks_cover_the_epoch(self):
+        (files,) = self.rank_files(epochs=1)
+        # 41 files over 3 ranks: 13 each, 2 left over.
+        self.assertEqual([len(f) for f in files], [13, 13, 13])
+
+    def test_shard_by_class_keeps_every_class_on_every_rank(self):
+        for files in self.rank_files(balance=True, shard_by_class=True):
+            for f in files:
+                classes = [os.path.basename(os.path.dirname(name)) for name in f]
+                self.assertEqual(len(set(classes)), 3)
+                self.assertEqual(len(set(classes.count(c) for c in set(classes))), 1)
+
+    def test_epochs_differ_but_repeat_with_the_seed(self):
+        first = self.rank_files(world_size=2)
+        self.assertNotEqual(first[0][0], first[1][0])
+        self.assertEqual(first, self.rank_files(world_size=2))
+
+    def test_sharding_needs_a_seed_and_a_valid_rank(self):
+        with self.assertRaises(ValueError):
+            DataGenerator(self.directory, 2, n_classes=3, rank=0, world_size=2)
+        with self.assertRaises(ValueError):
+            DataGenerator(self.directory, 2, n_classes=3, seed=1, rank=2, world_size=2)
+
+
+class RandomWindowGeneratorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        rng = np.random.RandomState(0)
+        for k, shape in enumerate([(48, 40), (32, 64)]):
+            image_stack = rng.randint(0, 10000, shape + (3,)).astype(np.uint16)
+            labels = np.ma.masked_array(np.zeros(shape, dtype=np.int64),
+                                        mask=np.ones(shape, dtype=bool))
+            # class 0 everywhere in the first cube's top half, class 2 in one
+            # corner of the second; no class 1.
+            if k == 0:
+                labels[:24] = 0
+            else:
+                labels[:8, :8] = 2
+            cdl = rng.randint(0, 255, shape + (1,)).astype(np.uint8)
+            save_training_cube(image_stack, labels, cdl, self.directory, 'train',
+                               '{}_27_2013'.format(38 + k))
+        self.cube_directory = os.path.join(self.directory, 'train')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def generator(self, **kwargs):
+        return RandomWindowGenerator(self.cube_directory, 4, 3, steps_per_epoch=5, tile_size=16,
+                                     seed=3, **kwargs)
+
+    def test_windows_are_inside_the_cubes_and_cover_their_class(self):
+        generator = self.generator()
+        self.assertEqual(len(generator.files), 20)
+        self.assertEqual(sorted(generator.classes), [0, 2])
+        for k, i, j, class_code in generator.files:
+            features, class_map, _ = load_training_cube(generator.cube_directories[k])
+            self.assertTrue(0 <= i <= class_map.shape[0] - 16)
+            self.assertTrue(0 <= j <= class_map.shape[1] - 16)
+            self.assertIn(class_code, class_map[i:i + 16, j:j + 16])
+
+    def test_batches_are_crops_of_the_cubes(self):
+        generator = self.generator(sparse_labels=True)
+        (features,), (labels,) = generator[1]
+        self.assertEqual(features.shape, (4, 16, 16, 3))
+        for n, (k, i, j, _) in enumerate(generator.files[4:8]):
+            cube_features, class_map, _ = load_training_cube(generator.cube_directories[k])
+            np.testing.assert_array_equal(features[n], cube_features[i:i + 16, j:j + 16])
+            np.testing.assert_array_equal(labels[n, ..., 0], class_map[i:i + 16, j:j + 16])
+
+    def test_training_windows_are_redrawn_every_epoch(self):
+        generator = self.generator()
+        first = list(generator.files)
+        generator.on_epoch_end()
+        self.assertNotEqual(generator.files, first)
+        self.assertEqual(first, self.generator().files)
+        validation = self.generator(training=False)
+        first = list(validation.files)
+        validation.on_epoch_end()
+        self.assertEqual(validation.files, first)
+
+    def test_tile_size_larger_than_a_cube(self):
+        with self.assertRaises(ValueError):
+            RandomWindowGenerator(self.cube_directory, 4, 3, steps_per_epoch=5, tile_size=40)
+        with self.assertRaises(ValueError):
+            RandomWindowGenerator(os.path.join(self.directory, 'scenes'), 4, 3, 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# ========================= EOF ====================================================================
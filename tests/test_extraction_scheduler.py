@@ -0,0 +1,235 @@
+# ===============================================================================
+# Copyright 2018 dgketchum
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+
+
+
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+# importing tests puts fully-conv-classification on the path.
+from tests import FULLY_CONV
+import extraction_scheduler
+from extraction_scheduler import (ExtractionJournal, extraction_jobs, job_fingerprint,
+        n_workers_for_budget, run_extraction, JOURNAL_FILE)
+
+# jobs the fake extraction fails, as (path, row, year, split).
+FAILING = set()
+
+
+def fake_extraction(split_shapefiles, path, row, year, image_directory,
+        training_root_directory, n_classes, assign_shapefile_class_code, tile_format):
+    # runs in the worker processes, so calls are recorded on disk.
+    split, = split_shapefiles
+    job = (path, row, year, split)
+    with open(os.path.join(training_root_directory, 'calls.txt'), 'a') as f:
+        f.write(json.dumps(list(job)) + '\n')
+    return job not in FAILING
+
+
+class ExtractionJournalTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, JOURNAL_FILE)
+
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+    def test_done_only_counts_finished_jobs(self):
+        journal = ExtractionJournal(self.path)
+        self.assertEqual(journal.done(), {})
+        journal.append((37, 28, 2013, 'train'), 'done', fingerprint='a', seconds=1.0)
+        journal.append((37, 28, 2013, 'test'), 'failed', fingerprint='b', error='boom')
+        journal.append((38, 27, 2013, 'train'), 'done')
+        journal.append((37, 28, 2013, 'train'), 'done', fingerprint='c')
+        self.assertEqual(journal.done(), {(37, 28, 2013, 'train'): 'c',
+                                          (38, 27, 2013, 'train'): None})
+
+
+    def test_line_cut_short_is_ignored(self):
+        journal = ExtractionJournal(self.path)
+        journal.append((37, 28, 2013, 'train'), 'done')
+        with open(self.path, 'a') as f:
+            f.write('{"job": [38, 27, 2013, "tr')
+        self.assertEqual(set(journal.done()), {(37, 28, 2013, 'train')})
+
+
+class RunExtractionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.root = os.path.join(self.directory, 'training')
+        self.calls_file = os.path.join(self.root, 'calls.txt')
+        self.shapefiles = {}
+        for name in ('irrigated_37_28', 'fallow_37_28', 'irrigated_38_27'):
+            for ext in ('.shp', '.dbf'):
+                with open(os.path.join(self.directory, name + ext), 'w') as f:
+                    f.write(name)
+            self.shapefiles[name] = os.path.join(self.directory, name + '.shp')
+        self.scenes = {(37, 28, 2013): {'train': [self.shapefiles['irrigated_37_28']],
+                                        'test': [self.shapefiles['fallow_37_28']]},
+                       (38, 27, 2013): {'train': [self.shapefiles['irrigated_38_27']]}}
+        # worker processes are forked, so they see the patched module.
+        self.extract = extraction_scheduler.extract_training_data_over_path_row
+        extraction_scheduler.extract_training_data_over_path_row = fake_extraction
+        FAILING.clear()
+
+
+    def tearDown(self):
+        extraction_scheduler.extract_training_data_over_path_row = self.extract
+        FAILING.clear()
+        shutil.rmtree(self.directory)
+
+
+    def _run(self, n_classes=4, **kwargs):
+        if os.path.isfile(self.calls_file):
+            os.remove(self.calls_file)
+        failed = run_extraction(self.scenes, 'images', self.root, n_classes, 2, 1, max_workers=2,
+                                **kwargs)
+        calls = []
+        if os.path.isfile(self.calls_file):
+            with open(self.calls_file) as f:
+                calls = [tuple(json.loads(line)) for line in f]
+        return failed, sorted(calls)
+
+
+    def test_resume_skips_done_jobs(self):
+        failed, calls = self._run()
+        self.assertEqual(failed, [])
+        self.assertEqual(calls, [(37, 28, 2013, 'test'), (37, 28, 2013, 'train'),
+                                 (38, 27, 2013, 'train')])
+        failed, calls = self._run()
+        self.assertEqual(failed, [])
+        self.assertEqual(calls, [])
+
+
+    def test_failed_jobs_are_retried(self):
+        FAILING.add((37, 28, 2013, 'test'))
+        failed, calls = self._run()
+        self.assertEqual(failed, [(37, 28, 2013, 'test')])
+        self.assertEqual(len(calls), 3)
+        FAILING.clear()
+        failed, calls = self._run()
+        self.assertEqual(failed, [])
+        self.assertEqual(calls, [(37, 28, 2013, 'test')])
+        journal = ExtractionJournal(os.path.join(self.root, JOURNAL_FILE))
+        self.assertEqual(len(journal.done()), 3)
+
+
+    def test_interrupted_job_is_redone(self):
+        # a job that was running when the run died has no journal line.
+        os.makedirs(self.root)
+        journal = ExtractionJournal(os.path.join(self.root, JOURNAL_FILE))
+        for scene in ((37, 28, 2013), (38, 27, 2013)):
+            fingerprint = job_fingerprint(self.scenes[scene]['train'], 'images', 4, 'pickle')
+            journal.append(scene + ('train',), 'done', fingerprint=fingerprint)
+        failed, calls = self._run()
+        self.assertEqual(calls, [(37, 28, 2013, 'test')])
+
+
+    def test_changed_shapefile_is_redone(self):
+        self._run()
+        shapefile = self.shapefiles['irrigated_38_27']
+        later = os.path.getmtime(shapefile) + 10
+        os.utime(shapefile, (later, later))
+        failed, calls = self._run()
+        self.assertEqual(calls, [(38, 27, 2013, 'train')])
+        with open(os.path.splitext(shapefile)[0] + '.dbf', 'a') as f:
+            f.write('another record')
+        failed, calls = self._run()
+        self.assertEqual(calls, [(38, 27, 2013, 'train')])
+        self.assertEqual(self._run()[1], [])
+
+
+    def test_changed_parameters_redo_every_job(self):
+        self._run()
+        failed, calls = self._run(n_classes=3)
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(self._run(n_classes=3)[1], [])
+        failed, calls = self._run(n_classes=3, tile_format='cube')
+        self.assertEqual(len(calls), 3)
+
+
+    def test_added_shapefile_is_redone(self):
+        self._run()
+        self.scenes[(37, 28, 2013)]['train'].append(self.shapefiles['irrigated_38_27'])
+        failed, calls = self._run()
+        self.assertEqual(calls, [(37, 28, 2013, 'train')])
+
+
+    def test_entries_without_fingerprint_are_redone(self):
+        # journals written before jobs were fingerprinted.
+        os.makedirs(self.root)
+        journal = ExtractionJournal(os.path.join(self.root, JOURNAL_FILE))
+        journal.append((38, 27, 2013, 'train'), 'done')
+        failed, calls = self._run()
+        self.assertEqual(len(calls), 3)
+
+
+    def test_rerun_ignores_the_journal(self):
+        self._run()
+        failed, calls = self._run(rerun=True)
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(self._run()[1], [])
+
+
+    def test_sharded_formats_run_on_one_process(self):
+        for tile_format in ('store', 'tfrecord'):
+            with self.assertRaises(ValueError):
+                run_extraction(self.scenes, 'images', self.root, 4, 2, 1,
+                        tile_format=tile_format, max_workers=2)
+        self.assertFalse(os.path.isfile(self.calls_file))
+        failed = run_extraction(self.scenes, 'images', self.root, 4, 2, 1, tile_format='store')
+        self.assertEqual(failed, [])
+
+
+class SchedulingTestCase(unittest.TestCase):
+
+    def test_workers_fit_the_memory_budget(self):
+        self.assertEqual(n_workers_for_budget(32, 4, max_workers=16), 8)
+        self.assertEqual(n_workers_for_budget(32, 4, max_workers=3), 3)
+        # one job always runs, even over budget.
+        self.assertEqual(n_workers_for_budget(2, 4, max_workers=3), 1)
+
+
+    def test_jobs_grouped_by_scene(self):
+        directory = tempfile.mkdtemp()
+        try:
+            names = {'train': ['irrigated_37_28', 'fallow_37_28', 'irrigated_38_27'],
+                     'test': ['irrigated_37_28']}
+            for split, basenames in names.items():
+                os.makedirs(os.path.join(directory, split))
+                for name in basenames:
+                    open(os.path.join(directory, split, name + '.shp'), 'w').close()
+            scenes = extraction_jobs(directory, assign_shapefile_year=lambda f: 2013)
+            self.assertEqual(set(scenes), {(37, 28, 2013), (38, 27, 2013)})
+            self.assertEqual(set(scenes[(37, 28, 2013)]), {'test', 'train'})
+            self.assertEqual(sorted(os.path.basename(f) for f in scenes[(37, 28, 2013)]['train']),
+                    ['fallow_37_28.shp', 'irrigated_37_28.shp'])
+            self.assertEqual(set(scenes[(38, 27, 2013)]), {'train'})
+        finally:
+            shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# ========================= EOF ====================================================================
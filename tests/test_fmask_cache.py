@@ -0,0 +1,117 @@
+# ===============================================================================
+# Copyright 2018 dgketchum
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+from rasterio import open as rasopen
+from rasterio.crs import CRS
+from rasterio.transform import Affine
+
+# importing tests puts fully-conv-classification on the path.
+from tests import FULLY_CONV
+from fmask_cache import load_combined_fmask, fmask_paths, _cache_files
+
+
+def write_raster(filename, arr, transform, crs=CRS.from_epsg(32612)):
+    with rasopen(filename, 'w', driver='GTiff', height=arr.shape[0], width=arr.shape[1],
+                 count=1, dtype=arr.dtype, crs=crs, transform=transform) as dst:
+        dst.write(arr, 1)
+
+
+class FmaskCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        # a width that isn't a multiple of 8 exercises the bit packing padding.
+        self.transform = Affine(30.0, 0.0, 300000.0, 0.0, -30.0, 5200000.0)
+        rng = np.random.RandomState(0)
+        self.fmasks = []
+        self.paths = []
+        for date in ('2013150', '2013182'):
+            os.makedirs(os.path.join(self.directory, date))
+            # 0 clear, 1 obscured, 2 anything else fmask reports.
+            fmask = rng.randint(0, 3, (19, 21)).astype(np.uint8)
+            filename = os.path.join(self.directory, date, 'LC8{}_cloud_fmask.tif'.format(date))
+            write_raster(filename, fmask, self.transform)
+            self.fmasks.append(fmask)
+            self.paths.append(filename)
+        with rasopen(self.paths[0], 'r') as src:
+            self.target_geo = src.meta.copy()
+        self.union = np.any(np.stack(self.fmasks) == 1, axis=0)
+
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+    def test_finds_fmasks(self):
+        self.assertEqual(fmask_paths(self.directory), sorted(self.paths))
+
+
+    def test_unpacked_union(self):
+        combined = load_combined_fmask(self.directory, self.target_geo)
+        self.assertEqual(combined.dtype, bool)
+        np.testing.assert_array_equal(combined, self.union)
+        # the cached copy unpacks to the same mask.
+        np.testing.assert_array_equal(load_combined_fmask(self.directory, self.target_geo),
+                self.union)
+
+
+    def test_window(self):
+        load_combined_fmask(self.directory, self.target_geo)
+        for window in [(0, 0, 19, 21), (3, 5, 7, 9), (2, 8, 4, 8), (10, 13, 9, 8)]:
+            row_off, col_off, height, width = window
+            np.testing.assert_array_equal(
+                    load_combined_fmask(self.directory, self.target_geo, window=window),
+                    self.union[row_off:row_off + height, col_off:col_off + width])
+
+
+    def test_cache_reused_until_an_fmask_changes(self):
+        load_combined_fmask(self.directory, self.target_geo)
+        cache_file, sidecar = _cache_files(self.directory, self.target_geo)
+        self.assertTrue(os.path.isfile(cache_file))
+        self.assertTrue(os.path.isfile(sidecar))
+        # overwrite the cache; an unchanged scene must not rebuild it.
+        np.save(cache_file, np.zeros((19, 3), dtype=np.uint8))
+        self.assertFalse(load_combined_fmask(self.directory, self.target_geo).any())
+
+        fmask = np.ones((19, 21), dtype=np.uint8)
+        write_raster(self.paths[1], fmask, self.transform)
+        mtime = os.path.getmtime(self.paths[1]) + 10
+        os.utime(self.paths[1], (mtime, mtime))
+        self.assertTrue(load_combined_fmask(self.directory, self.target_geo).all())
+
+
+    def test_no_fmasks(self):
+        empty = tempfile.mkdtemp()
+        try:
+            combined = load_combined_fmask(empty, self.target_geo)
+            self.assertEqual(combined.shape, (19, 21))
+            self.assertFalse(combined.any())
+        finally:
+            shutil.rmtree(empty)
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# ========================= EOF ====================================================================
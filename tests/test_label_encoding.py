@@ -0,0 +1,66 @@
+# ===============================================================================
+# Copyright 2018 dgketchum
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+
+
+import unittest
+
+import numpy as np
+
+# importing tests puts fully-conv-classification on the path.
+from tests import FULLY_CONV
+from label_encoding import (LABEL_NODATA, class_map_from_labels, class_map_from_one_hot,
+                            one_hot_from_class_map, tile_class_map)
+
+
+class LabelEncodingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.n_classes = 4
+        self.class_map = rng.randint(0, self.n_classes, (3, 8, 8)).astype(np.uint8)
+        self.class_map[:, :2] = LABEL_NODATA
+
+    def test_one_hot_matches_reference(self):
+        one_hot = one_hot_from_class_map(self.class_map, self.n_classes)
+        self.assertEqual(one_hot.shape, self.class_map.shape + (self.n_classes,))
+        self.assertEqual(one_hot.dtype, np.float32)
+        reference = np.zeros(one_hot.shape, dtype=np.float32)
+        for c in range(self.n_classes):
+            reference[..., c] = self.class_map == c
+        np.testing.assert_array_equal(one_hot, reference)
+
+    def test_nodata_and_unknown_codes_are_all_zeros(self):
+        class_map = np.array([LABEL_NODATA, self.n_classes, 0], dtype=np.uint8)
+        one_hot = one_hot_from_class_map(class_map, self.n_classes, dtype=np.uint8)
+        self.assertEqual(one_hot.dtype, np.uint8)
+        np.testing.assert_array_equal(one_hot.sum(axis=-1), [0, 0, 1])
+
+    def test_round_trip(self):
+        one_hot = one_hot_from_class_map(self.class_map, self.n_classes)
+        np.testing.assert_array_equal(class_map_from_one_hot(one_hot), self.class_map)
+        self.assertIs(tile_class_map({'class_map': self.class_map}), self.class_map)
+        np.testing.assert_array_equal(tile_class_map({'one_hot': one_hot}), self.class_map)
+
+    def test_class_map_from_masked_labels(self):
+        labels = np.ma.masked_array([[0, 1], [2, 3]], mask=[[False, True], [False, False]])
+        np.testing.assert_array_equal(class_map_from_labels(labels),
+                                      [[0, LABEL_NODATA], [2, 3]])
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# ========================= EOF ====================================================================
@@ -0,0 +1,124 @@
+# ===============================================================================
+# Copyright 2018 dgketchum
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import geopandas as gpd
+import numpy as np
+from rasterio.transform import Affine
+from shapely.geometry import Point, box
+
+# importing tests puts fully-conv-classification on the path.
+from tests import FULLY_CONV
+from label_encoding import LABEL_NODATA
+from label_rasters import masked_class_labels, rasterize_class_labels
+
+TRANSFORM = Affine(30.0, 0.0, 300000.0, 0.0, -30.0, 5200000.0)
+TARGET_GEO = {'crs': {'init': 'epsg:32612'}, 'transform': TRANSFORM, 'height': 20, 'width': 30}
+
+
+def pixel_box(row0, col0, row1, col1):
+    # the polygon covering pixels [row0, row1) x [col0, col1), shrunk a little
+    # so that only those pixel centres fall inside.
+    x0, y0 = TRANSFORM * (col0 + 0.1, row0 + 0.1)
+    x1, y1 = TRANSFORM * (col1 - 0.1, row1 - 0.1)
+    return box(min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1))
+
+
+def brute_force(polygons_by_code):
+    # every pixel centre tested against every polygon, later polygons winning.
+    class_map = np.full((20, 30), LABEL_NODATA, dtype=np.uint8)
+    for code, polygons in polygons_by_code:
+        for row in range(20):
+            for col in range(30):
+                if any(p.contains(Point(TRANSFORM * (col + 0.5, row + 0.5))) for p in polygons):
+                    class_map[row, col] = code
+    return class_map
+
+
+class LabelRastersTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.polygons = {'irrigated': [pixel_box(0, 0, 10, 12), pixel_box(15, 20, 20, 30)],
+                         'unirrigated': [pixel_box(5, 8, 18, 16)],
+                         'fallow': [pixel_box(2, 25, 8, 29)]}
+        self.codes = {'irrigated': 0, 'unirrigated': 1, 'fallow': 3}
+        self.shapefiles = []
+        for name in ('irrigated', 'unirrigated', 'fallow'):
+            shapefile = os.path.join(self.directory, '{}.shp'.format(name))
+            # stored in geographic coordinates, so they're reprojected to the grid.
+            gpd.GeoDataFrame(geometry=self.polygons[name], crs='EPSG:32612').to_crs(
+                'EPSG:4326').to_file(shapefile)
+            self.shapefiles.append(shapefile)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def class_code(self, shapefile):
+        return self.codes[os.path.splitext(os.path.basename(shapefile))[0]]
+
+    def test_one_pass_matches_brute_force(self):
+        class_map = rasterize_class_labels(self.shapefiles, self.class_code, TARGET_GEO)
+        self.assertEqual(class_map.dtype, np.uint8)
+        expected = brute_force([(self.codes[n], self.polygons[n])
+                                for n in ('irrigated', 'unirrigated', 'fallow')])
+        np.testing.assert_array_equal(class_map, expected)
+
+    def test_class_priority_decides_overlaps(self):
+        class_map = rasterize_class_labels(self.shapefiles, self.class_code, TARGET_GEO,
+                                           class_priority=[1, 3, 0])
+        expected = brute_force([(self.codes[n], self.polygons[n])
+                                for n in ('unirrigated', 'fallow', 'irrigated')])
+        np.testing.assert_array_equal(class_map, expected)
+        # the overlap of the first two shapefiles is irrigated now.
+        self.assertEqual(class_map[7, 9], 0)
+
+    def test_no_shapefiles(self):
+        class_map = rasterize_class_labels([], self.class_code, TARGET_GEO)
+        self.assertTrue(np.all(class_map == LABEL_NODATA))
+
+    def test_cache_follows_the_shapefiles(self):
+        cache_directory = os.path.join(self.directory, 'cache')
+        first = rasterize_class_labels(self.shapefiles, self.class_code, TARGET_GEO,
+                                       cache_directory=cache_directory)
+        self.assertEqual(len(os.listdir(cache_directory)), 1)
+        np.testing.assert_array_equal(rasterize_class_labels(
+            self.shapefiles, self.class_code, TARGET_GEO, cache_directory=cache_directory), first)
+        self.assertEqual(len(os.listdir(cache_directory)), 1)
+        gpd.GeoDataFrame(geometry=[pixel_box(0, 0, 2, 2)], crs='EPSG:32612').to_file(
+            self.shapefiles[2])
+        changed = rasterize_class_labels(self.shapefiles, self.class_code, TARGET_GEO,
+                                         cache_directory=cache_directory)
+        self.assertEqual(len(os.listdir(cache_directory)), 2)
+        self.assertEqual(changed[0, 0], 3)
+        self.assertEqual(changed[3, 26], LABEL_NODATA)
+
+    def test_masked_class_labels(self):
+        class_map = np.array([[0, LABEL_NODATA], [2, 1]], dtype=np.uint8)
+        labels = masked_class_labels(class_map)
+        self.assertEqual(labels.shape, (1, 2, 2))
+        np.testing.assert_array_equal(labels.mask, [[[False, True], [False, False]]])
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# ========================= EOF ====================================================================
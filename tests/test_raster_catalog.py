@@ -0,0 +1,112 @@
+# ===============================================================================
+# Copyright 2018 dgketchum
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+
+
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+
+# importing tests puts fully-conv-classification on the path.
+from tests import FULLY_CONV
+from raster_catalog import CATALOG_DIRECTORY, RasterCatalog, raster_catalog
+
+SCENES = ('LC80380272013150LGN00', 'LC80380272013182LGN00')
+
+
+def touch(filename):
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    open(filename, 'w').close()
+
+
+class RasterCatalogTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.image_directory = os.path.join(self.root, '38_27_2013')
+        for scene in SCENES:
+            for band in ('B1.TIF', 'B10.TIF', 'B4.TIF'):
+                touch(os.path.join(self.image_directory, scene, '{}_{}'.format(scene, band)))
+        touch(os.path.join(self.image_directory, SCENES[0], 'cloud_fmask.tif'))
+        touch(os.path.join(self.image_directory, 'slope.tif'))
+        touch(os.path.join(self.image_directory, 'notes.txt'))
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_scan_describes_rasters(self):
+        with RasterCatalog(self.root) as catalog:
+            self.assertEqual(catalog.scan(), (8, 0))
+            self.assertEqual(len(catalog), 8)
+            b1 = catalog.query(self.image_directory, ['B1.TIF'])
+            self.assertEqual([r.filepath for r in b1], [os.path.join(self.image_directory, s,
+                             '{}_B1.TIF'.format(s)) for s in SCENES])
+            first = b1[0]
+            self.assertEqual((first.path, first.row, first.year), (38, 27, 2013))
+            self.assertEqual(first.sensor, 'LC8')
+            self.assertEqual(first.acquisition_date, datetime.date(2013, 5, 30))
+            self.assertEqual(first.scene_directory, os.path.join('38_27_2013', SCENES[0]))
+            # B10 isn't filed as B1.
+            self.assertEqual(len(catalog.query(bands=['B10.TIF'])), 2)
+            static = catalog.query(bands=['slope.tif'])
+            self.assertEqual([r.sensor for r in static], ['static'])
+
+    def test_query_filters(self):
+        with RasterCatalog(self.root) as catalog:
+            catalog.scan()
+            date = datetime.date(2013, 7, 1)
+            rasters = catalog.query(self.image_directory, acquisition_date=date)
+            self.assertEqual(sorted(r.band for r in rasters), ['B1.TIF', 'B10.TIF', 'B4.TIF'])
+            self.assertEqual(catalog.query(self.image_directory, recursive=False,
+                                           bands=['slope.tif'])[0].band, 'slope.tif')
+            self.assertEqual(catalog.query(os.path.join(self.image_directory, SCENES[1]),
+                                           bands=['cloud_fmask.tif']), [])
+            band_map = catalog.band_paths(self.image_directory, ['B4.TIF', 'B2.TIF'])
+            self.assertEqual(len(band_map['B4.TIF']), 2)
+            self.assertEqual(band_map['B2.TIF'], [])
+            with self.assertRaises(ValueError):
+                catalog.query(self.image_directory, cloud_cover=10)
+            with self.assertRaises(ValueError):
+                catalog.query(tempfile.gettempdir())
+
+    def test_incremental_scan(self):
+        with RasterCatalog(self.root) as catalog:
+            catalog.scan()
+            self.assertEqual(catalog.scan(), (0, 0))
+            scene = os.path.join(self.image_directory, SCENES[1])
+            touch(os.path.join(scene, '{}_B5.TIF'.format(SCENES[1])))
+            os.remove(os.path.join(scene, '{}_B1.TIF'.format(SCENES[1])))
+            # mtimes can be too coarse to tell the two listings apart.
+            os.utime(scene, (0, 0))
+            self.assertEqual(catalog.scan(), (1, 1))
+            shutil.rmtree(os.path.join(self.image_directory, SCENES[0]))
+            self.assertEqual(catalog.scan(), (0, 4))
+            self.assertEqual(len(catalog), 4)
+
+    def test_raster_catalog_finds_the_catalog_above(self):
+        raster_catalog(self.root)
+        self.assertTrue(os.path.isdir(os.path.join(self.root, CATALOG_DIRECTORY)))
+        catalog = raster_catalog(self.image_directory)
+        self.assertEqual(catalog.root, os.path.abspath(self.root))
+        self.assertFalse(os.path.isdir(os.path.join(self.image_directory, CATALOG_DIRECTORY)))
+        catalog.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# ========================= EOF ====================================================================
@@ -0,0 +1,112 @@
+# ===============================================================================
+# Copyright 2018 dgketchum
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+from rasterio import open as rasopen
+from rasterio.crs import CRS
+from rasterio.transform import Affine
+
+# importing tests puts fully-conv-classification on the path.
+from tests import FULLY_CONV
+from scene_cube import open_scene_cube, scene_cube
+from tile_manifest import tile_id
+
+
+def write_raster(filename, arr, transform, crs=CRS.from_epsg(32612)):
+    with rasopen(filename, 'w', driver='GTiff', height=arr.shape[0], width=arr.shape[1],
+                 count=1, dtype=arr.dtype, crs=crs, transform=transform) as dst:
+        dst.write(arr, 1)
+
+
+class SceneCubeTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.transform = Affine(30.0, 0.0, 300000.0, 0.0, -30.0, 5200000.0)
+        rng = np.random.RandomState(0)
+        self.paths_map = {}
+        for band in ('B2.TIF', 'B3.TIF', 'B4.TIF'):
+            self.paths_map[band] = []
+            for date in ('2013150', '2013182'):
+                filename = os.path.join(self.directory, 'LC8{}_{}'.format(date, band))
+                write_raster(filename, rng.randint(0, 1000, (64, 48)).astype(np.uint16),
+                             self.transform)
+                self.paths_map[band].append(filename)
+        with rasopen(self.paths_map['B2.TIF'][0], 'r') as src:
+            self.target_geo = src.meta.copy()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _band_names(self, paths_map):
+        with open_scene_cube(self.directory, paths_map, self.target_geo) as stack:
+            return list(stack.band_names)
+
+    def _tile_id(self, paths_map):
+        class_map = np.zeros((16, 16), dtype=np.uint8)
+        return tile_id(38, 27, 2013, window=(0, 0, 16), class_map=class_map,
+                       bands=self._band_names(paths_map))
+
+    def test_cube_matches_sources(self):
+        with open_scene_cube(self.directory, self.paths_map, self.target_geo) as stack:
+            self.assertEqual(stack.band_names, ['B2.TIF'] * 2 + ['B3.TIF'] * 2 + ['B4.TIF'] * 2)
+            cube = stack.read()
+        sources = []
+        for band in sorted(self.paths_map):
+            for filename in sorted(self.paths_map[band]):
+                with rasopen(filename, 'r') as src:
+                    sources.append(src.read(1))
+        np.testing.assert_array_equal(cube, np.stack(sources))
+
+    def test_cube_rebuilt_when_a_source_changes(self):
+        cube_file = scene_cube(self.directory, self.paths_map, self.target_geo)
+        mtime = os.path.getmtime(cube_file)
+        self.assertEqual(scene_cube(self.directory, self.paths_map, self.target_geo), cube_file)
+        self.assertEqual(os.path.getmtime(cube_file), mtime)
+
+        filename = self.paths_map['B3.TIF'][1]
+        write_raster(filename, np.full((64, 48), 7, dtype=np.uint16), self.transform)
+        later = os.path.getmtime(filename) + 10
+        os.utime(filename, (later, later))
+        with open_scene_cube(self.directory, self.paths_map, self.target_geo) as stack:
+            cube = stack.read()
+        np.testing.assert_array_equal(cube[3], 7)
+
+    def test_tile_id_follows_cube_bands(self):
+        tid = self._tile_id(self.paths_map)
+        self.assertEqual(tid, self._tile_id(self.paths_map))
+
+        dropped = dict((k, v) for k, v in self.paths_map.items() if k != 'B3.TIF')
+        self.assertNotEqual(tid, self._tile_id(dropped))
+
+        added = dict(self.paths_map)
+        added['B5.TIF'] = self.paths_map['B4.TIF'][:1]
+        self.assertNotEqual(tid, self._tile_id(added))
+
+        renamed = dict(self.paths_map)
+        renamed['B1.TIF'] = renamed.pop('B4.TIF')
+        self.assertNotEqual(tid, self._tile_id(renamed))
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# ========================= EOF ====================================================================
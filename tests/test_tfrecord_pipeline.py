@@ -0,0 +1,167 @@
+# ===============================================================================
+# Copyright 2018 dgketchum
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+# importing tests puts fully-conv-classification on the path.
+from tests import FULLY_CONV
+from label_encoding import LABEL_NODATA, one_hot_from_class_map
+from runspec import cdl_crop_values
+from tile_manifest import TileManifestWriter, tile_record
+from band_statistics import BandStatistics
+
+try:
+    import tensorflow as tf
+    from tfrecord_pipeline import TFRecordTileWriter, count_tiles, load_index, make_dataset
+except ImportError:
+    tf = None
+
+
+def make_tiles(n, seed=0):
+    rng = np.random.RandomState(seed)
+    tiles = []
+    for k in range(n):
+        class_map = rng.randint(0, 3, (8, 8)).astype(np.uint8)
+        class_map[0] = LABEL_NODATA
+        tiles.append({'data': rng.randint(0, 10000, (8, 8, 3)).astype(np.uint16),
+                      'class_map': class_map,
+                      'cdl': rng.choice([1, 5, 61, 176], size=(8, 8)).astype(np.uint8),
+                      'class_code': k % 3})
+    return tiles
+
+
+@unittest.skipIf(tf is None, 'needs tensorflow')
+class TFRecordPipelineTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.tiles = make_tiles(7)
+        with TFRecordTileWriter(self.directory, tiles_per_shard=4) as writer:
+            for tile in self.tiles:
+                writer.add(tile)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def batches(self, **kwargs):
+        dataset = make_dataset(self.directory, 7, 3, training=False, cycle_length=1, **kwargs)
+        return list(dataset.as_numpy_iterator())
+
+    def test_index_counts_tiles_per_shard(self):
+        self.assertEqual(count_tiles(self.directory), 7)
+        self.assertEqual(sorted(load_index(self.directory)['shards'].values()), [3, 4])
+
+    def test_round_trip(self):
+        (batch,) = self.batches(use_cdl=True)
+        (features,), (labels, cdl) = batch
+        np.testing.assert_array_equal(features, np.stack([t['data'] for t in self.tiles]))
+        class_maps = np.stack([t['class_map'] for t in self.tiles])
+        np.testing.assert_array_equal(labels, one_hot_from_class_map(class_maps, 3))
+        crop = list(cdl_crop_values().keys())
+        np.testing.assert_array_equal(cdl, np.isin(np.stack([t['cdl'] for t in self.tiles]),
+                                                   crop))
+
+    def test_sparse_labels(self):
+        (batch,) = self.batches(sparse_labels=True)
+        (_,), (labels,) = batch
+        np.testing.assert_array_equal(labels[..., 0],
+                                      np.stack([t['class_map'] for t in self.tiles]))
+
+    def test_irrigated_weights(self):
+        (batch,) = self.batches(apply_irrigated_weights=True)
+        (_,), (labels,) = batch
+        expected = one_hot_from_class_map(np.stack([t['class_map'] for t in self.tiles]), 3)
+        expected[..., 0] *= 50
+        np.testing.assert_array_equal(labels, expected)
+        with self.assertRaises(ValueError):
+            self.batches(sparse_labels=True, apply_irrigated_weights=True)
+
+    def test_manifest_selects_live_tiles(self):
+        # a re-extraction appends the changed tiles to new shards; the
+        # replaced ones stay in the old shards but not in the manifest.
+        directory = os.path.join(self.directory, 'incremental')
+        tiles = make_tiles(6, seed=1)
+        for k, tile in enumerate(tiles):
+            tile['tile_id'] = 'tile{}'.format(k)
+
+        def extract(tiles):
+            with TileManifestWriter(directory, scene='38_27_2013', overwrite=True) as manifest, \
+                    TFRecordTileWriter(directory, tiles_per_shard=2) as writer:
+                for k, tile in enumerate(tiles):
+                    shard = writer.add(tile)
+                    manifest.append(tile_record(tile, shard, 3, 38, 27, 2013, (0, 8 * k, 8), [1]))
+        extract(tiles[:4])
+        extract([tiles[0], tiles[4], tiles[2], tiles[5]])
+        self.assertEqual(count_tiles(directory), 4)
+        dataset = make_dataset(directory, 10, 3, training=False, cycle_length=1,
+                               sparse_labels=True)
+        (batch,) = list(dataset.as_numpy_iterator())
+        (features,), (labels,) = batch
+        expected = [tiles[k]['data'] for k in (0, 2, 4, 5)]
+        self.assertEqual(len(features), 4)
+        self.assertEqual(sorted(f.tobytes() for f in features),
+                         sorted(e.tobytes() for e in expected))
+
+    def test_band_statistics_standardize_features(self):
+        stats = BandStatistics(3)
+        stats.update(np.stack([t['data'] for t in self.tiles]))
+        (batch,) = self.batches(band_statistics=stats)
+        (features,), _ = batch
+        self.assertEqual(features.dtype, np.float32)
+        expected = stats.standardize(np.stack([t['data'] for t in self.tiles]))
+        np.testing.assert_allclose(features, expected, rtol=1e-5, atol=1e-5)
+
+    def test_ranks_read_disjoint_shards(self):
+        directory = os.path.join(self.directory, 'sharded')
+        tiles = make_tiles(10, seed=2)
+        with TFRecordTileWriter(directory, tiles_per_shard=2) as writer:
+            for tile in tiles:
+                writer.add(tile)
+        seen = []
+        for rank in range(2):
+            dataset = make_dataset(directory, 10, 3, training=False, cycle_length=1,
+                                   rank=rank, world_size=2)
+            (batch,) = list(dataset.as_numpy_iterator())
+            seen.append(set(f.tobytes() for f in batch[0][0]))
+        self.assertEqual(seen[0] & seen[1], set())
+        self.assertEqual(seen[0] | seen[1], set(t['data'].tobytes() for t in tiles))
+        with self.assertRaises(ValueError):
+            make_dataset(directory, 2, 3, rank=2, world_size=2)
+        with self.assertRaises(ValueError):
+            make_dataset(directory, 2, 3, rank=0, world_size=6)
+
+    def test_writer_needs_class_maps(self):
+        tile = dict(self.tiles[0])
+        del tile['class_map']
+        with TFRecordTileWriter(self.directory) as writer:
+            with self.assertRaises(ValueError):
+                writer.add(tile)
+
+    def test_empty_directory(self):
+        with self.assertRaises(ValueError):
+            make_dataset(os.path.join(self.directory, 'empty'), 2, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# ========================= EOF ====================================================================
@@ -0,0 +1,99 @@
+# ===============================================================================
+# Copyright 2018 dgketchum
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+
+
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+# importing tests puts fully-conv-classification on the path.
+from tests import FULLY_CONV
+from tile_cache import TileCache
+
+
+def make_tile(value, nbytes=1000):
+    return {'data': np.full(nbytes, value, dtype=np.uint8), 'class_code': 0}
+
+
+class TileCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_least_recently_used_tile_is_evicted(self):
+        cache = TileCache(max_bytes=2500)
+        for key in 'abc':
+            cache.put(key, make_tile(ord(key)))
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('b')['data'][0], ord('b'))
+        cache.put('d', make_tile(ord('d')))
+        # b was read after c was added, so c went.
+        self.assertIsNone(cache.get('c'))
+        self.assertIsNotNone(cache.get('b'))
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['n_tiles']), (2, 2, 2))
+        self.assertEqual(stats['nbytes'], 2000)
+
+    def test_oversized_tile_is_not_cached(self):
+        cache = TileCache(max_bytes=500)
+        cache.put('a', make_tile(1))
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.nbytes, 0)
+
+    def test_put_copies_memmaps(self):
+        filename = os.path.join(self.directory, 'tile.bin')
+        data = np.memmap(filename, dtype=np.uint8, mode='w+', shape=(100,))
+        cache = TileCache(max_bytes=1000)
+        cache.put('a', {'data': data})
+        self.assertNotIsInstance(cache.get('a')['data'], np.memmap)
+
+    def test_evicted_tiles_spill_and_come_back(self):
+        spill_directory = os.path.join(self.directory, 'spill')
+        cache = TileCache(max_bytes=1500, spill_directory=spill_directory,
+                          spill_max_bytes=1000)
+        for key in 'abc':
+            cache.put(key, make_tile(ord(key)))
+        # a was spilled, then pushed out of the spill budget by b.
+        self.assertEqual(len(os.listdir(spill_directory)), 1)
+        self.assertIsNone(cache.get('a'))
+        tile = cache.get('b')
+        np.testing.assert_array_equal(tile['data'], make_tile(ord('b'))['data'])
+        self.assertEqual(cache.stats()['spill_hits'], 1)
+        cache.clear()
+        self.assertEqual(os.listdir(spill_directory), [])
+        self.assertEqual(cache.stats()['n_tiles'], 0)
+
+    def test_pickled_cache_is_empty(self):
+        cache = TileCache(max_bytes=5000, spill_directory=os.path.join(self.directory, 'spill'))
+        cache.put('a', make_tile(1))
+        copy = pickle.loads(pickle.dumps(cache))
+        self.assertIsNone(copy.get('a'))
+        self.assertIsNone(copy.spill_directory)
+        copy.put('a', make_tile(1))
+        self.assertIsNotNone(copy.get('a'))
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# ========================= EOF ====================================================================
@@ -0,0 +1,108 @@
+# ===============================================================================
+# Copyright 2018 dgketchum
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+
+
+import unittest
+
+import numpy as np
+
+# importing tests puts fully-conv-classification on the path.
+from tests import FULLY_CONV
+from label_encoding import LABEL_NODATA
+from tile_coverage import CoverageIndex, class_code_from_counts
+
+
+def brute_force_counts(class_map, x, y, size, n_classes):
+    window = class_map[x:x + size, y:y + size]
+    return np.array([np.count_nonzero(window == c) for c in range(n_classes)])
+
+
+def brute_force_windows(class_map, n_classes, tile_size, stride, block_size,
+                        min_labelled_fraction):
+    labelled = class_map < n_classes
+    xs, ys = np.nonzero(labelled)
+    if not xs.shape[0]:
+        return []
+    windows = []
+    for x in range(xs.min() - xs.min() % block_size, xs.max() + 1, stride):
+        for y in range(ys.min() - ys.min() % block_size, ys.max() + 1, stride):
+            if x + tile_size > class_map.shape[0] or y + tile_size > class_map.shape[1]:
+                continue
+            counts = brute_force_counts(class_map, x, y, tile_size, n_classes)
+            if counts.sum() > 0 and counts.sum() >= min_labelled_fraction * tile_size**2:
+                windows.append((x, y, counts))
+    return windows
+
+
+class TileCoverageTestCase(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.n_classes = 3
+        # not a multiple of the block size, with an unlabelled border.
+        self.class_map = np.full((150, 130), LABEL_NODATA, dtype=np.uint8)
+        self.class_map[20:140, 35:120] = rng.randint(0, self.n_classes, (120, 85))
+        self.class_map[rng.random_sample(self.class_map.shape) < 0.3] = LABEL_NODATA
+
+    def test_window_counts_match_brute_force(self):
+        index = CoverageIndex(self.class_map, self.n_classes, block_size=8)
+        xs = np.arange(0, 150, 8)
+        ys = np.arange(0, 130, 8)
+        counts = index.window_counts(xs, ys, 32)
+        for i, x in enumerate(xs):
+            for j, y in enumerate(ys):
+                np.testing.assert_array_equal(counts[i, j], brute_force_counts(
+                    self.class_map, x, y, 32, self.n_classes))
+
+    def test_select_windows_matches_brute_force(self):
+        for block_size, tile_size, stride, fraction in [(8, 32, None, 0.0), (8, 32, 16, 0.5),
+                                                        (16, 48, 16, 0.2), (1, 20, 7, 0.0)]:
+            index = CoverageIndex(self.class_map, self.n_classes, block_size=block_size)
+            got = index.select_windows(tile_size, stride=stride, min_labelled_fraction=fraction)
+            expected = brute_force_windows(self.class_map, self.n_classes, tile_size,
+                                           stride or tile_size, block_size, fraction)
+            self.assertEqual([(x, y) for x, y, _ in got], [(x, y) for x, y, _ in expected])
+            for (_, _, a), (_, _, b) in zip(got, expected):
+                np.testing.assert_array_equal(a, b)
+
+    def test_masked_labels(self):
+        labels = np.ma.masked_array(np.ones((32, 32), dtype=np.int64),
+                                    mask=np.zeros((32, 32), dtype=bool))
+        labels.mask[:, 16:] = True
+        index = CoverageIndex(labels, 2, block_size=16)
+        np.testing.assert_array_equal(index.counts(0, 0, 32), [0, 512])
+
+    def test_no_labels(self):
+        index = CoverageIndex(np.full((32, 32), LABEL_NODATA, dtype=np.uint8), 2)
+        self.assertEqual(index.select_windows(16), [])
+
+    def test_unaligned_windows_are_rejected(self):
+        index = CoverageIndex(self.class_map, self.n_classes, block_size=8)
+        with self.assertRaises(ValueError):
+            index.counts(4, 0, 32)
+        with self.assertRaises(ValueError):
+            index.counts(0, 0, 30)
+
+    def test_class_code_from_counts(self):
+        self.assertEqual(class_code_from_counts([5, 1, 0, 1]), 3)
+        self.assertEqual(class_code_from_counts([5, 9, 0, 0]), 0)
+        self.assertEqual(class_code_from_counts([0, 2, 7, 0]), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# ========================= EOF ====================================================================
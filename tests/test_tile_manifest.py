@@ -0,0 +1,134 @@
+# ===============================================================================
+# Copyright 2018 dgketchum
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+# importing tests puts fully-conv-classification on the path.
+from tests import FULLY_CONV
+from label_encoding import LABEL_NODATA
+from tile_manifest import (TileManifest, TileManifestWriter, has_manifest,
+                           scene_manifest_records, tile_id, tile_record)
+
+
+def make_record(name, class_code, pixel_counts, path=38, row=27, year=2013):
+    return {'tile': name, 'class_code': class_code, 'pixel_counts': pixel_counts,
+            'path': path, 'row': row, 'year': year, 'window': [0, 0, 16]}
+
+
+class TileManifestTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_tile_id(self):
+        class_map = np.zeros((16, 16), dtype=np.uint8)
+        tid = tile_id(38, 27, 2013, (0, 0, 16), class_map, ['B1.TIF', 'B2.TIF'])
+        self.assertEqual(tid, tile_id(38, 27, 2013, (0, 0, 16), class_map.copy(),
+                                      ('B1.TIF', 'B2.TIF')))
+        changed = class_map.copy()
+        changed[0, 0] = 1
+        for other in (tile_id(39, 27, 2013, (0, 0, 16), class_map, ['B1.TIF', 'B2.TIF']),
+                      tile_id(38, 27, 2013, (16, 0, 16), class_map, ['B1.TIF', 'B2.TIF']),
+                      tile_id(38, 27, 2013, (0, 0, 16), changed, ['B1.TIF', 'B2.TIF']),
+                      tile_id(38, 27, 2013, (0, 0, 16), class_map, ['B1.TIF'])):
+            self.assertNotEqual(tid, other)
+
+    def test_tile_record(self):
+        class_map = np.full((4, 4), LABEL_NODATA, dtype=np.uint8)
+        class_map[0] = [0, 0, 1, 2]
+        tile = {'data': np.zeros((4, 4, 3), dtype=np.uint16), 'class_map': class_map,
+                'cdl': np.array([[1, 5, 5, 5]] * 4, dtype=np.uint8), 'class_code': 0,
+                'tile_id': 'abc'}
+        record = tile_record(tile, 'class_0_data/abc.pkl', 3, 38, 27, 2013, (32, 48, 4), [1])
+        self.assertEqual(record['tile'], 'class_0_data/abc.pkl')
+        self.assertEqual(record['tile_id'], 'abc')
+        self.assertEqual(record['n_pixels'], 16)
+        self.assertEqual(record['pixel_counts'], [2, 1, 1])
+        self.assertEqual(record['nodata_pixels'], 12)
+        self.assertEqual(record['window'], [32, 48, 4])
+        self.assertAlmostEqual(record['cdl_crop_fraction'], 0.25)
+
+    def test_pixel_weights_balance_classes(self):
+        with TileManifestWriter(self.directory) as writer:
+            writer.append(make_record('a', 0, [90, 0]))
+            writer.append(make_record('b', 0, [10, 0]))
+            writer.append(make_record('c', 1, [0, 5]))
+        manifest = TileManifest(self.directory)
+        self.assertEqual(manifest.class_codes(), [0, 1])
+        self.assertEqual(manifest.tiles_for_class(0), ['a', 'b'])
+        np.testing.assert_array_equal(manifest.pixel_counts([1]), [[0, 5]])
+        np.testing.assert_allclose(manifest.pixel_weights(), [0.45, 0.05, 0.5])
+        np.testing.assert_allclose(manifest.pixel_weights([0]), [0.9, 0.1])
+
+    def test_writers_append(self):
+        self.assertFalse(has_manifest(self.directory))
+        with TileManifestWriter(self.directory) as writer:
+            writer.append(make_record('a', 0, [1, 0]))
+        with TileManifestWriter(self.directory) as writer:
+            writer.append(make_record('b', 1, [0, 1]))
+        self.assertTrue(has_manifest(self.directory))
+        self.assertEqual(TileManifest(self.directory).tiles(), ['a', 'b'])
+
+    def test_scene_manifest_supersedes_shared_records(self):
+        with TileManifestWriter(self.directory) as writer:
+            writer.append(make_record('old_38', 0, [1, 0]))
+            writer.append(make_record('old_39', 0, [1, 0], path=39))
+            writer.append({'tile': 'legacy', 'class_code': 1, 'pixel_counts': [0, 1]})
+        with TileManifestWriter(self.directory, scene='38_27_2013', overwrite=True) as writer:
+            writer.append(make_record('new_38', 0, [1, 0]))
+        self.assertEqual(sorted(TileManifest(self.directory).tiles()),
+                         ['legacy', 'new_38', 'old_39'])
+
+    def test_failed_overwrite_keeps_previous_manifest(self):
+        with TileManifestWriter(self.directory, scene='38_27_2013', overwrite=True) as writer:
+            writer.append(make_record('first', 0, [1, 0]))
+        with self.assertRaises(RuntimeError):
+            with TileManifestWriter(self.directory, scene='38_27_2013',
+                                    overwrite=True) as writer:
+                writer.append(make_record('second', 0, [1, 0]))
+                raise RuntimeError()
+        records = scene_manifest_records(self.directory, '38_27_2013')
+        self.assertEqual([r['tile'] for r in records], ['first'])
+        self.assertEqual(os.listdir(self.directory), ['manifest_38_27_2013.jsonl'])
+
+    def test_scene_manifest_overwrite(self):
+        with TileManifestWriter(self.directory, scene='38_27_2013', overwrite=True) as writer:
+            writer.append(make_record('first', 0, [1, 0]))
+            writer.append(make_record('second', 0, [1, 0]))
+        with TileManifestWriter(self.directory, scene='39_27_2013') as writer:
+            writer.append(make_record('other', 1, [0, 1], path=39))
+        # re-extracting a scene lists only the tiles of that run.
+        with TileManifestWriter(self.directory, scene='38_27_2013', overwrite=True) as writer:
+            writer.append(make_record('second', 0, [1, 0]))
+        records = scene_manifest_records(self.directory, '38_27_2013')
+        self.assertEqual([r['tile'] for r in records], ['second'])
+        self.assertTrue(has_manifest(self.directory))
+        self.assertEqual(sorted(TileManifest(self.directory).tiles()), ['other', 'second'])
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# ========================= EOF ====================================================================
@@ -0,0 +1,137 @@
+# ===============================================================================
+# Copyright 2018 dgketchum
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+
+
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+# importing tests puts fully-conv-classification on the path.
+from tests import FULLY_CONV
+from label_encoding import one_hot_from_class_map
+from tile_store import TileStore, TileStoreWriter, convert_pickle_directory, is_tile_store
+
+
+def make_tiles(n, seed=0):
+    rng = np.random.RandomState(seed)
+    return [{'data': rng.randint(0, 10000, (8, 8, 3)).astype(np.uint16),
+             'class_map': rng.randint(0, 3, (8, 8)).astype(np.uint8),
+             'cdl': rng.randint(0, 255, (8, 8)).astype(np.uint8),
+             'class_code': k % 3} for k in range(n)]
+
+
+class TileStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store_directory = os.path.join(self.directory, 'store')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def assert_tiles_equal(self, tile, expected):
+        self.assertEqual(tile['class_code'], expected['class_code'])
+        for key in ('data', 'class_map', 'cdl'):
+            np.testing.assert_array_equal(tile[key], expected[key])
+            self.assertEqual(tile[key].dtype, expected[key].dtype)
+
+    def test_round_trip_across_shards(self):
+        tiles = make_tiles(7)
+        with TileStoreWriter(self.store_directory, tiles_per_shard=3) as writer:
+            refs = [writer.add(tile) for tile in tiles]
+        # add returns the tile's index, which the manifest records.
+        self.assertEqual(refs, list(range(7)))
+        self.assertTrue(is_tile_store(self.store_directory))
+        store = TileStore(self.store_directory)
+        self.assertEqual(len(store), 7)
+        for k, tile in enumerate(tiles):
+            self.assert_tiles_equal(store[k], tile)
+        self.assertEqual(store.class_codes(), [0, 1, 2])
+        self.assertEqual(store.tiles_for_class(1), [1, 4])
+
+    def test_reopened_store_appends(self):
+        tiles = make_tiles(5)
+        with TileStoreWriter(self.store_directory, tiles_per_shard=4) as writer:
+            for tile in tiles[:2]:
+                writer.add(tile)
+        with TileStoreWriter(self.store_directory) as writer:
+            self.assertEqual([writer.add(tile) for tile in tiles[2:]], [2, 3, 4])
+        store = TileStore(self.store_directory)
+        self.assertEqual(len(store), 5)
+        for k, tile in enumerate(tiles):
+            self.assert_tiles_equal(store[k], tile)
+
+    def test_pickled_store_reopens_shards(self):
+        tiles = make_tiles(2)
+        with TileStoreWriter(self.store_directory) as writer:
+            for tile in tiles:
+                writer.add(tile)
+        store = TileStore(self.store_directory)
+        store[0]
+        copy = pickle.loads(pickle.dumps(store))
+        self.assertEqual(copy._shards, {})
+        self.assert_tiles_equal(copy[1], tiles[1])
+
+    def test_mismatched_tile_is_rejected(self):
+        tiles = make_tiles(2)
+        tiles[1]['data'] = tiles[1]['data'][:4]
+        with TileStoreWriter(self.store_directory) as writer:
+            writer.add(tiles[0])
+            with self.assertRaises(ValueError):
+                writer.add(tiles[1])
+
+    def test_tile_with_other_arrays_is_rejected(self):
+        tiles = make_tiles(2)
+        with TileStoreWriter(self.store_directory) as writer:
+            writer.add(tiles[0])
+        one_hot_tile = dict(tiles[1])
+        one_hot_tile['one_hot'] = one_hot_from_class_map(one_hot_tile.pop('class_map'), 3)
+        without_cdl = dict(tiles[1])
+        del without_cdl['cdl']
+        with TileStoreWriter(self.store_directory) as writer:
+            for tile in (one_hot_tile, without_cdl):
+                with self.assertRaises(ValueError) as e:
+                    writer.add(tile)
+                self.assertIn('class_map', str(e.exception))
+            writer.add(tiles[1])
+        self.assertEqual(len(TileStore(self.store_directory)), 2)
+
+    def test_convert_pickle_directory(self):
+        tiles = make_tiles(4)
+        pickle_directory = os.path.join(self.directory, 'pickles')
+        for k, tile in enumerate(tiles):
+            class_directory = os.path.join(pickle_directory, 'class_{}_data'.format(
+                tile['class_code']))
+            os.makedirs(class_directory, exist_ok=True)
+            old_tile = dict(tile)
+            old_tile['one_hot'] = one_hot_from_class_map(old_tile.pop('class_map'), 3)
+            with open(os.path.join(class_directory, '{}.pkl'.format(k)), 'wb') as f:
+                pickle.dump(old_tile, f)
+        self.assertEqual(convert_pickle_directory(pickle_directory, self.store_directory), 4)
+        store = TileStore(self.store_directory)
+        # files are converted in sorted order: class_0 (0, 3), class_1 (1), class_2 (2).
+        for k, tile in zip(range(4), [tiles[0], tiles[3], tiles[1], tiles[2]]):
+            self.assert_tiles_equal(store[k], tile)
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# ========================= EOF ====================================================================
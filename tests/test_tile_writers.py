@@ -0,0 +1,164 @@
+# ===============================================================================
+# Copyright 2018 dgketchum
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+
+
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+import unittest
+
+import numpy as np
+
+# importing tests puts fully-conv-classification on the path.
+from tests import FULLY_CONV
+from tile_writers import AsyncTileWriter, PickleTileWriter
+
+
+def make_tile(k):
+    return {'data': np.full((4, 4, 2), k, dtype=np.uint16), 'class_code': k % 2}
+
+
+class ListWriter(object):
+    ''' Keeps tiles in memory; fails on the tile numbered fail_on. '''
+
+    def __init__(self, fail_on=None, delay=None):
+        self.tiles = []
+        self.fail_on = fail_on
+        self.delay = delay
+        self.closed = False
+
+    def add(self, tile):
+        if self.delay is not None:
+            self.delay.wait()
+        if int(tile['data'][0, 0, 0]) == self.fail_on:
+            raise IOError('disk full')
+        self.tiles.append(tile)
+        return len(self.tiles) - 1
+
+    def close(self):
+        self.closed = True
+
+
+class ListManifest(object):
+
+    def __init__(self):
+        self.records = []
+
+    def append(self, record):
+        self.records.append(record)
+
+
+class TileWritersTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_pickle_writer(self):
+        writer = PickleTileWriter(self.directory)
+        refs = [writer.add(make_tile(k)) for k in range(3)]
+        self.assertEqual(len(set(refs)), 3)
+        for k, ref in enumerate(refs):
+            self.assertTrue(ref.startswith('class_{}_data'.format(k % 2)))
+            with open(os.path.join(self.directory, ref), 'rb') as f:
+                np.testing.assert_array_equal(pickle.load(f)['data'], make_tile(k)['data'])
+        self.assertFalse(any(f.endswith('.tmp') for _, _, files in os.walk(self.directory)
+                             for f in files))
+
+    def test_tiles_are_written_in_order_with_their_records(self):
+        writer = ListWriter()
+        manifest = ListManifest()
+        with AsyncTileWriter(writer, manifest=manifest, max_queue=2,
+                             verbose=False) as async_writer:
+            for k in range(10):
+                async_writer.add(make_tile(k), {'k': k})
+            async_writer.add(make_tile(10))
+        self.assertTrue(writer.closed)
+        self.assertEqual([int(t['data'][0, 0, 0]) for t in writer.tiles], list(range(11)))
+        self.assertEqual(manifest.records, [{'k': k, 'tile': k} for k in range(10)])
+        self.assertEqual(async_writer.stats()['tiles'], 11)
+
+    def test_threads_write_every_tile(self):
+        manifest = ListManifest()
+        with AsyncTileWriter(PickleTileWriter(self.directory), manifest=manifest,
+                             verbose=False) as writer:
+            for k in range(20):
+                writer.add(make_tile(k), {'k': k})
+        self.assertEqual(sorted(r['k'] for r in manifest.records), list(range(20)))
+        for record in manifest.records:
+            self.assertTrue(os.path.isfile(os.path.join(self.directory, record['tile'])))
+
+    def test_writer_errors_are_raised_by_close(self):
+        writer = ListWriter(fail_on=3)
+        async_writer = AsyncTileWriter(writer, verbose=False)
+        for k in range(6):
+            async_writer.add(make_tile(k))
+        with self.assertRaises(IOError):
+            async_writer.close()
+        self.assertEqual(len(writer.tiles), 3)
+
+    def test_writer_errors_are_raised_by_the_next_add(self):
+        delay = threading.Event()
+        writer = ListWriter(fail_on=0, delay=delay)
+        async_writer = AsyncTileWriter(writer, max_queue=1, verbose=False)
+        async_writer.add(make_tile(0))
+        delay.set()
+        with self.assertRaises(IOError):
+            for k in range(1, 100):
+                async_writer.add(make_tile(k))
+        # the queue was drained, so closing doesn't block.
+        with self.assertRaises(IOError):
+            async_writer.close()
+
+    def test_body_errors_are_not_masked_by_writer_errors(self):
+        writer = ListWriter(fail_on=0)
+        with self.assertRaises(KeyError):
+            with AsyncTileWriter(writer, verbose=False) as async_writer:
+                async_writer.add(make_tile(0))
+                raise KeyError('extraction failed')
+        self.assertTrue(writer.closed)
+        self.assertIsNone(async_writer._threads)
+
+    def test_body_errors_drop_queued_tiles(self):
+        delay = threading.Event()
+        writer = ListWriter(delay=delay)
+        with self.assertRaises(KeyError):
+            with AsyncTileWriter(writer, verbose=False) as async_writer:
+                for k in range(5):
+                    async_writer.add(make_tile(k))
+                # lets the first tile finish once __exit__ is dropping the rest.
+                threading.Timer(0.2, delay.set).start()
+                raise KeyError('extraction failed')
+        self.assertTrue(writer.closed)
+        # the tile already being written when the body failed is kept.
+        self.assertLessEqual(len(writer.tiles), 1)
+
+    def test_unsafe_writers_get_one_thread(self):
+        with self.assertRaises(ValueError):
+            AsyncTileWriter(ListWriter(), n_threads=2)
+        async_writer = AsyncTileWriter(ListWriter(), verbose=False)
+        self.assertEqual(len(async_writer._threads), 1)
+        async_writer.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# ========================= EOF ====================================================================
@@ -0,0 +1,125 @@
+# ===============================================================================
+# Copyright 2018 dgketchum
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+# importing tests puts fully-conv-classification on the path.
+from tests import FULLY_CONV
+from label_encoding import LABEL_NODATA
+from training_cubes import find_training_cubes, load_training_cube, save_training_cube
+
+
+def make_scene(seed, shape=(40, 36)):
+    rng = np.random.RandomState(seed)
+    image_stack = rng.randint(0, 10000, shape + (3,)).astype(np.uint16)
+    labels = np.ma.masked_array(rng.randint(0, 3, shape), mask=rng.random_sample(shape) < 0.5)
+    cdl = rng.randint(0, 255, shape + (1,)).astype(np.uint8)
+    return image_stack, labels, cdl
+
+
+class CountingStack(object):
+    ''' Array stand in for a lazy stack, counting the reads. '''
+
+    def __init__(self, arr):
+        self.arr = arr
+        self.reads = 0
+
+    def __getitem__(self, key):
+        self.reads += 1
+        return self.arr[key]
+
+
+class TrainingCubeTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_round_trip(self):
+        image_stack, labels, cdl = make_scene(0)
+        save_training_cube(image_stack, labels, cdl, self.directory, 'train', '38_27_2013')
+        cube = os.path.join(self.directory, 'train', '38_27_2013')
+        features, class_map, cube_cdl = load_training_cube(cube)
+        self.assertIsInstance(features, np.memmap)
+        np.testing.assert_array_equal(features, image_stack)
+        np.testing.assert_array_equal(cube_cdl, cdl)
+        self.assertEqual(class_map.dtype, np.uint8)
+        np.testing.assert_array_equal(class_map, np.ma.filled(labels, LABEL_NODATA))
+
+    def test_splits_share_the_scene(self):
+        image_stack, labels, cdl = make_scene(0)
+        _, test_labels, _ = make_scene(1)
+        save_training_cube(image_stack, labels, cdl, self.directory, 'train', '38_27_2013')
+        save_training_cube(image_stack, test_labels, cdl, self.directory, 'test', '38_27_2013')
+        self.assertEqual(os.listdir(os.path.join(self.directory, 'scenes')), ['38_27_2013'])
+        train = load_training_cube(os.path.join(self.directory, 'train', '38_27_2013'))
+        test = load_training_cube(os.path.join(self.directory, 'test', '38_27_2013'))
+        np.testing.assert_array_equal(train[0], test[0])
+        np.testing.assert_array_equal(test[1], np.ma.filled(test_labels, LABEL_NODATA))
+
+    def test_scene_rewritten_when_its_sources_change(self):
+        source = os.path.join(self.directory, 'scene_cube.tif')
+        open(source, 'w').close()
+        image_stack, labels, cdl = make_scene(0)
+        save_training_cube(image_stack, labels, cdl, self.directory, 'train', '38_27_2013',
+                           source_paths=[source])
+        cube = os.path.join(self.directory, 'train', '38_27_2013')
+
+        # unchanged sources: the saved scene is kept and the stacks aren't read.
+        stack, cdl_stack = CountingStack(make_scene(1)[0]), CountingStack(cdl)
+        save_training_cube(stack, labels, cdl_stack, self.directory, 'test', '38_27_2013',
+                           source_paths=[source])
+        self.assertEqual((stack.reads, cdl_stack.reads), (0, 0))
+        np.testing.assert_array_equal(load_training_cube(cube)[0], image_stack)
+
+        later = os.path.getmtime(source) + 10
+        os.utime(source, (later, later))
+        new_image_stack, new_labels, new_cdl = make_scene(2)
+        save_training_cube(new_image_stack, new_labels, new_cdl, self.directory, 'train',
+                           '38_27_2013', source_paths=[source])
+        features, class_map, cube_cdl = load_training_cube(cube)
+        np.testing.assert_array_equal(features, new_image_stack)
+        np.testing.assert_array_equal(cube_cdl, new_cdl)
+        np.testing.assert_array_equal(class_map, np.ma.filled(new_labels, LABEL_NODATA))
+
+    def test_scene_without_sources_is_always_rewritten(self):
+        save_training_cube(*make_scene(0), self.directory, 'train', '38_27_2013')
+        image_stack, labels, cdl = make_scene(1)
+        save_training_cube(image_stack, labels, cdl, self.directory, 'train', '38_27_2013')
+        features = load_training_cube(os.path.join(self.directory, 'train', '38_27_2013'))[0]
+        np.testing.assert_array_equal(features, image_stack)
+
+    def test_find_training_cubes(self):
+        for path_row_year in ('39_27_2013', '38_27_2013'):
+            save_training_cube(*make_scene(0), self.directory, 'train', path_row_year)
+        os.makedirs(os.path.join(self.directory, 'train', 'not_a_cube'))
+        train = os.path.join(self.directory, 'train')
+        self.assertEqual(find_training_cubes(train), [os.path.join(train, '38_27_2013'),
+                                                      os.path.join(train, '39_27_2013')])
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# ========================= EOF ====================================================================
@@ -0,0 +1,117 @@
+# ===============================================================================
+# Copyright 2018 dgketchum
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ===============================================================================
+
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from fiona import open as fopen
+from shapely.geometry import box, mapping
+
+from pixel_classification.wrs2_index import WRS2Index
+
+SCHEMA = {'geometry': 'Polygon', 'properties': {'PATH': 'int', 'ROW': 'int'}}
+
+
+def write_tiles(shapefile, tiles):
+    ''' tiles: (path, row, (minx, miny, maxx, maxy)). '''
+    with fopen(shapefile, 'w', driver='ESRI Shapefile', schema=SCHEMA,
+               crs='EPSG:4326') as dst:
+        for path, row, bounds in tiles:
+            dst.write({'geometry': mapping(box(*bounds)),
+                       'properties': {'PATH': path, 'ROW': row}})
+
+
+class WRS2IndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache_directory = os.path.join(self.directory, 'cache')
+        os.makedirs(self.cache_directory)
+        self.shapefile = os.path.join(self.directory, 'wrs2.shp')
+        write_tiles(self.shapefile, [(38, 27, (0, 0, 2, 2)), (39, 27, (1, 0, 3, 2)),
+                                     (38, 28, (0, -2, 2, 0.5))])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def index(self):
+        return WRS2Index(self.shapefile, cache_directory=self.cache_directory)
+
+    def test_lookups(self):
+        index = self.index()
+        self.assertEqual(len(index), 3)
+        self.assertEqual(index.geometry(38, 27).bounds, (0, 0, 2, 2))
+        self.assertIsNone(index.geometry(40, 27))
+        self.assertEqual(index.feature(39, 27)['properties'], {'PATH': 39, 'ROW': 27})
+        self.assertEqual(index.path_rows_at(1.5, 1), [(38, 27), (39, 27)])
+        self.assertEqual(index.path_rows_containing(box(0.2, 0.6, 0.8, 0.8)), [(38, 27)])
+        self.assertEqual(index.path_rows_intersecting(box(0.2, 0.2, 0.8, 0.8)),
+                         [(38, 27), (38, 28)])
+
+    def test_cache_reused_while_the_shapefile_is_unchanged(self):
+        self.index()
+        self.assertEqual(len(os.listdir(self.cache_directory)), 1)
+
+        def fail(index):
+            raise AssertionError('shapefile read again')
+        read_shapefile = WRS2Index._read_shapefile
+        WRS2Index._read_shapefile = fail
+        try:
+            self.assertEqual(self.index().path_rows_at(2.5, 1), [(39, 27)])
+        finally:
+            WRS2Index._read_shapefile = read_shapefile
+
+    def test_cache_rebuilt_when_the_shapefile_changes(self):
+        self.assertEqual(len(self.index()), 3)
+        write_tiles(self.shapefile, [(40, 27, (5, 5, 7, 7))])
+        later = os.path.getmtime(self.shapefile) + 10
+        os.utime(self.shapefile, (later, later))
+        index = self.index()
+        self.assertEqual(index.path_rows, [(40, 27)])
+        self.assertEqual(index.path_rows_at(6, 6), [(40, 27)])
+
+    def test_same_named_shapefiles_get_their_own_caches(self):
+        other = os.path.join(self.directory, 'other')
+        os.makedirs(other)
+        write_tiles(os.path.join(other, 'wrs2.shp'), [(40, 27, (5, 5, 7, 7))])
+        self.assertEqual(len(self.index()), 3)
+        self.assertEqual(len(WRS2Index(os.path.join(other, 'wrs2.shp'),
+                                       cache_directory=self.cache_directory)), 1)
+        self.assertEqual(len(self.index()), 3)
+        self.assertEqual(len(os.listdir(self.cache_directory)), 2)
+
+    def test_cache_directory_created(self):
+        cache_directory = os.path.join(self.cache_directory, 'IrrMapper')
+        index = WRS2Index(self.shapefile, cache_directory=cache_directory)
+        self.assertTrue(os.path.isfile(index.cache_file))
+        self.assertEqual(os.path.dirname(index.cache_file), cache_directory)
+
+    def test_unreadable_cache_is_rebuilt(self):
+        self.index()
+        cache_file = self.index().cache_file
+        with open(cache_file, 'wb') as f:
+            f.write(b'not a pickle')
+        self.assertEqual(len(self.index()), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+# ========================= EOF ====================================================================